@@ -7,7 +7,7 @@ import pandas as pd
 import scipy.sparse as sp
 from sklearn.base import BaseEstimator, TransformerMixin
 
-from brainless.utils.utils import CustomLabelEncoder
+from brainless.utils.utils import CustomLabelEncoder, is_sparse_col
 
 bad_values = {
     float('nan'),
@@ -16,6 +16,21 @@ bad_values = {
     '-inf'
 }
 
+# Object columns holding just one of these kinds of values can be factorized without stringifying
+# every value first
+single_type_inferred_dtypes = {'string', 'empty', 'integer', 'floating', 'boolean'}
+
+
+# This is how we turn a categorical value into the string that gets appended to the column name
+def stringify_category(val):
+    if not isinstance(val, str):
+        if isinstance(val, numbers.Number) or val is None:
+            val = str(val)
+        else:
+            val = val.encode('utf-8').decode('utf-8')
+    return val
+
+
 class DataFrameVectorizer(BaseEstimator, TransformerMixin):
 
     def __init__(self,
@@ -41,6 +56,7 @@ class DataFrameVectorizer(BaseEstimator, TransformerMixin):
             'int8', 'int16', 'int32', 'int64', 'float16', 'float32', 'float64'
         ]
         self.additional_numerical_cols = []
+        self.categorical_index = None
 
     def get(self, prop_name, default=None):
         try:
@@ -78,6 +94,8 @@ class DataFrameVectorizer(BaseEstimator, TransformerMixin):
         new_cols = numerical_columns + categorical_columns
         X = X[new_cols]
 
+        categorical_index = {}
+
         for col_name in X.columns:
 
             if self.column_descriptions.get(col_name,
@@ -94,18 +112,20 @@ class DataFrameVectorizer(BaseEstimator, TransformerMixin):
                                             False) == 'categorical' and not self.keep_cat_features:
                 # If this is a categorical column, iterate through each row to get all the
                 # possible values that we are one-hot-encoding.
+                categories = []
                 for val in set(X[col_name]):
-                    if not isinstance(val, str):
-                        if isinstance(val, numbers.Number) or val is None:
-                            val = str(val)
-                        else:
-                            val = val.encode('utf-8').decode('utf-8')
+                    val = stringify_category(val)
 
                     feature_name = col_name + self.separator + val
 
                     if feature_name not in vocab:
                         feature_names.append(feature_name)
                         vocab[feature_name] = len(vocab)
+                        categories.append(val)
+
+                if len(categories) > 0:
+                    categorical_index[col_name] = self._make_index_entry(
+                        vocab[col_name + self.separator + categories[0]], categories)
 
             # If this is a categorical column, do not include the column name itself,
             # just include the feature_names as calculated above
@@ -115,8 +135,36 @@ class DataFrameVectorizer(BaseEstimator, TransformerMixin):
 
         self.feature_names_ = feature_names
         self.vocabulary_ = vocab
+        self.categorical_index = categorical_index
         return self
 
+    # Each one-hot-encoded column writes to one contiguous block of our results. The index maps
+    # col_name -> (start_idx, categories, category_offsets), where categories is the list of
+    # stringified values in block order, and category_offsets maps each of those values to its
+    # position within the block.
+    @staticmethod
+    def _make_index_entry(start_idx, categories):
+        category_offsets = {val: offset for offset, val in enumerate(categories)}
+        return (start_idx, categories, category_offsets)
+
+    # Models trained before we kept a categorical_index will not have one. Rebuild it from the
+    # vocabulary the first time it's needed.
+    def get_categorical_index(self):
+        if self.get('categorical_index') is None:
+            categorical_index = {}
+            if not self.get('keep_cat_features', False):
+                for col_name in self.categorical_columns:
+                    prefix = col_name + self.separator
+                    len_prefix = len(prefix)
+                    block = sorted([(col_idx, feature_name[len_prefix:])
+                                    for feature_name, col_idx in self.vocabulary_.items()
+                                    if feature_name[:len_prefix] == prefix])
+                    if len(block) > 0:
+                        categorical_index[col_name] = self._make_index_entry(
+                            block[0][0], [val for col_idx, val in block])
+            self.categorical_index = categorical_index
+        return self.categorical_index
+
     # TODO: Simplify
     def _transform(self, X):
 
@@ -125,6 +173,7 @@ class DataFrameVectorizer(BaseEstimator, TransformerMixin):
 
         if isinstance(X, dict):
 
+            categorical_index = self.get_categorical_index()
             indices = array("i")
             indptr = array("i", [0])
             values = []
@@ -132,13 +181,13 @@ class DataFrameVectorizer(BaseEstimator, TransformerMixin):
             for feature, value in X.items():
                 if self.column_descriptions.get(feature, False) == 'categorical':
                     if not self.get('keep_cat_features', False):
-                        if not isinstance(value, str):
-                            if isinstance(value, numbers.Number) or value is None:
-                                value = str(value)
-                            else:
-                                value = value.encode('utf-8').decode('utf-8')
-                        feature = feature + self.separator + value
-                        value = 1
+                        if feature in categorical_index:
+                            start_idx, categories, category_offsets = categorical_index[feature]
+                            offset = category_offsets.get(stringify_category(value))
+                            if offset is not None:
+                                indices.append(start_idx + offset)
+                                values.append(datatype(1))
+                        continue
                     else:
                         if value in bad_values:
                             value = '_None'
@@ -167,47 +216,116 @@ class DataFrameVectorizer(BaseEstimator, TransformerMixin):
             return result_matrix
 
         else:
+            # X itself is never modified. Columns we trained on that X doesn't have, along with
+            # missing values, are read as 0s.
+            if not self.keep_cat_features:
+                return self._transform_df_to_sparse(X)
 
-            for col in self.numerical_columns:
-                if col not in X.columns:
-                    X[col] = 0
-            for col in self.categorical_columns:
-                if col not in X.columns:
-                    X[col] = 0
-            for col in self.additional_numerical_cols:
-                if col not in X.columns:
-                    X[col] = 0
+            # Running this in parallel can cause memory crashes if the dataset is too large.
+            # TODO: With as complex as this lambda is, consider refactoring into an actual function
+            categorical_values = list(map(
+                lambda col_name: self.transform_categorical_col(
+                    col_values=list(self.get_categorical_values(X, col_name)), col_name=col_name),
+                self.categorical_columns))
 
+            # reindex gives us a new frame, with every missing column added at once
+            X = X.reindex(columns=self.numerical_columns, fill_value=0)
             X.fillna(0, inplace=True)
 
             for idx, col in enumerate(self.numerical_columns):
-                if X[col].dtype not in self.numeric_col_types:
+                if X[col].dtype not in self.numeric_col_types and not is_sparse_col(X[col]):
                     X[col] = X[col].astype(np.float32)
 
-            # Running this in parallel can cause memory crashes if the dataset is too large.
-            # TODO: With as complex as this lambda is, consider refactoring into an actual function
-            categorical_values = list(map(
-                lambda col_name: self.transform_categorical_col(col_values=list(X[col_name]),
-                                                                col_name=col_name),
-                self.categorical_columns))
-
-            X = X[self.numerical_columns]
-            # X.drop(self.categorical_columns, inplace=True, axis=1)
             X.reset_index(drop=True, inplace=True)
             for result in categorical_values:
                 result.reset_index(drop=True, inplace=True)
                 X[result.columns] = result
                 del result
 
-        if self.keep_cat_features:
-            return X
-        else:
-            X = sp.csr_matrix(X.values)
             return X
 
-    # We are assuming that each categorical column got a contiguous block of result columns (ie,
-    # the 5 categories in City get columns 5-9, not columns 0, 8, 26, 4, and 20)
-    # TODO: Simplify
+    # Builds the numerical block and each categorical block as their own CSR matrices, and stacks
+    # them together once at the end. Nothing here is ever densified beyond the numerical columns,
+    # which is what keeps memory in check for wide one-hot encodings.
+    def _transform_df_to_sparse(self, X):
+        blocks = [self._numerical_block(X)]
+
+        categorical_index = self.get_categorical_index()
+        for col_name in self.categorical_columns:
+            if col_name in categorical_index:
+                blocks.append(self.one_hot_encode_col(self.get_categorical_values(X, col_name),
+                                                      col_name,
+                                                      dtype=self.datatype))
+
+        additional_numerical_cols = self.get('additional_numerical_cols', [])
+        if len(additional_numerical_cols) > 0:
+            blocks.append(dense_to_csr(self.get_numerical_values(X, additional_numerical_cols)))
+
+        return sp.hstack(blocks, format='csr', dtype=self.datatype)
+
+    # A categorical column's values, with missing values as 0, and all 0s if X doesn't have the
+    # column at all
+    @staticmethod
+    def get_categorical_values(X, col_name):
+        if col_name not in X.columns:
+            return np.zeros(X.shape[0], dtype=np.int64)
+        col_values = X[col_name]
+        if col_values.hasnans:
+            col_values = col_values.fillna(0)
+        return col_values
+
+    # Gathers these (dense) numerical columns of X into a single new array of our datatype, one
+    # column at a time, so it doesn't matter how fragmented X is. Missing values, and columns X
+    # doesn't have, come through as 0s.
+    def get_numerical_values(self, X, cols):
+        values = np.zeros((X.shape[0], len(cols)), dtype=self.datatype)
+        for col_idx, col in enumerate(cols):
+            if col in X.columns:
+                col_values = X[col]
+                # Anything that isn't already numeric gets cast the same way astype would, after
+                # filling in missing values
+                if col_values.dtype == object:
+                    col_values = col_values.fillna(0)
+                values[:, col_idx] = col_values.values
+        values[np.isnan(values)] = 0
+        return values
+
+    # Text features come to us as pandas sparse columns. Those go straight into CSR without ever
+    # being densified, and then get shuffled back into their place among the numerical columns.
+    def _numerical_block(self, X):
+        dense_cols = []
+        sparse_cols = []
+        for col in self.numerical_columns:
+            if col in X.columns and is_sparse_col(X[col]):
+                sparse_cols.append(col)
+            else:
+                dense_cols.append(col)
+
+        numerical_block = dense_to_csr(self.get_numerical_values(X, dense_cols))
+
+        if len(sparse_cols) == 0:
+            return numerical_block
+
+        sparse_block = sp.csr_matrix(X[sparse_cols].sparse.to_coo(), dtype=self.datatype)
+        numerical_block = sp.hstack([numerical_block, sparse_block], format='csr')
+
+        block_positions = {col: idx for idx, col in enumerate(dense_cols + sparse_cols)}
+        col_order = [block_positions[col] for col in self.numerical_columns]
+        if col_order != list(range(len(col_order))):
+            numerical_block = numerical_block[:, col_order]
+        return numerical_block
+
+    # Returns the encoded column names for this categorical column's block, in order, along with
+    # the index of the first one
+    def get_categorical_block(self, col_name):
+        if col_name not in self.get_categorical_index():
+            return [], None
+        start_idx, categories, category_offsets = self.get_categorical_index()[col_name]
+        encoded_col_names = [col_name + self.separator + val for val in categories]
+        return encoded_col_names, start_idx
+
+    # Each categorical column gets a contiguous block of result columns (ie, the 5 categories in
+    # City get columns 5-9, not columns 0, 8, 26, 4, and 20)
     def transform_categorical_col(self, col_values, col_name):
         if self.get('keep_cat_features', False):
             return_values = self.get('label_encoders')[col_name].transform(col_values)
@@ -219,55 +337,75 @@ class DataFrameVectorizer(BaseEstimator, TransformerMixin):
             return result
 
         else:
+            encoded_col_names, start_idx = self.get_categorical_block(col_name)
 
-            num_trained_cols = 0
-            min_transformed_idx = None
-            max_transformed_idx = None
-            len_col_name = len(col_name)
-            encoded_col_names = []
-
-            for trained_feature, col_idx in self.vocabulary_.items():
-                if trained_feature[:len_col_name] == col_name:
-                    encoded_col_names.append([trained_feature, col_idx])
-                    num_trained_cols += 1
-                    if min_transformed_idx is None:
-                        min_transformed_idx = col_idx
-                        max_transformed_idx = col_idx
-                    elif col_idx > max_transformed_idx:
-                        max_transformed_idx = col_idx
-                    elif col_idx < min_transformed_idx:
-                        min_transformed_idx = col_idx
-
-            encoded_col_names = sorted(encoded_col_names, key=lambda tup: tup[1])
-            encoded_col_names = [tup[0] for tup in encoded_col_names]
-
-            result = sp.lil_matrix((len(col_values), num_trained_cols))
-
-            if num_trained_cols == 0:
-                df_result = pd.DataFrame(result.toarray(), columns=encoded_col_names)
+            if len(encoded_col_names) == 0:
+                df_result = pd.DataFrame(np.zeros((len(col_values), 0)), columns=encoded_col_names)
                 return df_result
 
-            if num_trained_cols != (max_transformed_idx - min_transformed_idx + 1):
-                raise ValueError('We have somehow ended up with categorical column '
-                                 'behavior we were not expecting ')
-
-            for row_idx, val in enumerate(col_values):
-                if not isinstance(val, str):
-                    if isinstance(val, numbers.Number) or val is None:
-                        val = str(val)
-                    else:
-                        val = val.encode('utf-8').decode('utf-8')
-
-                feature_name = col_name + self.separator + val
-                if feature_name in self.vocabulary_:
-                    col_idx = self.vocabulary_[feature_name]
-                    col_idx = col_idx - min_transformed_idx
-
-                    result[row_idx, col_idx] = 1
+            result = self.one_hot_encode_col(col_values, col_name)
 
             df_result = pd.DataFrame(result.toarray(), columns=encoded_col_names)
             return df_result
 
+    # Builds the one-hot block for a single categorical column directly as a CSR matrix, with
+    # columns numbered from the start of the block.
+    # Rather than looking up every row, we factorize the column once, look up each unique value,
+    # and then broadcast those lookups back out to every row using the codes.
+    def one_hot_encode_col(self, col_values, col_name, dtype=np.float64):
+        start_idx, categories, category_offsets = self.get_categorical_index()[col_name]
+
+        if isinstance(col_values, pd.Series):
+            values = col_values.values
+        elif isinstance(col_values, np.ndarray):
+            values = col_values
+        else:
+            # Building an object array directly keeps python values exactly as they were (np.asarray
+            # would turn a list of ints with a None into floats, for instance)
+            values = np.array(col_values, dtype=object)
+
+        if values.ndim != 1:
+            # np.asarray will happily turn a list of lists into a 2d array
+            values = np.empty(len(col_values), dtype=object)
+            for row_idx, val in enumerate(col_values):
+                values[row_idx] = val
+        col_values = values
+        num_rows = col_values.shape[0]
+
+        # factorize considers 1, 1.0, and True to be the same value, but they are different
+        # categories once they have been stringified. If a column mixes types like that, we
+        # stringify every row first.
+        if col_values.dtype == object and pd.api.types.infer_dtype(
+                col_values, skipna=True) not in single_type_inferred_dtypes:
+            col_values = np.array([stringify_category(val) for val in col_values], dtype=object)
+
+        codes, uniques = pd.factorize(col_values)
+        uniques = list(uniques)
+
+        # Each unique value's column within this block, or -1 if it was not seen during training.
+        # factorize gives missing values (None, nan) a code of -1, which lands on the extra -1
+        # entry at the end.
+        unique_col_idxs = np.full(len(uniques) + 1, -1, dtype=np.int64)
+        for unique_idx, val in enumerate(uniques):
+            unique_col_idxs[unique_idx] = category_offsets.get(stringify_category(val), -1)
+
+        row_col_idxs = unique_col_idxs[codes]
+
+        # None and nan stringify differently, so the (usually rare) missing rows are looked up
+        # one by one
+        missing_rows = np.flatnonzero(codes == -1)
+        for row_idx in missing_rows:
+            row_col_idxs[row_idx] = category_offsets.get(
+                stringify_category(col_values[row_idx]), -1)
+
+        has_value = row_col_idxs >= 0
+        indices = row_col_idxs[has_value].astype(np.intc)
+        indptr = np.zeros(num_rows + 1, dtype=np.intc)
+        np.cumsum(has_value, out=indptr[1:])
+        data = np.ones(indices.shape[0], dtype=dtype)
+
+        return sp.csr_matrix((data, indices, indptr), shape=(num_rows, len(categories)))
+
     def transform(self, X):
         return self._transform(X)
 
@@ -280,6 +418,10 @@ class DataFrameVectorizer(BaseEstimator, TransformerMixin):
 
     # This is for cases where we want to add in new features, such as for feature_learning
     def add_new_numerical_cols(self, new_feature_names):
+        # Make sure our categorical_index exists before the vocabulary changes underneath it. New
+        # columns are appended after every categorical block, so the index itself stays the same.
+        self.get_categorical_index()
+
         # add to our vocabulary
         for feature_name in new_feature_names:
             if feature_name not in self.vocabulary_:
@@ -296,8 +438,11 @@ class DataFrameVectorizer(BaseEstimator, TransformerMixin):
         if self.has_been_restricted:
             return self
 
+        categorical_index = self.get_categorical_index()
+        numerical_columns = set(self.numerical_columns)
+        additional_numerical_cols = set(self.additional_numerical_cols)
+
         new_numerical_cols = []
-        new_categorical_cols = []
         new_additional_numerical_cols = []
         new_feature_names = []
         new_vocab = {}
@@ -305,25 +450,50 @@ class DataFrameVectorizer(BaseEstimator, TransformerMixin):
         for idx, val in enumerate(support):
             if val:
                 feature_name = self.feature_names_[idx]
-                if self.separator in feature_name:
-                    base_feature_name = feature_name[:feature_name.rfind(self.separator)]
-                else:
-                    base_feature_name = feature_name
                 new_feature_names.append(feature_name)
                 new_vocab[feature_name] = len(new_vocab)
-                if feature_name in self.numerical_columns:
+                if feature_name in numerical_columns:
                     new_numerical_cols.append(feature_name)
-                elif base_feature_name in self.categorical_columns \
-                        and base_feature_name not in new_categorical_cols:
-                    new_categorical_cols.append(base_feature_name)
-                elif feature_name in self.additional_numerical_cols:
+                elif feature_name in additional_numerical_cols:
                     new_additional_numerical_cols.append(feature_name)
 
+        # Blocks keep their relative order, so each categorical column still gets a contiguous
+        # block, just a (possibly) smaller one that starts earlier
+        new_categorical_cols = []
+        new_categorical_index = {}
+        for col_name in self.categorical_columns:
+            # Label encoded columns are a single feature, named after the column itself
+            if self.get('keep_cat_features', False):
+                if col_name in new_vocab:
+                    new_categorical_cols.append(col_name)
+                continue
+            if col_name not in categorical_index:
+                continue
+            start_idx, categories, category_offsets = categorical_index[col_name]
+            kept_categories = [
+                val for val in categories if col_name + self.separator + val in new_vocab
+            ]
+            if len(kept_categories) > 0:
+                new_categorical_cols.append(col_name)
+                new_categorical_index[col_name] = self._make_index_entry(
+                    new_vocab[col_name + self.separator + kept_categories[0]], kept_categories)
+
         self.feature_names_ = new_feature_names
         self.vocabulary_ = new_vocab
         self.numerical_columns = new_numerical_cols
         self.categorical_columns = new_categorical_cols
         self.additional_numerical_cols = new_additional_numerical_cols
+        self.categorical_index = new_categorical_index
 
         self.has_been_restricted = True
         return self
+
+
+# The same CSR matrix sp.csr_matrix(values) would give us, for a 2D array with no nans. Finding the
+# nonzero values directly is much faster than going through a COO matrix.
+def dense_to_csr(values):
+    is_nonzero = values != 0
+    indptr = np.zeros(values.shape[0] + 1, dtype=np.intc)
+    np.cumsum(np.count_nonzero(is_nonzero, axis=1), out=indptr[1:])
+    indices = np.nonzero(is_nonzero)[1].astype(np.intc)
+    return sp.csr_matrix((values[is_nonzero], indices, indptr), shape=values.shape)
@@ -1,6 +1,33 @@
+import importlib
+import sys
 
 from brainless._version import __version__
-from brainless.predictor import Predictor
 from brainless.utils.models.utils_models import load_ml_model
-from brainless.algorithm.classifier import Classifier
-from brainless.algorithm.regressor import Regressor
+from brainless.utils.execution.utils_execution import configure_execution
+from brainless.utils.registry.utils_registry import ModelRegistry
+
+# Everything we need to train models (the hyperparameter search, the scorers, calibration, and so
+# on) takes a while to import, and getting predictions from a saved pipeline with load_ml_model
+# needs none of it. So these are only imported the first time someone uses them.
+lazy_attributes = {
+    'Predictor': 'brainless.predictor',
+    'Classifier': 'brainless.algorithm.classifier',
+    'Regressor': 'brainless.algorithm.regressor'
+}
+
+
+def __getattr__(name):
+    if name in lazy_attributes:
+        return getattr(importlib.import_module(lazy_attributes[name]), name)
+    raise AttributeError('module ' + repr(__name__) + ' has no attribute ' + repr(name))
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + list(lazy_attributes.keys()))
+
+
+# Modules can only define __getattr__ from python 3.7 on
+if sys.version_info < (3, 7):
+    from brainless.predictor import Predictor
+    from brainless.algorithm.classifier import Classifier
+    from brainless.algorithm.regressor import Regressor
@@ -50,6 +50,9 @@ class Predictor(object):
     def predict_intervals(self, *args, **kwargs):
         return self.model.predict_intervals(*args, **kwargs)
 
+    def compile_for_serving(self, *args, **kwargs):
+        return self.model.compile_for_serving(*args, **kwargs)
+
     def save(self, *args, **kwargs):
         return self.model.save(*args, **kwargs)
 
@@ -2,7 +2,6 @@
 import copyreg
 import datetime
 import math
-import multiprocessing
 import os
 import random
 import sys
@@ -13,10 +12,8 @@ from collections import OrderedDict
 import dill
 import numpy as np
 import pandas as pd
-import pathos
 from scipy import sparse as scipy_sparse
 # evolutionary_search uses deap
-from evolutionary_search import EvolutionaryAlgorithmSearchCV
 from six import get_method_function, get_method_self
 from sklearn.calibration import CalibratedClassifierCV
 from sklearn.metrics import accuracy_score
@@ -25,10 +22,13 @@ from sklearn.preprocessing import FunctionTransformer
 from tabulate import tabulate
 
 from brainless import DataFrameVectorizer
+from brainless import runtime
 from brainless.utils import utils
+from brainless.utils.bundle import utils_bundle
 from brainless.utils.categorical import utils_categorical_ensembling
 from brainless.utils.cleaning import utils_data_cleaning
 from brainless.utils.ensembling import utils_ensembling
+from brainless.utils.execution import utils_execution
 from brainless.utils.feature_selection import utils_feature_selection
 from brainless.utils.model_traning import utils_model_training
 from brainless.utils.models import utils_models
@@ -172,7 +172,8 @@ class PredictorBase(object):
         else:
             pipeline_list.append(('basic_transform',
                                   utils_data_cleaning.BasicDataCleaning(
-                                      column_descriptions=self.column_descriptions)))
+                                      column_descriptions=self.column_descriptions,
+                                      nlp_hashed_features=self.nlp_hashed_features)))
 
         if self.perform_feature_scaling is True:
             if trained_pipeline is not None:
@@ -464,7 +465,8 @@ class PredictorBase(object):
                                 return_transformation_pipeline=False,
                                 X_test_already_transformed=False,
                                 skip_feature_responses=None,
-                                prediction_interval_params=None):
+                                prediction_interval_params=None,
+                                nlp_hashed_features=None):
 
         self.user_input_func = user_input_func
         self.optimize_final_model = optimize_final_model
@@ -581,6 +583,13 @@ class PredictorBase(object):
         else:
             self.prediction_interval_params = prediction_interval_params
 
+        if nlp_hashed_features is not None and (isinstance(nlp_hashed_features, bool) or
+                                                int(nlp_hashed_features) <= 0):
+            raise ValueError('nlp_hashed_features must be None, or a positive number of hash '
+                             'buckets for each nlp column. You passed in: ' +
+                             str(nlp_hashed_features))
+        self.nlp_hashed_features = nlp_hashed_features
+
         if prediction_intervals is None:
             self.calculate_prediction_intervals = False
         else:
@@ -852,7 +861,8 @@ class PredictorBase(object):
               return_transformation_pipeline=False,
               X_test_already_transformed=False,
               skip_feature_responses=None,
-              prediction_interval_params=None):
+              prediction_interval_params=None,
+              nlp_hashed_features=None):
 
         self.set_params_and_defaults(
             raw_training_data,
@@ -892,7 +902,8 @@ class PredictorBase(object):
             return_transformation_pipeline=return_transformation_pipeline,
             X_test_already_transformed=X_test_already_transformed,
             skip_feature_responses=skip_feature_responses,
-            prediction_interval_params=prediction_interval_params)
+            prediction_interval_params=prediction_interval_params,
+            nlp_hashed_features=nlp_hashed_features)
 
         if verbose:
             print(
@@ -996,9 +1007,8 @@ class PredictorBase(object):
 
         uncertainty_data_transformed = self.transformation_pipeline.transform(uncertainty_data)
 
-        base_predictions = self.trained_final_model.predict(uncertainty_data_transformed)
-        base_predictions = [[val] for val in base_predictions]
-        base_predictions = np.array(base_predictions)
+        base_predictions = self.trained_final_model.predict(uncertainty_data_transformed,
+                                                            output='numpy').reshape(-1, 1)
         uncertainty_data_transformed = scipy_sparse.hstack(
             [uncertainty_data_transformed, base_predictions], format='csr')
 
@@ -1440,7 +1450,7 @@ class PredictorBase(object):
         for k, v in gs_params.items():
             total_combinations *= len(v)
 
-        n_jobs = -1
+        n_jobs = utils_execution.get_n_jobs(-1)
         population_size = 35
         tournament_size = 3
         gene_mutation_prob = 0.1
@@ -1460,8 +1470,16 @@ class PredictorBase(object):
         ]:
             n_jobs = 1
 
-        elif total_combinations >= 50:
-            n_jobs = multiprocessing.cpu_count()
+        # When the search itself runs in parallel, each model it fits gets its share of our
+        # cpu_budget, rather than every one of them trying to use every core at once
+        if n_jobs > 1:
+            candidate_models = [ppl.model]
+            if isinstance(gs_params.get('model'), list):
+                candidate_models.extend(gs_params['model'])
+            model_n_jobs = max(utils_execution.get_cpu_budget() // n_jobs, 1)
+            for candidate_model in candidate_models:
+                if 'n_jobs' in candidate_model.get_params():
+                    candidate_model.set_params(n_jobs=model_n_jobs)
 
         fit_evolutionary_search = False
         if total_combinations >= 50 and model_name not in [
@@ -1471,6 +1489,9 @@ class PredictorBase(object):
         # For some reason, EASCV doesn't play nicely with CatBoost. It blows up the memory
         # hugely, and takes forever to train.
         if fit_evolutionary_search is True:
+            # Only import this if we have to, because deap takes a while to import
+            from evolutionary_search import EvolutionaryAlgorithmSearchCV
+
             gs = EvolutionaryAlgorithmSearchCV(
                 # Fit on the pipeline.
                 ppl,
@@ -1545,6 +1566,9 @@ class PredictorBase(object):
 
         if refit is True:
             trained_final_model = gs.best_estimator_
+            # The search is over, so our final model can have the whole cpu_budget back
+            if n_jobs > 1 and 'n_jobs' in trained_final_model.model.get_params():
+                trained_final_model.model.set_params(n_jobs=utils_execution.get_n_jobs(-1))
             model_name = utils_models.get_name_from_model(trained_final_model)
             self.print_results(model_name, trained_final_model, X_df, y)
 
@@ -1738,67 +1762,38 @@ class PredictorBase(object):
 
             X_df_transformed = self.fit_transformation_pipeline(X_df, y, estimator_names)
 
-        unique_categories = X_df[categorical_column].unique()
-
-        # Iterate through categories to find:
-        # 1. index positions of that category within X_df (and thus, X_df_transformed, and y)
-
-        # 2. some sorting (either alphabetical, size of category, or ideally, sorted by magnitude
-        # of y value).
-
-        # 3. size of category would be most efficient. if we have 8 cores and 13 categories,
-        # we don't want to save the largest category for the last one, even if from an analytics
-        # perspective that's the one we would want last
-
-        # 4. create a map from category name to indexes
-
-        # 5. sort by len(indices)
-
-        # 6. iterate through that, creating a new mapping from category_name to the relevant data
-        # for that category. pull that data from X_df_transformed
-
-        # 7. map over that list to train a new predictor for each category!
-
-        categories_and_indices = []
-        for category in unique_categories:
-            indices = list(np.flatnonzero(X_df[self.categorical_column] == category))
-            categories_and_indices.append([category, indices])
+        # Find the rows that belong to each category in a single pass over the column, then train
+        # the largest categories first. If we have 8 cores and 13 categories, we don't want to save
+        # the largest category for last, with the other 7 cores sitting idle while it trains.
+        categories_and_indices = utils_categorical_ensembling.partition_rows_by_category(
+            X_df[self.categorical_column])
+        categories_and_indices.sort(key=lambda x: len(x[1]), reverse=True)
 
+        # Categories smaller than our min_category_size filter are combined together, and get a
+        # single model trained on all of their rows
         categories_and_data = []
-        all_small_categories = {'relevant_transformed_rows': [], 'relevant_y': []}
-        for pair in sorted(categories_and_indices, key=lambda x: len(x[1]), reverse=True):
-            category = pair[0]
-            indices = pair[1]
+        small_category_indices = []
+        for category, indices in categories_and_indices:
+            if len(indices) > self.min_category_size:
+                categories_and_data.append([category, indices])
+            else:
+                small_category_indices.append(indices)
 
-            relevant_transformed_rows = X_df_transformed[indices]
-            relevant_y = [y[idx_val] for idx_val in indices]
+        if sum(len(indices) for indices in small_category_indices) > self.min_category_size:
+            categories_and_data.append(
+                ['_all_small_categories', np.concatenate(small_category_indices)])
+            categories_and_data.sort(key=lambda x: len(x[1]), reverse=True)
 
-            # If this category is larger than our min_category_size filter, train a model for it
-            if len(indices) > self.min_category_size:
-                categories_and_data.append([category, relevant_transformed_rows, relevant_y])
+        # Object dtype, so that each category's y values come back out exactly as they went in
+        y_values = np.asarray(y, dtype=object)
+
+        # Only the row positions get handed to each worker. The workers are forked, so they read
+        # their rows straight out of the X_df_transformed we already have in memory, rather than us
+        # making a copy of every category's rows up front, and pickling them all over.
+        def train_one_categorical_model(category, indices):
+            relevant_X = X_df_transformed[indices]
+            relevant_y = y_values[indices].tolist()
 
-            # Otherwise, add it to our "all_small_categories" category, and train a model on all
-            # our small categories combined
-            else:
-                # Slightly complicated because we're dealing with sparse matrices
-                if isinstance(all_small_categories['relevant_transformed_rows'], list):
-                    all_small_categories['relevant_transformed_rows'] = relevant_transformed_rows
-                else:
-                    all_small_categories['relevant_transformed_rows'] = scipy_sparse.vstack(
-                        [
-                            all_small_categories['relevant_transformed_rows'],
-                            relevant_transformed_rows
-                        ],
-                        format='csr')
-                all_small_categories['relevant_y'] += relevant_y
-
-        if len(all_small_categories['relevant_y']) > self.min_category_size:
-            categories_and_data.insert(0, [
-                '_all_small_categories', all_small_categories['relevant_transformed_rows'],
-                all_small_categories['relevant_y']
-            ])
-
-        def train_one_categorical_model(category, relevant_X, relevant_y):
             print('\n\nNow training a new estimator for the category: ' + str(category))
 
             print('Some stats on the y values for this category: ' + str(category))
@@ -1837,43 +1832,21 @@ class PredictorBase(object):
             }
             return result_to_return
 
-        if os.environ.get('is_test_suite', False) == 'True':
-            # If this is the test_suite, do not run things in parallel
-            results = list(
-                map(lambda x: train_one_categorical_model(x[0], x[1], x[2]), categories_and_data))
-        else:
+        # Keras models can't be pickled back to us from a worker process, so those train one
+        # after the other
+        preferred_mode = 'processes'
+        if any(str(model_name)[:12] == 'DeepLearning' for model_name in self.model_names or []):
+            preferred_mode = 'serial'
 
-            pool = pathos.multiprocessing.ProcessPool()
-
-            # Since we may have already closed the pool, try to restart it
-            # TODO: Try to improve flow control
-            try:
-                pool.restart()
-            except AssertionError:
-                pass
+        # Only run as many categories at once as we have the memory for
+        estimated_training_bytes = utils_categorical_ensembling.estimate_training_bytes(
+            X_df_transformed, [indices for category, indices in categories_and_data])
+        max_workers = utils_execution.get_max_workers_within_memory_budget(estimated_training_bytes)
 
-            try:
-                results = list(
-                    pool.map(lambda x: train_one_categorical_model(x[0], x[1], x[2]),
-                             categories_and_data))
-            except RuntimeError:
-                # Deep Learning models require a ton of recursion. I've tried to work around it,
-                # but sometimes we just need to brute force the solution here
-                original_recursion_limit = sys.getrecursionlimit()
-                sys.setrecursionlimit(10000)
-                results = list(
-                    pool.map(lambda x: train_one_categorical_model(x[0], x[1], x[2]),
-                             categories_and_data))
-                sys.setrecursionlimit(original_recursion_limit)
-
-            # Once we have gotten all we need from the pool, close it so it's not taking up
-            # unnecessary memory
-            pool.close()
-            # TODO: Try to improve flow control
-            try:
-                pool.join()
-            except AssertionError:
-                pass
+        results = utils_execution.map_in_workers(lambda x: train_one_categorical_model(x[0], x[1]),
+                                                 categories_and_data,
+                                                 preferred_mode=preferred_mode,
+                                                 max_workers=max_workers)
 
         for result in results:
             if result['trained_category_model'] is not None:
@@ -2121,37 +2094,37 @@ class PredictorBase(object):
                 else:
                     raise e
 
-    def predict(self, prediction_data):
-        if isinstance(prediction_data, list):
-            prediction_data = pd.DataFrame(prediction_data)
-        prediction_data = prediction_data.copy()
+    # output='numpy' returns an ndarray with one prediction per row (even for a single dictionary),
+    # rather than python lists and values.
+    # prediction_data is never modified, unless copy is False. Then we're free to modify it in place
+    # rather than copying it first, which is faster if you won't be using it again.
+    def predict(self, prediction_data, output=None, copy=True):
+        predicted_values = runtime.predict(self.trained_pipeline, prediction_data, output=output,
+                                           copy=copy)
 
-        predicted_values = self.trained_pipeline.predict(prediction_data)
         if self.took_log_of_y:
-            for idx, val in predicted_values:
-                predicted_values[idx] = math.exp(val)
+            predicted_values = utils.exp_predictions(predicted_values)
 
         return predicted_values
 
-    def predict_uncertainty(self, prediction_data):
-        prediction_data = prediction_data.copy()
-
-        predicted_values = self.trained_pipeline.predict_uncertainty(prediction_data)
+    # Pre-resolves the trained pipeline into a flat plan for fast single-dictionary predictions.
+    # Call this again if you retrain.
+    def compile_for_serving(self):
+        self.trained_pipeline.compile_for_serving()
+        return self
 
-        return predicted_values
+    def predict_uncertainty(self, prediction_data):
+        return runtime.predict_uncertainty(self.trained_pipeline, prediction_data)
 
     def predict_intervals(self, prediction_data, return_type=None):
+        return runtime.predict_intervals(self.trained_pipeline, prediction_data,
+                                         return_type=return_type)
 
-        prediction_data = prediction_data.copy()
-
-        return self.trained_pipeline.predict_intervals(prediction_data, return_type=return_type)
-
-    def predict_proba(self, prediction_data):
-        if isinstance(prediction_data, list):
-            prediction_data = pd.DataFrame(prediction_data)
-        prediction_data = prediction_data.copy()
-
-        return self.trained_pipeline.predict_proba(prediction_data)
+    # output='numpy' returns a 2D ndarray of shape (n_rows, n_classes), even for a single
+    # dictionary. copy works just like it does for predict.
+    def predict_proba(self, prediction_data, output=None, copy=True):
+        return runtime.predict_proba(self.trained_pipeline, prediction_data, output=output,
+                                     copy=copy)
 
     def score(self, X_test, y_test, advanced_scoring=True, verbose=2):
 
@@ -2189,66 +2162,33 @@ class PredictorBase(object):
         else:
             return self.trained_pipeline.score(X_test, y_test)
 
-    # TODO: Simplify
+    # Labels each row as uncertain (1) or not (0), by how far its base prediction is from y, for
+    # all the rows at once
     def define_uncertain_predictions(self, base_predictions, y):
-        if not (isinstance(base_predictions[0], float) or isinstance(base_predictions[0], int)):
-            base_predictions = [row[0] for row in base_predictions]
-
-        base_predictions = list(base_predictions)
-
-        is_uncertain_predictions = []
-
-        for idx, y_val in enumerate(y):
-
-            base_prediction_for_row = base_predictions[idx]
-            delta = base_prediction_for_row - y_val
-
-            if self.uncertainty_delta_units == 'absolute':
-                if self.uncertainty_delta_direction == 'both':
-                    if abs(delta) > self.uncertainty_delta:
-                        is_uncertain_predictions.append(1)
-                    else:
-                        is_uncertain_predictions.append(0)
-
-                else:
-                    # This is now the case of single-directional deltas (we only care if our
-                    # predictions are higher, not lower, or lower and not higher)
-                    if self.uncertainty_delta > 0:
-                        if delta > self.uncertainty_delta:
-                            is_uncertain_predictions.append(1)
-                        else:
-                            is_uncertain_predictions.append(0)
-                    else:
-                        # This is the case where we have directional deltas, and the
-                        # uncertainty_delta < 0
-                        if delta < self.uncertainty_delta:
-                            is_uncertain_predictions.append(1)
-                        else:
-                            is_uncertain_predictions.append(0)
-
-            elif self.uncertainty_delta_units == 'percentage':
-                if self.uncertainty_delta_direction == 'both':
-                    if abs(delta) / y_val > self.uncertainty_delta:
-                        is_uncertain_predictions.append(1)
-                    else:
-                        is_uncertain_predictions.append(0)
-                else:
-                    # This is now the case of single-directional deltas (we only care if our
-                    # predictions are higher, not lower, or lower and not higher)
-                    if self.uncertainty_delta > 0:
-                        if delta / y_val > self.uncertainty_delta:
-                            is_uncertain_predictions.append(1)
-                        else:
-                            is_uncertain_predictions.append(0)
-                    else:
-                        # This is the case where we have directional deltas, and the
-                        # uncertainty_delta < 0
-                        if delta / y_val < self.uncertainty_delta:
-                            is_uncertain_predictions.append(1)
-                        else:
-                            is_uncertain_predictions.append(0)
+        # base_predictions might be a column vector, with a single value in each row
+        base_predictions = np.asarray(base_predictions, dtype=np.float64).reshape(-1)
+        y = np.asarray(y, dtype=np.float64)
+        deltas = base_predictions - y
+
+        if self.uncertainty_delta_units == 'absolute':
+            divisors = 1
+        elif self.uncertainty_delta_units == 'percentage':
+            divisors = y
+        else:
+            return []
+
+        # A y value of 0 gives us an infinite percentage delta, which is certainly uncertain
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if self.uncertainty_delta_direction == 'both':
+                is_uncertain_predictions = np.abs(deltas) / divisors > self.uncertainty_delta
+            # This is now the case of single-directional deltas (we only care if our predictions
+            # are higher, not lower, or lower and not higher)
+            elif self.uncertainty_delta > 0:
+                is_uncertain_predictions = deltas / divisors > self.uncertainty_delta
+            else:
+                is_uncertain_predictions = deltas / divisors < self.uncertainty_delta
 
-        return is_uncertain_predictions
+        return is_uncertain_predictions.astype(int).tolist()
 
     def score_uncertainty(self, X, y):
 
@@ -2265,7 +2205,15 @@ class PredictorBase(object):
         return self.transformation_pipeline.transform(X)
 
     # TODO: Simplify
-    def save(self, file_name='auto_ml_saved_pipeline.dill', verbose=True):
+    # bundle_format: 'zip' (the default) saves a single file, and 'directory' saves the same
+    # bundle as a directory. See utils_bundle for what's inside. 'dill' saves the whole pipeline
+    # as a single dill file, like older versions of brainless did.
+    def save(self, file_name=None, verbose=True, bundle_format='zip'):
+        if bundle_format not in utils_bundle.bundle_formats:
+            raise ValueError('bundle_format must be one of ' + str(utils_bundle.bundle_formats) +
+                             ', but we received ' + str(bundle_format))
+        if file_name is None:
+            file_name = utils_bundle.get_default_file_name(bundle_format)
 
         make_feature_importances = True
         try:
@@ -2290,6 +2238,50 @@ class PredictorBase(object):
 
             self.trained_pipeline.feature_importances_ = importances_dict
 
+        with utils_bundle.training_state_removed(self.trained_pipeline):
+            if bundle_format == 'dill':
+                num_deep_learning_models = self._save_dill_blob(file_name)
+            else:
+                manifest = utils_bundle.save_bundle(self.trained_pipeline, file_name,
+                                                    bundle_format=bundle_format)
+                num_deep_learning_models = len(manifest['keras_models'])
+
+        if verbose:
+            print('\n\nWe have saved the trained pipeline to a filed called "' + file_name + '"')
+            print('It is saved in the directory: ')
+            print(os.getcwd())
+            print('To use it to get predictions, please follow the following flow (adjusting for '
+                  'your own uses as necessary:\n\n ')
+            print('`from brainless.utils_models import load_ml_model')
+            print('`trained_ml_pipeline = load_ml_model("' + file_name + '")')
+            print('`trained_ml_pipeline.predict(data)`\n\n')
+
+            # Bundles hold their deep learning models inside them
+            if num_deep_learning_models > 0 and bundle_format == 'dill':
+                print('While saving the trained_ml_pipeline, we found a number of deep learning '
+                      'models that we saved separately. ')
+                print('Make sure to transfer these files to whichever environment you plan to load '
+                      'the trained pipeline in ')
+                print('Specifically, we saved ' + str(num_deep_learning_models) +
+                      ' deep learning models to separate files')
+
+            print('Note that this pickle/dill file can only be loaded in an environment with the '
+                  'same modules installed, and running the same Python version. ')
+            print('This version of Python is:')
+            print(sys.version_info)
+
+            print('\n\nWhen passing in new data to get predictions on, columns that were not '
+                  'present (or were not found to be useful) in the training data will be silently '
+                  'ignored. ')
+            print('It is worthwhile to make sure that you feed in all the most useful data points '
+                  'though, to make sure you can get the highest quality predictions. ')
+
+        return os.path.join(os.getcwd(), file_name)
+
+    # Saves the whole trained pipeline with dill, and any Keras models it holds to separate .h5
+    # files next to it. Returns the number of Keras models we saved.
+    def _save_dill_blob(self, file_name):
+
         def save_one_step(pipeline_step, used_deep_learning):
             # TODO: Try to improve flow control
             try:
@@ -2393,36 +2385,7 @@ class PredictorBase(object):
                     except AttributeError:
                         pass
 
-        if verbose:
-            print('\n\nWe have saved the trained pipeline to a filed called "' + file_name + '"')
-            print('It is saved in the directory: ')
-            print(os.getcwd())
-            print('To use it to get predictions, please follow the following flow (adjusting for '
-                  'your own uses as necessary:\n\n ')
-            print('`from brainless.utils_models import load_ml_model')
-            print('`trained_ml_pipeline = load_ml_model("' + file_name + '")')
-            print('`trained_ml_pipeline.predict(data)`\n\n')
-
-            if used_deep_learning is True:
-                print('While saving the trained_ml_pipeline, we found a number of deep learning '
-                      'models that we saved separately. ')
-                print('Make sure to transfer these files to whichever environment you plan to load '
-                      'the trained pipeline in ')
-                print('Specifically, we saved ' + str(len(model_name_map.keys())) +
-                      ' deep learning models to separate files')
-
-            print('Note that this pickle/dill file can only be loaded in an environment with the '
-                  'same modules installed, and running the same Python version. ')
-            print('This version of Python is:')
-            print(sys.version_info)
-
-            print('\n\nWhen passing in new data to get predictions on, columns that were not '
-                  'present (or were not found to be useful) in the training data will be silently '
-                  'ignored. ')
-            print('It is worthwhile to make sure that you feed in all the most useful data points '
-                  'though, to make sure you can get the highest quality predictions. ')
-
-        return os.path.join(os.getcwd(), file_name)
+        return len(model_name_map.keys())
 
     def _train_ensemble(self, X_train, y_train):
 
@@ -0,0 +1,65 @@
+import pandas as pd
+
+from brainless.utils import utils
+from brainless.utils.models.utils_models import load_ml_model
+from brainless.utils.registry.utils_registry import ModelRegistry
+
+# A slim entry point for getting predictions from saved pipelines in production:
+#
+#   from brainless import runtime
+#   trained_pipeline = runtime.load_ml_model('my_saved_pipeline')
+#   runtime.predict(trained_pipeline, data)
+#
+# Processes that serve many saved pipelines can keep them loaded in a ModelRegistry instead:
+#
+#   registry = runtime.ModelRegistry(max_bytes=4 * 1024 ** 3)
+#   runtime.predict(registry.get('my_saved_pipeline'), data)
+#
+# This only imports what we need to get predictions. Training (PredictorBase, the hyperparameter
+# searches and deap, the scorers and tabulate, the analytics) is never imported, so scoring
+# processes start quickly and stay small. Saved pipelines don't carry any of the state that only
+# training needs either (see utils_bundle.training_only_attributes).
+# Each function takes the same arguments as the Predictor method of the same name.
+
+
+def validate_prediction_output(output):
+    if output not in utils.prediction_outputs:
+        raise ValueError('output must be one of ' + str(utils.prediction_outputs) +
+                         ', but we received ' + str(output))
+
+
+# output and copy are only passed on to the trained pipeline when they're set, so that pipelines
+# that don't know about them keep working
+def get_prediction_kwargs(prediction_data, output=None, copy=True):
+    validate_prediction_output(output)
+    prediction_kwargs = {}
+    if output is not None:
+        prediction_kwargs['output'] = output
+    # A list of dictionaries becomes a DataFrame that nobody else has a reference to
+    if not copy or isinstance(prediction_data, list):
+        prediction_kwargs['copy'] = False
+    return prediction_kwargs
+
+
+def predict(trained_pipeline, prediction_data, output=None, copy=True):
+    prediction_kwargs = get_prediction_kwargs(prediction_data, output, copy)
+    if isinstance(prediction_data, list):
+        prediction_data = pd.DataFrame(prediction_data)
+
+    return trained_pipeline.predict(prediction_data, **prediction_kwargs)
+
+
+def predict_proba(trained_pipeline, prediction_data, output=None, copy=True):
+    prediction_kwargs = get_prediction_kwargs(prediction_data, output, copy)
+    if isinstance(prediction_data, list):
+        prediction_data = pd.DataFrame(prediction_data)
+
+    return trained_pipeline.predict_proba(prediction_data, **prediction_kwargs)
+
+
+def predict_intervals(trained_pipeline, prediction_data, return_type=None):
+    return trained_pipeline.predict_intervals(prediction_data, return_type=return_type)
+
+
+def predict_uncertainty(trained_pipeline, prediction_data):
+    return trained_pipeline.predict_uncertainty(prediction_data)
@@ -0,0 +1,551 @@
+import ast
+import contextlib
+import datetime
+import json
+import os
+import pickle
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import zipfile
+
+import dill
+import numpy as np
+
+from brainless._version import __version__
+from brainless.utils.categorical import utils_categorical_ensembling
+
+# A bundle is a saved pipeline, split up into a directory (or an uncompressed zip file of that
+# directory) that looks like:
+#   manifest.json      what's in the bundle, and which versions of everything wrote it
+#   pipeline.pkl       the pipeline itself, minus everything below
+#   arrays/<n>.npy     large numpy arrays (tree nodes, coefficients, idf vectors, etc.), and
+#                      large vocabularies as a pair of arrays
+#   models/<n>.pkl     sub-models (per-category models, interval predictors, uncertainty models),
+#                      which are only unpickled the first time they're used
+#   keras/<n>.h5       deep learning models
+# Unpickling a single dill blob means holding all of its bytes in memory on top of the objects
+# built from them, and rebuilding every model up front, even ones that never get used.
+
+bundle_formats = ['zip', 'directory', 'dill']
+# What save() names the file when it isn't given a name. Only dill files can be read with
+# dill.load, so only they end in .dill.
+default_file_names = {
+    'zip': 'auto_ml_saved_pipeline.brainless',
+    'directory': 'auto_ml_saved_pipeline',
+    'dill': 'auto_ml_saved_pipeline.dill'
+}
+bundle_format_name = 'brainless_bundle'
+bundle_format_version = 1
+manifest_name = 'manifest.json'
+pipeline_member_name = 'pipeline.pkl'
+
+# Anything smaller than this stays inside the pickle it came from
+min_separate_array_bytes = 64 * 1024
+min_separate_vocabulary_size = 10000
+
+# Writing through a map would change the saved bundle, so we don't allow it
+mmap_modes = [None, 'r', 'c']
+
+# Arrays inside a zip bundle start on a multiple of this, so they line up just like they would
+# if they were read out of their own .npy file
+zip_array_alignment = 64
+zip_padding_header_id = 0xD935
+
+# What FinalModelATC only needs during training, and never saves (see training_state_removed)
+training_only_attributes = ['_scorer', 'X_test', 'y_test']
+
+
+# The models that only some predictions need, and that can be saved separately and loaded lazily.
+# We are not sure what all of these models look like (Keras, Predictors, etc.), so we only rely on
+# the properties our own models have.
+def get_lazy_sub_models(trained_pipeline):
+    sub_models = []
+    for final_model in get_final_models(trained_pipeline):
+        for interval_predictor in getattr(final_model, 'interval_predictors', None) or []:
+            sub_models.append(interval_predictor[1])
+        uncertainty_model = get_uncertainty_model(final_model)
+        if uncertainty_model is not None:
+            sub_models.append(uncertainty_model)
+
+    if isinstance(trained_pipeline, utils_categorical_ensembling.CategoricalEnsembler):
+        sub_models.extend(trained_pipeline.trained_models.values())
+    return sub_models
+
+
+# uncertainty_model is a bool on models that weren't trained with one (including the uncertainty
+# model itself, and models whose uncertainty training gave up)
+def get_uncertainty_model(final_model):
+    uncertainty_model = getattr(final_model, 'uncertainty_model', None)
+    if uncertainty_model is None or isinstance(uncertainty_model, bool):
+        return None
+    return uncertainty_model
+
+
+def get_final_models(trained_pipeline):
+    if isinstance(trained_pipeline, utils_categorical_ensembling.CategoricalEnsembler):
+        return list(trained_pipeline.trained_models.values())
+
+    try:
+        final_model = trained_pipeline.named_steps['final_model']
+    except (AttributeError, KeyError):
+        return []
+
+    final_models = [final_model]
+    for ensemble_predictor in getattr(final_model, 'ensemble_predictors', None) or []:
+        final_models.append(ensemble_predictor)
+    return final_models
+
+
+# Every FinalModelATC in the pipeline, including the ones that live inside other FinalModelATCs
+# (interval predictors, uncertainty models, and the members of an ensemble)
+def get_all_final_models(trained_pipeline):
+    all_final_models = []
+    final_models_to_visit = get_final_models(trained_pipeline)
+    while len(final_models_to_visit) > 0:
+        final_model = final_models_to_visit.pop()
+        if any(final_model is seen_final_model for seen_final_model in all_final_models):
+            continue
+        all_final_models.append(final_model)
+
+        for interval_predictor in getattr(final_model, 'interval_predictors', None) or []:
+            final_models_to_visit.append(interval_predictor[1])
+        uncertainty_model = get_uncertainty_model(final_model)
+        if uncertainty_model is not None:
+            final_models_to_visit.append(uncertainty_model)
+        final_models_to_visit.extend(getattr(final_model, 'ensemble_predictors', None) or [])
+    return all_final_models
+
+
+# Leaves the state our FinalModelATCs only need while they are training (the holdout data, and
+# the scorer that scores it) out of whatever gets saved inside this block. Getting predictions
+# never touches it, and the scorer would drag our scoring code into every process that loads the
+# pipeline. Everything is put back once we're done saving.
+@contextlib.contextmanager
+def training_state_removed(trained_pipeline):
+    removed_state = []
+    for final_model in get_all_final_models(trained_pipeline):
+        for attribute_name in training_only_attributes:
+            if getattr(final_model, attribute_name, None) is not None:
+                removed_state.append(
+                    (final_model, attribute_name, getattr(final_model, attribute_name)))
+                setattr(final_model, attribute_name, None)
+    try:
+        yield
+    finally:
+        for final_model, attribute_name, value in removed_state:
+            setattr(final_model, attribute_name, value)
+
+
+def get_keras_models(trained_pipeline):
+    keras_models = []
+    for final_model in get_final_models(trained_pipeline):
+        if (getattr(final_model, 'model_name', None) or '')[:12] == 'DeepLearning':
+            keras_models.append(final_model.model)
+    return keras_models
+
+
+# Vocabularies (from our DataFrameVectorizer, or sklearn's text vectorizers) are dictionaries of
+# strings to their column index, which we can store as two arrays
+def is_vocabulary(obj):
+    if type(obj) is not dict or len(obj) < min_separate_vocabulary_size:
+        return False
+    # numpy strings drop any trailing null characters
+    return all(type(key) is str and not key.endswith('\x00') for key in obj) and all(
+        isinstance(val, (int, np.integer)) and not isinstance(val, bool) for val in obj.values())
+
+
+def is_separate_array(obj):
+    return type(obj) in (np.ndarray, np.memmap) and not obj.dtype.hasobject and \
+        obj.nbytes >= min_separate_array_bytes
+
+
+class BundlePickler(dill.Pickler):
+
+    def __init__(self, file, bundle_writer, root_obj):
+        super(BundlePickler, self).__init__(file)
+        self.bundle_writer = bundle_writer
+        self.root_obj = root_obj
+
+    def persistent_id(self, obj):
+        # Whatever we were asked to pickle goes in this pickle, even if it's a sub-model
+        if obj is self.root_obj:
+            return None
+        return self.bundle_writer.get_persistent_id(obj)
+
+
+class BundleUnpickler(dill.Unpickler):
+
+    def __init__(self, file, bundle_reader):
+        super(BundleUnpickler, self).__init__(file)
+        self.bundle_reader = bundle_reader
+
+    def persistent_load(self, pid):
+        return self.bundle_reader.load_persistent_id(pid)
+
+
+class BundleWriter(object):
+
+    def __init__(self, file_name, bundle_format='zip'):
+        if bundle_format not in ['zip', 'directory']:
+            raise ValueError('bundle_format must be one of ' + str(bundle_formats) +
+                             ', but we received ' + str(bundle_format))
+        self.file_name = file_name
+        self.bundle_format = bundle_format
+
+        self.manifest = {
+            'format': bundle_format_name,
+            'format_version': bundle_format_version,
+            'brainless_version': __version__,
+            'python_version': '.'.join([str(val) for val in sys.version_info[:3]]),
+            'numpy_version': np.__version__,
+            'created_at': datetime.datetime.now().isoformat(),
+            'pipeline': pipeline_member_name,
+            'arrays': {},
+            'sub_models': {},
+            'keras_models': []
+        }
+
+        # Keyed by id(obj). We hold onto every obj, so that its id can't be reused while we save.
+        self.persistent_ids = {}
+        self.saved_objs = []
+        self.sub_model_ids = set()
+        self.keras_model_ids = set()
+
+    def write(self, trained_pipeline):
+        self.sub_model_ids = set(id(model) for model in get_lazy_sub_models(trained_pipeline))
+        self.keras_model_ids = set(id(model) for model in get_keras_models(trained_pipeline))
+        self.manifest['pipeline_type'] = type(trained_pipeline).__name__
+
+        if self.bundle_format == 'zip':
+            # Write everything to a temporary file first, so that a failed save never leaves a
+            # half-written bundle where a working one used to be
+            temp_file_name = self.file_name + '.tmp'
+            self.zip_file = zipfile.ZipFile(temp_file_name, 'w', compression=zipfile.ZIP_STORED,
+                                            allowZip64=True)
+            try:
+                try:
+                    self.write_pickle(trained_pipeline, pipeline_member_name)
+                    self.zip_file.writestr(manifest_name, json.dumps(self.manifest, indent=2))
+                finally:
+                    self.zip_file.close()
+                os.replace(temp_file_name, self.file_name)
+            except BaseException:
+                if os.path.exists(temp_file_name):
+                    os.remove(temp_file_name)
+                raise
+        else:
+            for dir_name in ['arrays', 'models', 'keras']:
+                os.makedirs(os.path.join(self.file_name, dir_name), exist_ok=True)
+            self.write_pickle(trained_pipeline, pipeline_member_name)
+            with open(os.path.join(self.file_name, manifest_name), 'w') as manifest_file:
+                json.dump(self.manifest, manifest_file, indent=2)
+
+        return self.manifest
+
+    def get_persistent_id(self, obj):
+        obj_id = id(obj)
+        if obj_id in self.persistent_ids:
+            return self.persistent_ids[obj_id]
+
+        if is_separate_array(obj):
+            pid = ('array', self.write_array(obj))
+        elif is_vocabulary(obj):
+            keys = np.array(list(obj.keys()), dtype=np.str_)
+            values = np.fromiter(obj.values(), dtype=np.int64, count=len(obj))
+            pid = ('vocabulary', self.write_array(keys), self.write_array(values))
+        elif obj_id in self.sub_model_ids:
+            member_name = 'models/' + str(len(self.manifest['sub_models'])) + '.pkl'
+            self.manifest['sub_models'][member_name] = {'type': type(obj).__name__}
+            self.write_pickle(obj, member_name)
+            pid = ('sub_model', member_name)
+        elif obj_id in self.keras_model_ids:
+            pid = ('keras_model', self.write_keras_model(obj))
+        else:
+            return None
+
+        self.persistent_ids[obj_id] = pid
+        self.saved_objs.append(obj)
+        return pid
+
+    def write_pickle(self, obj, member_name):
+        if self.bundle_format == 'directory':
+            with open(os.path.join(self.file_name, member_name), 'wb') as member_file:
+                BundlePickler(member_file, self, obj).dump(obj)
+            return
+
+        # Arrays and sub-models get written to the zip file while we're still pickling, and a zip
+        # file can only have one member open for writing at a time
+        with tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024) as pickle_file:
+            BundlePickler(pickle_file, self, obj).dump(obj)
+            pickle_file.seek(0)
+            # Pickles can be larger than 2GB, which we only find out after writing them
+            with self.zip_file.open(member_name, 'w', force_zip64=True) as member_file:
+                shutil.copyfileobj(pickle_file, member_file, 1024 * 1024)
+
+    def write_array(self, array):
+        member_name = 'arrays/' + str(len(self.manifest['arrays'])) + '.npy'
+        self.manifest['arrays'][member_name] = {
+            'dtype': np.lib.format.dtype_to_descr(array.dtype),
+            'shape': list(array.shape),
+            'nbytes': int(array.nbytes)
+        }
+
+        if self.bundle_format == 'directory':
+            with open(os.path.join(self.file_name, member_name), 'wb') as array_file:
+                np.lib.format.write_array(array_file, array, allow_pickle=False)
+            return member_name
+
+        # The .npy header is always padded out to a multiple of 64 bytes, so lining up the start
+        # of the member lines up the array's data too
+        zip_info = zipfile.ZipInfo(member_name, date_time=(1980, 1, 1, 0, 0, 0))
+        zip_info.compress_type = zipfile.ZIP_STORED
+        zip_info.file_size = array.nbytes + 65536
+        # zipfile makes the same decision when it writes the header
+        zip64 = zip_info.file_size * 1.05 > zipfile.ZIP64_LIMIT
+        zip_info.extra = get_zip_alignment_padding(self.zip_file.start_dir, member_name, zip64)
+        with self.zip_file.open(zip_info, 'w', force_zip64=zip64) as array_file:
+            np.lib.format.write_array(array_file, array, allow_pickle=False)
+        return member_name
+
+    def write_keras_model(self, keras_model):
+        member_name = 'keras/' + str(len(self.manifest['keras_models'])) + '.h5'
+        self.manifest['keras_models'].append(member_name)
+
+        if self.bundle_format == 'directory':
+            save_keras_model(keras_model, os.path.join(self.file_name, member_name))
+            return member_name
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            temp_file_name = os.path.join(temp_dir, 'keras_deep_learning_model.h5')
+            save_keras_model(keras_model, temp_file_name)
+            self.zip_file.write(temp_file_name, member_name)
+        finally:
+            # Keras may not have gotten as far as writing the file
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        return member_name
+
+
+# mmap_mode='r' memory maps every array in the bundle (read-only), rather than reading it into
+# memory. Every process that loads the same bundle this way shares a single copy of those arrays
+# in the OS's page cache. mmap_mode='c' maps them copy-on-write instead, for code that needs to
+# write to them. Saving over a bundle replaces the file, so arrays that are already mapped keep
+# pointing at the old one.
+class BundleReader(object):
+
+    def __init__(self, file_name, mmap_mode=None):
+        if mmap_mode not in mmap_modes:
+            raise ValueError('mmap_mode must be one of ' + str(mmap_modes) +
+                             ', but we received ' + str(mmap_mode))
+        self.file_name = file_name
+        self.mmap_mode = mmap_mode
+        if os.path.isdir(file_name):
+            self.zip_file = None
+        else:
+            self.zip_file = zipfile.ZipFile(file_name, 'r')
+
+        with self.open_member(manifest_name) as manifest_file:
+            self.manifest = json.loads(manifest_file.read().decode('utf-8'))
+        if self.manifest.get('format') != bundle_format_name:
+            raise ValueError(str(file_name) + ' is not a saved brainless bundle')
+        if self.manifest.get('format_version', 0) > bundle_format_version:
+            raise ValueError(
+                str(file_name) + ' was saved with a newer bundle format (version ' +
+                str(self.manifest.get('format_version')) + ', by brainless ' +
+                str(self.manifest.get('brainless_version')) + ') than this version of brainless ('
+                + __version__ + ') can load. Please upgrade brainless to load it.')
+
+        # Arrays and sub-models are shared between everything that references them
+        self.loaded_objs = {}
+        self.lock = threading.RLock()
+
+    def load(self):
+        return self.load_pickle(self.manifest['pipeline'])
+
+    def open_member(self, member_name):
+        if self.zip_file is None:
+            return open(os.path.join(self.file_name, member_name), 'rb')
+        return self.zip_file.open(member_name, 'r')
+
+    def load_pickle(self, member_name):
+        with self.open_member(member_name) as member_file:
+            return BundleUnpickler(member_file, self).load()
+
+    # How many bytes this member takes up in the bundle
+    def get_member_size(self, member_name):
+        if self.zip_file is None:
+            return os.path.getsize(os.path.join(self.file_name, member_name))
+        return self.zip_file.getinfo(member_name).file_size
+
+    def load_persistent_id(self, pid):
+        with self.lock:
+            if pid in self.loaded_objs:
+                return self.loaded_objs[pid]
+
+            if pid[0] == 'array':
+                obj = self.load_array(pid[1])
+            elif pid[0] == 'vocabulary':
+                keys = self.load_array(pid[1]).tolist()
+                values = self.load_array(pid[2]).tolist()
+                obj = dict(zip(keys, values))
+            elif pid[0] == 'sub_model':
+                obj = LazyModel(self, pid[1])
+            elif pid[0] == 'keras_model':
+                obj = self.load_keras_model(pid[1])
+            else:
+                raise pickle.UnpicklingError('We do not know how to load ' + str(pid) +
+                                             ' from this bundle')
+
+            self.loaded_objs[pid] = obj
+            return obj
+
+    # Maps the array, or reads its bytes straight into place. np.load would parse the header more
+    # slowly, and check the zip file's CRC as it goes.
+    def load_array(self, member_name):
+        array_location = self.get_array_location(member_name)
+        if array_location is None:
+            with self.open_member(member_name) as array_file:
+                return np.lib.format.read_array(array_file, allow_pickle=False)
+
+        file_name, data_offset, dtype, shape, fortran_order = array_location
+        if self.mmap_mode is not None:
+            array = np.memmap(file_name, dtype=dtype, mode=self.mmap_mode, offset=data_offset,
+                              shape=shape, order='F' if fortran_order else 'C')
+            # Everything that uses the array gets a plain ndarray, still backed by the map
+            return array.view(np.ndarray)
+
+        if fortran_order:
+            array = np.empty(shape[::-1], dtype=dtype)
+        else:
+            array = np.empty(shape, dtype=dtype)
+        with open(file_name, 'rb') as array_file:
+            array_file.seek(data_offset)
+            array_file.readinto(memoryview(array.reshape(-1).view(np.uint8)))
+
+        if fortran_order:
+            return array.T
+        return array
+
+    # Where the data for this .npy member starts, in which file, and what it looks like. Returns
+    # None if the member was compressed (if someone re-zipped the bundle, say), and can only be
+    # read through zipfile.
+    def get_array_location(self, member_name):
+        if self.zip_file is None:
+            file_name = os.path.join(self.file_name, member_name)
+            member_offset = 0
+        else:
+            zip_info = self.zip_file.getinfo(member_name)
+            if zip_info.compress_type != zipfile.ZIP_STORED:
+                return None
+            file_name = self.file_name
+            with open(file_name, 'rb') as bundle_file:
+                bundle_file.seek(zip_info.header_offset)
+                local_header = bundle_file.read(zipfile.sizeFileHeader)
+            name_length, extra_length = struct.unpack('<HH', local_header[-4:])
+            member_offset = zip_info.header_offset + zipfile.sizeFileHeader + name_length + \
+                extra_length
+
+        with open(file_name, 'rb') as array_file:
+            array_file.seek(member_offset)
+            magic = array_file.read(8)
+            if magic[6] == 1:
+                header_length = struct.unpack('<H', array_file.read(2))[0]
+                header_start = 10
+            else:
+                header_length = struct.unpack('<I', array_file.read(4))[0]
+                header_start = 12
+            header = ast.literal_eval(array_file.read(header_length).decode('latin1'))
+
+        return (file_name, member_offset + header_start + header_length,
+                np.lib.format.descr_to_dtype(header['descr']), header['shape'],
+                header['fortran_order'])
+
+    def load_keras_model(self, member_name):
+        from brainless.utils.models import utils_models
+
+        if self.zip_file is None:
+            return utils_models.keras_load_model(os.path.join(self.file_name, member_name))
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            temp_file_name = self.zip_file.extract(member_name, temp_dir)
+            keras_model = utils_models.keras_load_model(temp_file_name)
+            os.remove(temp_file_name)
+        finally:
+            for dir_path, _, _ in sorted(os.walk(temp_dir), reverse=True):
+                os.rmdir(dir_path)
+        return keras_model
+
+
+# Stands in for a sub-model in a loaded bundle, and unpickles it the first time anything on it is
+# used. Pickling (or copying) a LazyModel gives you the model itself.
+class LazyModel(object):
+
+    def __init__(self, bundle_reader, member_name):
+        self._lazy_bundle_reader = bundle_reader
+        self._lazy_member_name = member_name
+        self._lazy_model = None
+        self._lazy_lock = threading.Lock()
+
+    def load(self):
+        if self._lazy_model is None:
+            with self._lazy_lock:
+                if self._lazy_model is None:
+                    self._lazy_model = self._lazy_bundle_reader.load_pickle(
+                        self._lazy_member_name)
+        return self._lazy_model
+
+    def is_loaded(self):
+        return self._lazy_model is not None
+
+    def __getattr__(self, name):
+        # Only called for attributes we don't have ourselves. Our own attributes are missing while
+        # copy and pickle are building a LazyModel without calling __init__.
+        if name.startswith('_lazy_'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __reduce_ex__(self, protocol):
+        return self.load().__reduce_ex__(protocol)
+
+
+def get_default_file_name(bundle_format='zip'):
+    return default_file_names[bundle_format]
+
+
+def save_bundle(trained_pipeline, file_name, bundle_format='zip'):
+    return BundleWriter(file_name, bundle_format=bundle_format).write(trained_pipeline)
+
+
+def load_bundle(file_name, mmap_mode=None):
+    return BundleReader(file_name, mmap_mode=mmap_mode).load()
+
+
+def is_bundle(file_name):
+    if os.path.isdir(file_name):
+        return os.path.isfile(os.path.join(file_name, manifest_name))
+    if not zipfile.is_zipfile(file_name):
+        return False
+    with zipfile.ZipFile(file_name, 'r') as zip_file:
+        return manifest_name in zip_file.namelist()
+
+
+def save_keras_model(keras_model, file_name):
+    try:
+        keras_model.save(file_name)
+    except AttributeError:
+        # Same as PredictorBase.save, sometimes the Keras model is inside the sklearn wrapper
+        keras_model.model.save(file_name)
+
+
+# A zip extra field, sized so that a member written at header_offset has its data start on a
+# multiple of zip_array_alignment
+def get_zip_alignment_padding(header_offset, member_name, zip64):
+    header_size = zipfile.sizeFileHeader + len(member_name.encode('ascii')) + 4
+    if zip64:
+        header_size += 20
+    padding_size = -(header_offset + header_size) % zip_array_alignment
+    return struct.pack('<HH', zip_padding_header_id, padding_size) + b'\x00' * padding_size
@@ -1,3 +1,6 @@
+import functools
+
+import numpy as np
 import pandas as pd
 
 
@@ -17,37 +20,90 @@ class CategoricalEnsembler(object):
         except AttributeError:
             return default
 
-    def predict(self, data):
-        # For now, we are assuming that data is a list of dictionaries, so if we have a single
-        # dict, put it in a list
-        if isinstance(data, dict):
-            data = [data]
+    # All of our category models share a single transformation_pipeline, so that is the only
+    # thing that needs compiling
+    def compile_for_serving(self):
+        self.transformation_pipeline.compile_for_serving()
+        return self
+
+    # Finds the key of the trained model for this category, falling back on our default_category
+    # for categories we did not see during training
+    def get_model_key(self, category):
+        if str(category) == 'nan':
+            category = 'nan'
+        if category in self.trained_models:
+            return category
+        if self.default_category == '_RAISE_ERROR':
+            raise KeyError(category)
+        return self.default_category
+
+    # Transforms the whole frame at once, then hands each category's model all of its rows in a
+    # single call, rather than running the pipeline and a model once for every row.
+    # Returns a list of predictions (or an ndarray, if output is 'numpy'), in the same order as the
+    # rows of df.
+    # With copy=False, df may be modified in place rather than copied.
+    def get_batch_predictions(self, df, method_name, output=None, copy=True):
+        num_rows = df.shape[0]
+
+        # pd.factorize gives missing values a code of -1, which lands on the last slot of
+        # model_idx_by_code
+        codes, unique_categories = pd.factorize(df[self.categorical_column])
+        row_categories = list(unique_categories)
+        if (codes == -1).any():
+            row_categories.append('nan')
+
+        model_keys = []
+        model_idx_by_key = {}
+        model_idx_by_code = []
+        for category in row_categories:
+            model_key = self.get_model_key(category)
+            if model_key not in model_idx_by_key:
+                model_idx_by_key[model_key] = len(model_keys)
+                model_keys.append(model_key)
+            model_idx_by_code.append(model_idx_by_key[model_key])
+
+        row_model_idxs = np.array(model_idx_by_code, dtype=np.int64)[codes]
+
+        # A stable sort groups the rows by model, while keeping each group in its original order
+        row_order = np.argsort(row_model_idxs, kind='stable')
+        group_model_idxs, group_starts = np.unique(row_model_idxs[row_order], return_index=True)
+        group_ends = list(group_starts[1:]) + [num_rows]
+
+        transformed_df = self.transformation_pipeline.transform(df, copy=copy)
+
+        if output == 'numpy':
+            group_results = []
+        else:
+            predictions = [None] * num_rows
+        for model_idx, group_start, group_end in zip(group_model_idxs, group_starts, group_ends):
+            group_rows = row_order[group_start:group_end]
+            model = self.trained_models[model_keys[model_idx]]
+            group_predictions = getattr(model, method_name)(transformed_df[group_rows],
+                                                            output=output)
 
-        if isinstance(data, pd.DataFrame):
-            data = data.to_dict('records')
+            if output == 'numpy':
+                group_results.append([group_rows, group_predictions])
+                continue
 
-        predictions = []
-        for row in data:
-            category = row[self.categorical_column]
-            if str(category) == 'nan':
-                category = 'nan'
-            try:
-                model = self.trained_models[category]
-            except KeyError as e:
-                if self.default_category == '_RAISE_ERROR':
-                    raise e
-                model = self.trained_models[self.default_category]
-
-            transformed_row = self.transformation_pipeline.transform(row)
-            prediction = model.predict(transformed_row)
-            predictions.append(prediction)
+            # Our models hand back a single prediction, rather than a list, for a single row
+            if len(group_rows) == 1:
+                group_predictions = [group_predictions]
 
-        if len(predictions) == 1:
-            return predictions[0]
-        else:
-            return predictions
+            for row_idx, prediction in zip(group_rows, group_predictions):
+                predictions[row_idx] = prediction
+
+        if output == 'numpy':
+            return gather_group_predictions(group_results, num_rows)
+        return predictions
+
+    def get_predictions(self, data, method_name, output=None, copy=True):
+        if isinstance(data, list) and len(data) > 1:
+            data = pd.DataFrame(data)
+            copy = False
+
+        if isinstance(data, pd.DataFrame) and data.shape[0] > 1:
+            return self.get_batch_predictions(data, method_name, output=output, copy=copy)
 
-    def predict_proba(self, data):
         # For now, we are assuming that data is a list of dictionaries, so if we have a single
         # dict, put it in a list
         if isinstance(data, dict):
@@ -58,26 +114,47 @@ class CategoricalEnsembler(object):
 
         predictions = []
         for row in data:
-            category = row[self.categorical_column]
-            if str(category) == 'nan':
-                category = 'nan'
-
-            try:
-                model = self.trained_models[category]
-            except KeyError as e:
-                if self.default_category == '_RAISE_ERROR':
-                    raise e
-                model = self.trained_models[self.default_category]
-
-            transformed_row = self.transformation_pipeline.transform(row)
-            prediction = model.predict_proba(transformed_row)
+            model = self.trained_models[self.get_model_key(row[self.categorical_column])]
+
+            transformed_row = self.transformation_pipeline.transform(row, copy=copy)
+            prediction = getattr(model, method_name)(transformed_row, output=output)
             predictions.append(prediction)
 
+        if output == 'numpy':
+            return gather_group_predictions(
+                [[[row_idx], prediction] for row_idx, prediction in enumerate(predictions)],
+                len(predictions))
+
         if len(predictions) == 1:
             return predictions[0]
         else:
             return predictions
 
+    def predict(self, data, output=None, copy=True):
+        return self.get_predictions(data, 'predict', output=output, copy=copy)
+
+    def predict_proba(self, data, output=None, copy=True):
+        return self.get_predictions(data, 'predict_proba', output=output, copy=copy)
+
+
+# Puts the ndarray of predictions we got for each group of rows back in the order of the rows they
+# came from, in a single ndarray.
+# group_results is a list of [row_positions, predictions] pairs.
+def gather_group_predictions(group_results, num_rows):
+    row_shapes = set(group_predictions.shape[1:] for _, group_predictions in group_results)
+    if len(row_shapes) > 1:
+        raise ValueError('The models for different categories returned predictions of different '
+                         'shapes (' + str(sorted(row_shapes)) + '), which cannot be combined into '
+                         'a single array. This usually means some categories only had some of the '
+                         'classes in their training data. Use output=None to get lists back.')
+
+    dtype = functools.reduce(np.promote_types,
+                             [group_predictions.dtype for _, group_predictions in group_results])
+    predictions = np.empty((num_rows,) + row_shapes.pop(), dtype=dtype)
+    for row_positions, group_predictions in group_results:
+        predictions[row_positions] = group_predictions
+    return predictions
+
 
 # Remove nans from our categorical ensemble column
 def clean_categorical_definitions(df, categorical_column):
@@ -92,3 +169,37 @@ def clean_categorical_definitions(df, categorical_column):
         df[categorical_column].fillna('nan', inplace=True)
 
     return df
+
+
+# Splits the row positions of category_values into one group per category, in a single pass.
+# Returns a list of [category, row_positions] pairs, with row_positions in their original order.
+def partition_rows_by_category(category_values):
+    codes, unique_categories = pd.factorize(category_values)
+    categories = list(unique_categories)
+    # Missing values get a code of -1, which lands on this last slot
+    categories.append('nan')
+
+    # A stable sort keeps each category's rows in their original order
+    row_order = np.argsort(codes, kind='stable')
+    group_codes, group_starts, group_sizes = np.unique(codes[row_order],
+                                                       return_index=True,
+                                                       return_counts=True)
+
+    return [[categories[code], row_order[group_start:group_start + group_size]]
+            for code, group_start, group_size in zip(group_codes, group_starts, group_sizes)]
+
+
+# A rough upper bound on the memory needed to train a model on each group of rows of X. Many of our
+# models densify their training data, so we assume the worst, and add the copy of the rows
+# themselves on top of that.
+def estimate_training_bytes(X, row_position_groups):
+    num_features = X.shape[1]
+    if hasattr(X, 'indptr'):
+        row_bytes = np.diff(X.indptr) * (X.data.itemsize + X.indices.itemsize) + 8
+    else:
+        row_bytes = np.full(X.shape[0], num_features * 8)
+
+    return [
+        len(row_positions) * num_features * 8 + int(row_bytes[row_positions].sum())
+        for row_positions in row_position_groups
+    ]
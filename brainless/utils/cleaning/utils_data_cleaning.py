@@ -1,14 +1,42 @@
 import datetime
-import os
+import importlib
+import multiprocessing
 import warnings
+from functools import lru_cache
 
 import dateutil
 import numpy as np
 import pandas as pd
-import pathos
 from pandas import __version__ as pandas_version
 from sklearn.base import BaseEstimator, TransformerMixin
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfVectorizer
+
+from brainless.utils.execution import utils_execution
+
+# pandas only made this public in 2.0. Before that it lived in a few different places, and was
+# called _guess_datetime_format before 1.3.
+guess_datetime_format_locations = [
+    ('pandas.tseries.api', 'guess_datetime_format'),
+    ('pandas._libs.tslibs.parsing', 'guess_datetime_format'),
+    ('pandas._libs.tslibs.parsing', '_guess_datetime_format'),
+    ('pandas.core.tools.datetimes', '_guess_datetime_format'),
+    ('pandas.tseries.tools', '_guess_datetime_format')
+]
+
+
+def get_guess_datetime_format():
+    for module_name, function_name in guess_datetime_format_locations:
+        try:
+            return getattr(importlib.import_module(module_name), function_name)
+        except (ImportError, AttributeError):
+            pass
+    warnings.warn('We could not find guess_datetime_format in pandas ' + pandas_version + '. Date '
+                  'columns will still be parsed, but without a date format learned at training '
+                  'time, which makes parsing single dictionaries slower.')
+    return None
+
+
+guess_datetime_format = get_guess_datetime_format()
 
 # The easiest way to check against a bunch of different bad values is to convert whatever val we
 # have into a string, then check it against a set containing the string representation of a bunch
@@ -91,10 +119,79 @@ def clean_val_nan_version(key, val, replacement_val=np.nan):
         return float_val
 
 
+# Vectorized version of running clean_val_nan_version over every value in a column, with exactly
+# the same results. We only fall back to calling clean_val_nan_version value by value for the
+# (usually few) values we cannot convert in bulk, like strings that are not numbers at all.
+def clean_numeric_column(col_name, column_values, replacement_val=np.nan):
+    values = np.asarray(column_values.values)
+    if values.dtype != object:
+        values = values.astype(object)
+    num_rows = len(values)
+
+    result = np.full(num_rows, replacement_val, dtype=np.float64)
+    converted = np.zeros(num_rows, dtype=bool)
+
+    # numpy's object -> float64 conversion calls float() on each value, just in C
+    def convert_in_bulk(rows, rows_values):
+        try:
+            result[rows] = rows_values.astype(np.float64)
+        except (TypeError, ValueError, OverflowError):
+            return False
+        converted[rows] = True
+        return True
+
+    # Bad values just keep replacement_val. Missing values (None, nan) are all bad values, except
+    # for NaT, which goes through the usual path.
+    is_bad_row = pd.Series(values).isin(bad_vals_as_strings).values
+    rows = np.flatnonzero(pd.isnull(values))
+    is_bad_row[rows] = [str(val) in bad_vals_as_strings for val in values[rows]]
+    rows = np.flatnonzero(~is_bad_row)
+
+    fallback_rows = None
+    if not convert_in_bulk(rows, values[rows]):
+        # clean_val_nan_version strips commas from strings that fail to parse, and tries again.
+        # Stripping commas from a string that does parse does nothing, so we just strip them all.
+        stripped = np.empty(len(rows), dtype=object)
+        stripped[:] = [
+            val.replace(',', '') if isinstance(val, str) else val for val in values[rows]
+        ]
+
+        if not convert_in_bulk(rows, stripped):
+            # Some of these values are not numbers at all. pd.to_numeric does not always round
+            # the same way float() does, so we only use it to find the values that parse, and let
+            # float() do the actual parsing.
+            parses = pd.to_numeric(pd.Series(stripped), errors='coerce').notnull().values
+            if convert_in_bulk(rows[parses], stripped[parses]):
+                fallback_rows = rows[~parses]
+            else:
+                fallback_rows = rows
+
+    # float() happily accepts a few of our bad values ('nan', 'inf', float('inf')). These are the
+    # only ones that come out as nan or inf, so those are the only rows we need to check.
+    for row_idx in np.flatnonzero(converted & ~np.isfinite(result)):
+        if str(values[row_idx]) in bad_vals_as_strings:
+            result[row_idx] = replacement_val
+
+    if fallback_rows is not None:
+        for row_idx in fallback_rows:
+            result[row_idx] = clean_val_nan_version(col_name, values[row_idx],
+                                                    replacement_val=replacement_val)
+
+    return pd.Series(result, index=column_values.index, name=column_values.name)
+
+
+numeric_col_descs = {'continuous', 'numerical', 'float', 'int'}
+
+# Below this many cells that need cleaning, starting up worker processes takes longer than just
+# cleaning everything in this process
+min_cells_for_parallel_cleaning = 2000000
+
+
 class BasicDataCleaning(BaseEstimator, TransformerMixin):
 
-    def __init__(self, column_descriptions=None):
+    def __init__(self, column_descriptions=None, nlp_hashed_features=None):
         self.column_descriptions = column_descriptions
+        self.nlp_hashed_features = nlp_hashed_features
         self.transformed_column_descriptions = column_descriptions.copy()
         self.text_col_indicators = {'text', 'nlp'}
         self.numeric_col_types = [
@@ -103,7 +200,22 @@ class BasicDataCleaning(BaseEstimator, TransformerMixin):
 
         self.text_columns = {}
         for key, val in self.column_descriptions.items():
-            if val in self.text_col_indicators:
+            if val not in self.text_col_indicators:
+                continue
+            if nlp_hashed_features is not None:
+                # Hashing words into a fixed number of buckets means there is no vocabulary to
+                # learn (or to save along with the model). The features for bucket 17 of the
+                # "review" column are named "nlp_review_hash_17".
+                self.text_columns[key] = HashingVectorizer(
+                    n_features=int(nlp_hashed_features),
+                    decode_error='ignore',
+                    strip_accents='unicode',
+                    analyzer='word',
+                    stop_words='english',
+                    lowercase=True,
+                    # Keep every weight positive, just like our TF-IDF weights
+                    alternate_sign=False)
+            else:
                 self.text_columns[key] = TfidfVectorizer(
                     # If we have any documents that cannot be decoded properly, just ignore them
                     # and keep going as planned with everything else
@@ -143,6 +255,7 @@ class BasicDataCleaning(BaseEstimator, TransformerMixin):
         print('Running basic data cleaning')
 
         self.vals_to_drop = {'ignore', 'output', 'regressor', 'classifier'}
+        self.date_formats = {}
 
         # See if we should fit TfidfVectorizer or not
         for key in X_df.columns:
@@ -178,38 +291,83 @@ class BasicDataCleaning(BaseEstimator, TransformerMixin):
             if self.transformed_column_descriptions.get(key) is None:
                 self.transformed_column_descriptions[key] = 'continuous'
 
-            if key in self.text_columns:
-                X_df[key].fillna('nan', inplace=True)
-                if pandas_version < '0.20.0':
-                    text_col = X_df[key].astype(str, raise_on_error=False)
-                else:
-                    text_col = X_df[key].astype(str, errors='ignore')
-                self.text_columns[key].fit(text_col)
+            if self.column_descriptions.get(key) == 'date':
+                self.date_formats[key] = guess_date_format(X_df[key])
 
-                col_names = self.text_columns[key].get_feature_names()
+        text_cols_to_fit = [key for key in X_df.columns if key in self.text_columns]
+        if self.should_fit_text_in_parallel(X_df, text_cols_to_fit):
+            self.fit_text_columns_in_parallel(X_df, text_cols_to_fit)
+        else:
+            for key in text_cols_to_fit:
+                self.fit_text_column(column_values=X_df[key], col_name=key)
 
-                # Make weird characters play nice, or just ignore them :)
-                for idx, word in enumerate(col_names):
-                    try:
-                        col_names[idx] = str(word)
-                    except:
-                        # TODO: Fix bare Except
-                        col_names[idx] = 'non_ascii_word_' + str(idx)
+        return self
 
-                col_names = ['nlp_' + key + '_' + str(word) for word in col_names]
+    def fit_text_column(self, column_values, col_name):
+        if isinstance(self.text_columns[col_name], HashingVectorizer):
+            # Nothing to learn here, every word already has its bucket
+            n_features = self.text_columns[col_name].n_features
+            self.text_columns[col_name].cleaned_feature_names = [
+                'nlp_' + col_name + '_hash_' + str(bucket) for bucket in range(n_features)
+            ]
+            return self.text_columns[col_name]
 
-                self.text_columns[key].cleaned_feature_names = col_names
+        column_values = column_values.fillna('nan')
+        if pandas_version < '0.20.0':
+            text_col = column_values.astype(str, raise_on_error=False)
+        else:
+            text_col = column_values.astype(str, errors='ignore')
+        self.text_columns[col_name].fit(text_col)
 
-        return self
+        col_names = self.text_columns[col_name].get_feature_names()
+
+        # Make weird characters play nice, or just ignore them :)
+        for idx, word in enumerate(col_names):
+            try:
+                col_names[idx] = str(word)
+            except:
+                # TODO: Fix bare Except
+                col_names[idx] = 'non_ascii_word_' + str(idx)
+
+        col_names = ['nlp_' + col_name + '_' + str(word) for word in col_names]
+
+        self.text_columns[col_name].cleaned_feature_names = col_names
+
+        return self.text_columns[col_name]
+
+    # Each TfidfVectorizer learns its vocabulary independently of the others, so with more than
+    # one text column, we fit them all at once
+    def should_fit_text_in_parallel(self, X_df, text_cols_to_fit):
+        if utils_execution.get_execution_mode('processes') != 'processes':
+            return False
+        if self.get('nlp_hashed_features') is not None:
+            return False
+        if len(text_cols_to_fit) < 2:
+            return False
+        return X_df.shape[0] * len(text_cols_to_fit) >= min_cells_for_parallel_cleaning
+
+    # Forked workers inherit this closure (and X_df along with it) through fork, rather than having
+    # it pickled over to them
+    def fit_text_columns_in_parallel(self, X_df, text_cols_to_fit):
+
+        def fit_text_column_in_worker(col_name):
+            return col_name, self.fit_text_column(column_values=X_df[col_name], col_name=col_name)
+
+        fitted_vectorizers = utils_execution.map_in_workers(fit_text_column_in_worker,
+                                                            text_cols_to_fit)
+
+        for col_name, vectorizer in fitted_vectorizers:
+            self.text_columns[col_name] = vectorizer
 
     # TODO: Simplify
-    def transform(self, X):
+    # X is never modified, unless copy is False. Then a DataFrame with nothing but numeric columns
+    # is cleaned in place (which only resets its index), rather than copied first.
+    def transform(self, X, copy=True):
         column_descriptions = self.get('transformed_column_descriptions', self.column_descriptions)
 
         # Convert input to DataFrame if we were given a list of dictionaries
         if isinstance(X, list):
             X = pd.DataFrame(X)
-        X = X.copy()
 
         # All of these are values we will not want to keep for training this particular estimator.
         # Note that we have already split out the output column and saved it into it's own variable
@@ -226,7 +384,8 @@ class BasicDataCleaning(BaseEstimator, TransformerMixin):
                 elif col_desc in (None, 'continuous', 'numerical', 'float', 'int'):
                     dict_copy[key] = clean_val_nan_version(key, val, replacement_val=0)
                 elif col_desc == 'date':
-                    date_feature_dict = add_date_features_dict(X, key)
+                    date_feature_dict = add_date_features_dict(
+                        X, key, date_format=self.get('date_formats', {}).get(key))
                     dict_copy.update(date_feature_dict)
                 elif col_desc == 'categorical':
                     dict_copy[key] = val
@@ -264,8 +423,6 @@ class BasicDataCleaning(BaseEstimator, TransformerMixin):
             return dict_copy
 
         else:
-            X.reset_index(drop=True, inplace=True)
-
             # Run data cleaning only for columns that are not already pandas numeric dtypes
             cols_to_clean = []
             dtypes = X.dtypes
@@ -273,42 +430,117 @@ class BasicDataCleaning(BaseEstimator, TransformerMixin):
                 if dtypes[idx] not in self.numeric_col_types:
                     cols_to_clean.append(col)
 
-            if len(cols_to_clean) > 0:
-
-                df_to_clean = X[cols_to_clean]
-                X.drop(cols_to_clean, axis=1, inplace=True)
+            if len(cols_to_clean) == 0:
+                if copy:
+                    X = X.copy()
+                X.reset_index(drop=True, inplace=True)
+                return X
+
+            # Selecting and dropping columns both give us new frames, so X itself never gets
+            # modified from here on, and doesn't need to be copied
+            df_to_clean = X[cols_to_clean]
+            df_to_clean.index = pd.RangeIndex(len(df_to_clean))
+            X = X.drop(cols_to_clean, axis=1)
+            X.reset_index(drop=True, inplace=True)
 
-                if df_to_clean.shape[0] > 100000 or os.environ.get('is_test_suite', 0) == 'True':
-                    results = list(map(
-                        lambda col: self.process_one_column(column_values=df_to_clean[col],
-                                                            col_name=col), df_to_clean.columns))
-                else:
-                    pool = pathos.multiprocessing.ProcessPool()
-                    # TODO: Try to improve flow control
-                    try:
-                        pool.restart()
-                    except AssertionError:
-                        pass
-
-                    results = list(pool.map(
-                        lambda col: self.process_one_column(column_values=df_to_clean[col],
-                                                            col_name=col), df_to_clean.columns))
-                    pool.close()
-                    # TODO: Try to improve flow control
-                    try:
-                        pool.join()
-                    except AssertionError:
-                        pass
+            if self.should_clean_in_parallel(df_to_clean):
+                results = self.process_columns_in_parallel(df_to_clean)
+            else:
+                results = list(map(
+                    lambda col: self.process_one_column(column_values=df_to_clean[col],
+                                                        col_name=col), df_to_clean.columns))
 
-                result = {}
-                for val in results:
-                    result.update(val)
-                    del val
-                df_result = pd.DataFrame(result)
-                X[df_result.columns] = df_result
+            result = {}
+            for val in results:
+                result.update(val)
+                del val
+            df_result = pd.DataFrame(result)
+            # Assigning thousands of (sparse) text columns one at a time is slow, so we join
+            # everything at once
+            replaced_cols = [col for col in df_result.columns if col in X.columns]
+            if len(replaced_cols) > 0:
+                X = X.drop(replaced_cols, axis=1)
+            X = pd.concat([X, df_result], axis=1, copy=False)
 
             return X
 
+    # Forking a pool of workers costs more than it saves on small frames, or when there is only
+    # one column that needs real work
+    def should_clean_in_parallel(self, df_to_clean):
+        # Cleaning is mostly pure python, so threads would just take turns holding the GIL
+        if utils_execution.get_execution_mode('processes') != 'processes':
+            return False
+        cols_to_process = self.get_cols_to_process_in_workers(df_to_clean)
+        if len(cols_to_process) < 2:
+            return False
+        return df_to_clean.shape[0] * len(cols_to_process) >= min_cells_for_parallel_cleaning
+
+    # Categorical columns are passed through untouched, so there's no point sending them anywhere
+    def get_cols_to_process_in_workers(self, df_to_clean):
+        column_descriptions = self.get('transformed_column_descriptions', self.column_descriptions)
+        cols_to_process = []
+        for col_name in df_to_clean.columns:
+            col_desc = column_descriptions.get(col_name)
+            if col_desc in numeric_col_descs or col_desc == 'date' \
+                    or col_name in self.text_columns:
+                cols_to_process.append(col_name)
+        return cols_to_process
+
+    # Cleans columns in parallel across forked worker processes. The workers inherit this object
+    # and the frame through fork, rather than having them pickled over for every column. Cleaned
+    # numeric columns (usually the bulk of the work) are written straight into a shared buffer, so
+    # only the (much smaller) date and text results are pickled back to us.
+    def process_columns_in_parallel(self, df_to_clean):
+        column_descriptions = self.get('transformed_column_descriptions', self.column_descriptions)
+        cols_to_process = self.get_cols_to_process_in_workers(df_to_clean)
+        numeric_cols = [
+            col_name for col_name in cols_to_process
+            if column_descriptions.get(col_name) in numeric_col_descs
+        ]
+        numeric_slots = {col_name: idx for idx, col_name in enumerate(numeric_cols)}
+        num_rows = df_to_clean.shape[0]
+
+        numeric_buffer = multiprocessing.RawArray('d', max(len(numeric_cols) * num_rows, 1))
+
+        def process_one_column_in_worker(col_name):
+            result = self.process_one_column(column_values=df_to_clean[col_name],
+                                             col_name=col_name)
+            if col_name in numeric_slots:
+                worker_numeric_results = np.frombuffer(numeric_buffer, dtype=np.float64)
+                slot = numeric_slots[col_name]
+                worker_numeric_results[slot * num_rows:(slot + 1) * num_rows] = \
+                    result[col_name].values
+                return col_name, None
+            return col_name, result
+
+        worker_results = utils_execution.map_in_workers(process_one_column_in_worker,
+                                                        cols_to_process)
+
+        # Each numeric column is one contiguous row of this array. These are views on the shared
+        # buffer, not copies.
+        numeric_results = np.frombuffer(numeric_buffer, dtype=np.float64)
+        numeric_results = numeric_results[:len(numeric_cols) * num_rows].reshape(
+            len(numeric_cols), num_rows)
+
+        results = []
+        for col_name, result in worker_results:
+            if result is None:
+                result = {
+                    col_name: pd.Series(numeric_results[numeric_slots[col_name]],
+                                        index=df_to_clean.index)
+                }
+            results.append(result)
+
+        # The rest are either passed through untouched, or dropped
+        cols_to_process = set(cols_to_process)
+        for col_name in df_to_clean.columns:
+            if col_name not in cols_to_process:
+                results.append(
+                    self.process_one_column(column_values=df_to_clean[col_name],
+                                            col_name=col_name))
+
+        return results
+
     # TODO: Simplify
     def process_one_column(self, column_values, col_name):
         column_descriptions = self.get('transformed_column_descriptions', self.column_descriptions)
@@ -331,8 +563,7 @@ class BasicDataCleaning(BaseEstimator, TransformerMixin):
             # function handles commas inside strings that represent numbers, and returns nan if
             # we cannot turn this value into a float. nans are ignored in DataFrameVectorizer
             try:
-                column_values = column_values.apply(
-                    lambda x: clean_val_nan_version(col_name, x, replacement_val=0))
+                column_values = clean_numeric_column(col_name, column_values, replacement_val=0)
                 result = {col_name: column_values}
             except TypeError as e:
                 raise e
@@ -352,7 +583,9 @@ class BasicDataCleaning(BaseEstimator, TransformerMixin):
                 print('!' * 64)
 
         elif col_desc == 'date':
-            result = add_date_features_df(column_values, col_name)
+            result = add_date_features_df(column_values,
+                                          col_name,
+                                          date_format=self.get('date_formats', {}).get(col_name))
 
         elif col_name in self.text_columns:
 
@@ -366,14 +599,15 @@ class BasicDataCleaning(BaseEstimator, TransformerMixin):
                 nlp_matrix = self.text_columns[col_name].transform(
                     column_values.astype(str, errors='ignore'))
 
-            nlp_matrix = nlp_matrix.toarray()
-
-            text_df = pd.DataFrame(nlp_matrix)
-            text_df.columns = col_names
+            # Each document only has a handful of the (up to 3000) words in our vocabulary, so we
+            # keep these as sparse columns all the way through to DataFrameVectorizer
+            text_df = pd.DataFrame.sparse.from_spmatrix(nlp_matrix,
+                                                        index=column_values.index,
+                                                        columns=col_names)
 
             result = {}
-            for column_values in text_df.columns:
-                result[column_values] = text_df[column_values].astype(int)
+            for text_col_name in text_df.columns:
+                result[text_col_name] = text_df[text_col_name]
 
         elif col_desc in self.vals_to_drop:
             result = {}
@@ -412,52 +646,82 @@ def minutes_into_day_parts(minutes_into_day):
         return 'early_night'
 
 
-# Note: assumes that the column is already formatted as a pandas date type
-def add_date_features_df(col_data, date_col):
-    # Pandas nicely tries to prevent you from doing stupid things, like setting values on a copy
-    # of a df, not your real one. However, it's a bit overzealous in this case, so we'll
-    # side-step a bunch of warnings by setting is_copy to false here.
-
+# Vectorized version of minutes_into_day_parts, for an entire column at once
+def minutes_into_day_parts_array(minutes_into_day):
+    minutes_into_day = np.asarray(minutes_into_day, dtype=np.float64)
+    conditions = [
+        (minutes_into_day < 6 * 60) | (minutes_into_day > 23.5 * 60), minutes_into_day < 10 * 60,
+        minutes_into_day < 11.5 * 60, minutes_into_day < 14 * 60, minutes_into_day < 18 * 60,
+        minutes_into_day < 20.5 * 60
+    ]
+    choices = ['late_night', 'morning', 'mid_morning', 'lunchtime', 'afternoon', 'dinnertime']
+    return np.select(conditions, choices, default='early_night').astype(object)
+
+
+# Our date features come out as ints, unless some dates were missing, in which case they are floats
+# with 0 for the missing dates
+def fill_date_feature(values):
+    if values.isnull().any():
+        return values.astype(float).fillna(0)
+    return values.astype(int)
+
+
+# If the training data had dates as strings, we figure out their format at fit time. Parsing with
+# a known format is much faster than having dateutil figure it out for every single value.
+def guess_date_format(col_data):
+    if guess_datetime_format is None or col_data.dtype != object:
+        return None
+    for val in col_data.dropna().head(10):
+        if isinstance(val, str):
+            return guess_datetime_format(val)
+    return None
+
+
+# Note: assumes that the column is already formatted as a pandas date type, or can be converted to
+# one with pd.to_datetime
+def add_date_features_df(col_data, date_col, date_format=None):
     result = {}
 
-    col_data = pd.to_datetime(col_data)
-
-    if pandas_version < '0.20.0':
-        result[date_col + '_day_of_week'] = col_data.apply(lambda x: x.weekday()).astype(
-            int, raise_on_error=False)
-    else:
-        result[date_col + '_day_of_week'] = col_data.apply(lambda x: x.weekday()).astype(
-            int, errors='ignore')
+    col_data = parse_date_column(col_data, date_format)
+    dates = col_data.dt
 
-    # TODO: Try to improve flow control
-    try:
-        if pandas_version < '0.20.0':
-            result[date_col + '_hour'] = col_data.apply(lambda x: x.hour).astype(
-                int, raise_on_error=False)
-        else:
-            result[date_col + '_hour'] = col_data.apply(lambda x: x.hour).astype(
-                int, errors='ignore')
+    day_of_week = dates.weekday
+    result[date_col + '_day_of_week'] = fill_date_feature(day_of_week)
+    result[date_col + '_hour'] = fill_date_feature(dates.hour)
+    result[date_col + '_minutes_into_day'] = fill_date_feature(dates.hour * 60 + dates.minute)
+    result[date_col + '_is_weekend'] = day_of_week.isin([5, 6])
+    result[date_col + '_day_part'] = pd.Series(
+        minutes_into_day_parts_array(result[date_col + '_minutes_into_day']),
+        index=col_data.index)
 
-        result[date_col + '_minutes_into_day'] = col_data.apply(lambda x: x.hour * 60 + x.minute)
-
-        result[date_col + '_hour'] = result[date_col + '_hour'].fillna(0)
-        result[date_col + '_minutes_into_day'] = result[date_col + '_minutes_into_day'].fillna(0)
-    except AttributeError:
-        pass
+    return result
 
-    result[date_col + '_is_weekend'] = col_data.apply(lambda x: x.weekday() in (5, 6))
-    result[date_col + '_day_part'] = result[date_col +
-                                            '_minutes_into_day'].apply(minutes_into_day_parts)
 
-    result[date_col + '_day_of_week'] = result[date_col + '_day_of_week'].fillna(0)
-    result[date_col + '_is_weekend'] = result[date_col + '_is_weekend'].fillna(0)
-    result[date_col + '_day_part'] = result[date_col + '_day_part'].fillna(0)
-    return result
+def parse_date_column(col_data, date_format=None):
+    if date_format is not None and col_data.dtype == object:
+        try:
+            return pd.to_datetime(col_data, format=date_format)
+        except (TypeError, ValueError):
+            # Not every value matched the format from training. Let pandas work it out.
+            pass
+    return pd.to_datetime(col_data)
+
+
+# Production traffic tends to send the same timestamps over and over again, so we keep the most
+# recently parsed ones around. datetime objects are immutable, so sharing them is safe.
+@lru_cache(maxsize=4096)
+def parse_date_string(date_string, date_format=None):
+    if date_format is not None:
+        try:
+            return datetime.datetime.strptime(date_string, date_format)
+        except ValueError:
+            pass
+    return dateutil.parser.parse(date_string)
 
 
 # Same logic as above, except implemented for a single dictionary, which is much faster at
 # prediction time when getting just a single prediction
-def add_date_features_dict(row, date_col):
+def add_date_features_dict(row, date_col, date_format=None):
     date_feature_dict = {}
 
     # Handle cases where the val for the date_col is None
@@ -466,7 +730,7 @@ def add_date_features_dict(row, date_col):
         if date_val is None:
             return date_feature_dict
         if not isinstance(date_val, (datetime.datetime, datetime.date)):
-            date_val = dateutil.parser.parse(date_val)
+            date_val = parse_date_string(date_val, date_format)
     except:
         # TODO: Fix bare Except
         return date_feature_dict
@@ -482,7 +746,9 @@ def add_date_features_dict(row, date_col):
     try:
         date_feature_dict[date_col + '_hour'] = date_val.hour
 
-        date_feature_dict[date_col + '_minutes_into_day'] = date_val.hour * 60 + date_val.minute
+        minutes_into_day = date_val.hour * 60 + date_val.minute
+        date_feature_dict[date_col + '_minutes_into_day'] = minutes_into_day
+        date_feature_dict[date_col + '_day_part'] = minutes_into_day_parts(minutes_into_day)
     except AttributeError:
         pass
 
@@ -1,10 +1,20 @@
-import os
-
 import numpy as np
 import pandas as pd
-import pathos
 from sklearn.base import BaseEstimator, TransformerMixin
 
+from brainless.utils.execution import utils_execution
+
+# Each ensemble_method reduces the stacked predictions of all our sub-predictors down to a single
+# prediction, along the first (sub-predictor) axis
+ensemble_reducers = {
+    'median': np.median,
+    'average': np.mean,
+    'mean': np.mean,
+    'avg': np.mean,
+    'max': np.max,
+    'min': np.min
+}
+
 
 class Ensembler(BaseEstimator, TransformerMixin):
 
@@ -18,66 +28,50 @@ class Ensembler(BaseEstimator, TransformerMixin):
         self.ensemble_method = ensemble_method
         self.num_classes = num_classes
 
-    # Get a dataframe that is all the predictions from all the sub-models
-    # Note that we will get these predictions in parallel (relatively quick)
-
-    # TODO: Simplify
-    def get_all_predictions(self, X):
-
-        def get_predictions_for_one_estimator(estimator, X):
-            estimator_name = estimator.name
-
-            if self.type_of_estimator == 'regressor':
-                predictions = estimator.predict(X)
-            else:
-                # For classifiers
-                predictions = list(estimator.predict_proba(X))
-            return_obj = {estimator_name: predictions}
-            return return_obj
-
-        # Don't bother parallelizing if this is a single dictionary
-        if X.shape[0] == 1:
-            predictions_from_all_estimators = map(
-                lambda predictor: get_predictions_for_one_estimator(predictor, X),
-                self.ensemble_predictors)
-
+    # Gets the predictions (or predicted probabilities, for classifiers) from every sub-model for
+    # the same (already transformed) X.
+    # The sub-models spend nearly all their time inside numpy/scipy/the model libraries, which
+    # release the GIL, so our shared thread pool gets them running concurrently without copying X
+    # anywhere.
+    def get_predictions_from_all_estimators(self, X, method_name, output=None):
+
+        def get_predictions_for_one_estimator(estimator):
+            return getattr(estimator, method_name)(X, output=output)
+
+        # Don't bother parallelizing if this is a single dictionary. Keras models are tied to the
+        # graph (and session) of the thread that loaded them, so those stay on this thread too.
+        if X.shape[0] == 1 or len(self.ensemble_predictors) == 1 or any(
+                estimator.get('model_name', '')[:12] == 'DeepLearning'
+                for estimator in self.ensemble_predictors):
+            return list(map(get_predictions_for_one_estimator, self.ensemble_predictors))
+
+        return utils_execution.map_in_workers(get_predictions_for_one_estimator,
+                                              self.ensemble_predictors,
+                                              preferred_mode='threads')
+
+    # Stacks the predictions from every sub-model into a single ndarray, with the sub-models along
+    # the first axis. That's (n_predictors, n_rows) for regressors and (n_predictors, n_rows,
+    # n_classes) for classifiers, minus the n_rows axis if X is a single row (unless output is
+    # 'numpy').
+    def get_stacked_predictions(self, X, output=None):
+        if self.type_of_estimator == 'regressor':
+            method_name = 'predict'
         else:
+            method_name = 'predict_proba'
 
-            # Pathos doesn't like datasets beyond a certain size. So fall back on single,
-            # non-parallel predictions instead.
-            if os.environ.get('is_test_suite', False) == 'True':
-                predictions_from_all_estimators = map(
-                    lambda predictor: get_predictions_for_one_estimator(predictor, X),
-                    self.ensemble_predictors)
+        predictions = self.get_predictions_from_all_estimators(X, method_name, output=output)
+        return np.array([np.asarray(prediction, dtype=np.float64) for prediction in predictions])
 
-            else:
-                # Open a new multiprocessing pool
-                pool = pathos.multiprocessing.ProcessPool()
-
-                # Since we may have already closed the pool, try to restart it
-                # TODO: Try to improve flow control
-                try:
-                    pool.restart()
-                except AssertionError:
-                    pass
-                predictions_from_all_estimators = pool.map(
-                    lambda predictor: get_predictions_for_one_estimator(predictor, X),
-                    self.ensemble_predictors)
-
-                # Once we have gotten all we need from the pool, close it so it's not taking up
-                # unnecessary memory
-                pool.close()
-                # TODO: Try to improve flow control
-                try:
-                    pool.join()
-                except AssertionError:
-                    pass
-
-        predictions_from_all_estimators = list(predictions_from_all_estimators)
+    # Get a dataframe that is all the predictions from all the sub-models
+    def get_all_predictions(self, X):
+        stacked_predictions = self.get_stacked_predictions(X)
 
         results = {}
-        for result_dict in predictions_from_all_estimators:
-            results.update(result_dict)
+        for estimator, predictions in zip(self.ensemble_predictors, stacked_predictions):
+            if self.type_of_estimator == 'regressor':
+                results[estimator.name] = predictions
+            else:
+                results[estimator.name] = list(predictions)
 
         # if this is a single row we are getting predictions from, just return a dictionary with
         # single values for all the predictions
@@ -88,82 +82,38 @@ class Ensembler(BaseEstimator, TransformerMixin):
 
             return predictions_df
 
+    def reduce_predictions(self, stacked_predictions):
+        if self.ensemble_method not in ensemble_reducers:
+            raise ValueError('We do not know how to combine predictions using ensemble_method="' +
+                             str(self.ensemble_method) + '". Please pass in one of: ' +
+                             str(sorted(ensemble_reducers.keys())))
+
+        return ensemble_reducers[self.ensemble_method](stacked_predictions, axis=0)
+
     def fit(self, X, y):
         return self
 
     # Public API to get a single prediction from each row, where that single prediction is
     # somehow an ensemble of all our trained sub-predictors
 
-    def predict(self, X):
-
-        predictions = self.get_all_predictions(X)
+    # output='numpy' returns an ndarray with one prediction per row, even for a single row
+    def predict(self, X, output=None):
+        stacked_predictions = np.array(
+            self.get_predictions_from_all_estimators(X, 'predict', output=output))
 
-        # If this is just a single dictionary we're getting predictions from:
-        if X.shape[0] == 1:
-            # predictions is just a dictionary where all the values are the predicted values from
-            # one of our sub-predictors. we'll want that as a list
-            predicted_values = list(predictions.values())
-            if self.ensemble_method == 'median':
-                return np.median(predicted_values)
-            elif self.ensemble_method == 'average' \
-                    or self.ensemble_method == 'mean' \
-                    or self.ensemble_method == 'avg':
-                return np.average(predicted_values)
-            elif self.ensemble_method == 'max':
-                return np.max(predicted_values)
-            elif self.ensemble_method == 'min':
-                return np.min(predicted_values)
+        # A single row gets a single value back, rather than an array holding that value
+        return self.reduce_predictions(stacked_predictions)
 
-        else:
+    # output='numpy' returns a 2D ndarray of shape (n_rows, n_classes), even for a single row
+    def predict_proba(self, X, output=None):
+        if self.type_of_estimator == 'regressor':
+            raise ValueError('predict_proba is only available for classifiers')
 
-            if self.ensemble_method == 'median':
-                return predictions.apply(np.median, axis=1).values
-            elif self.ensemble_method == 'average' or self.ensemble_method == 'mean' \
-                    or self.ensemble_method == 'avg':
-                return predictions.apply(np.average, axis=1).values
-            elif self.ensemble_method == 'max':
-                return predictions.apply(np.max, axis=1).values
-            elif self.ensemble_method == 'min':
-                return predictions.apply(np.min, axis=1).values
+        stacked_predictions = self.get_stacked_predictions(X, output=output)
+        ensembled_predictions = self.reduce_predictions(stacked_predictions)
 
-    def get_predictions_by_class(self, predictions):
-        predictions_by_class = []
-        for class_idx in range(self.num_classes):
-            class_predictions = [pred[class_idx] for pred in predictions]
-            predictions_by_class.append(class_predictions)
-
-        return predictions_by_class
-
-    def predict_proba(self, X):
-
-        predictions = self.get_all_predictions(X)
-
-        # If this is just a single dictionary we're getting predictions from:
-        if X.shape[0] == 1:
-            # predictions is just a dictionary where all the values are the predicted values from
-            # one of our sub-predictors. we'll want that as a list
-            predicted_values = list(predictions.values())
-            predicted_values = self.get_predictions_by_class(predicted_values)
-
-            if self.ensemble_method == 'median':
-                return [np.median(class_predictions) for class_predictions in predicted_values]
-            elif self.ensemble_method == 'average' or self.ensemble_method == 'mean' \
-                    or self.ensemble_method == 'avg':
-                return [np.average(class_predictions) for class_predictions in predicted_values]
-            elif self.ensemble_method == 'max':
-                return [np.max(class_predictions) for class_predictions in predicted_values]
-            elif self.ensemble_method == 'min':
-                return [np.min(class_predictions) for class_predictions in predicted_values]
-
-        else:
-            classed_predictions = predictions.apply(self.get_predictions_by_class, axis=1)
-
-            if self.ensemble_method == 'median':
-                return classed_predictions.apply(np.median, axis=1)
-            elif self.ensemble_method == 'average' or self.ensemble_method == 'mean' \
-                    or self.ensemble_method == 'avg':
-                return classed_predictions.apply(np.average, axis=1)
-            elif self.ensemble_method == 'max':
-                return classed_predictions.apply(np.max, axis=1)
-            elif self.ensemble_method == 'min':
-                return classed_predictions.apply(np.min, axis=1)
+        # If this is just a single dictionary we're getting predictions from, return a single
+        # list of predicted probabilities for each class
+        if X.shape[0] == 1 and output is None:
+            return ensembled_predictions.tolist()
+        return ensembled_predictions
@@ -0,0 +1,234 @@
+import contextlib
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from threadpoolctl import threadpool_limits
+
+# One place that decides how much of the machine brainless gets to use. Data cleaning, text
+# fitting, ensembling, categorical ensembles, the hyperparameter search, the models' own n_jobs,
+# and the BLAS/OpenMP threads underneath numpy all read from here, so that stacking them on top of
+# each other doesn't end up running (number of cores)^2 threads.
+
+# The modes are ordered from least to most parallel. Each call site says which mode suits its work
+# best (threads for code that releases the GIL, processes for pure python work), and we never run
+# anything more parallel than the user has configured.
+execution_modes = ['serial', 'threads', 'processes']
+
+execution_config = {'mode': None, 'cpu_budget': None, 'memory_budget': None}
+
+# The thread pool is kept around and reused across calls, rather than paying to spin up new
+# threads for every batch of predictions.
+shared_thread_pool = {'executor': None, 'max_workers': None}
+shared_thread_pool_lock = threading.Lock()
+
+# Whatever a forked worker needs, set right before forking. Workers inherit it through fork
+# instead of having it pickled over to them.
+fork_state = {}
+
+# Work that is already running inside one of our workers runs serially, rather than forking or
+# queueing even more workers underneath it
+worker_flags = {'in_forked_worker': False}
+thread_worker_flags = threading.local()
+
+
+# Sets how brainless runs its parallel work, for the whole process.
+# mode: one of 'serial', 'threads', or 'processes'. Defaults to picking the best mode for each
+# piece of work.
+# cpu_budget: the number of cores brainless can use in total. Defaults to all of them.
+# memory_budget: the number of bytes of RAM our workers can use between them. Defaults to however
+# much memory is available when we start the workers.
+# Calling this with no arguments resets all of them to their defaults.
+def configure_execution(mode=None, cpu_budget=None, memory_budget=None):
+    if mode is not None and mode not in execution_modes:
+        raise ValueError('mode must be one of ' + str(execution_modes) + ', but we received ' +
+                         str(mode))
+    for budget_name, budget in [('cpu_budget', cpu_budget), ('memory_budget', memory_budget)]:
+        if budget is not None:
+            if isinstance(budget, bool) or not isinstance(budget, int) or budget < 1:
+                raise ValueError(budget_name + ' must be a positive integer, but we received ' +
+                                 str(budget))
+
+    execution_config['mode'] = mode
+    execution_config['cpu_budget'] = cpu_budget
+    execution_config['memory_budget'] = memory_budget
+
+    # The pool is sized to the old budget, so let the next caller create a fresh one
+    shutdown_thread_pool()
+    limit_blas_threads(get_cpu_budget())
+
+
+def get_cpu_budget():
+    if execution_config['cpu_budget'] is not None:
+        return execution_config['cpu_budget']
+    if os.environ.get('is_test_suite', 0) == 'True':
+        return 1
+    return multiprocessing.cpu_count()
+
+
+# Returns None if we have no budget, and can't tell how much memory is available either
+def get_memory_budget():
+    if execution_config['memory_budget'] is not None:
+        return execution_config['memory_budget']
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+# How many workers can run at once, when each item needs roughly estimated_bytes[idx] of memory
+# to process. We assume the largest items all end up running at the same time, so this holds up
+# no matter what order the workers pick the items up in.
+def get_max_workers_within_memory_budget(estimated_bytes):
+    memory_budget = get_memory_budget()
+    if memory_budget is None:
+        return None
+
+    max_workers = 0
+    total_bytes = 0
+    for item_bytes in sorted(estimated_bytes, reverse=True):
+        total_bytes += item_bytes
+        if total_bytes > memory_budget:
+            break
+        max_workers += 1
+
+    # Even if the largest item doesn't fit, we still have to process it somehow
+    return max(max_workers, 1)
+
+
+# Translates an sklearn-style n_jobs (where -1 means all cores, -2 means all but one, etc.) into a
+# number of cores that fits inside our cpu_budget
+def get_n_jobs(n_jobs=-1):
+    cpu_budget = get_cpu_budget()
+    if n_jobs is None or execution_config['mode'] == 'serial':
+        return 1
+    if n_jobs < 0:
+        return max(cpu_budget + 1 + n_jobs, 1)
+    return max(min(n_jobs, cpu_budget), 1)
+
+
+def get_execution_mode(preferred_mode='processes'):
+    if worker_flags['in_forked_worker'] or getattr(thread_worker_flags, 'in_thread_worker', False):
+        return 'serial'
+
+    configured_mode = execution_config['mode']
+    if configured_mode is None:
+        if get_cpu_budget() < 2:
+            return 'serial'
+        mode = preferred_mode
+    else:
+        mode = execution_modes[min(
+            execution_modes.index(configured_mode), execution_modes.index(preferred_mode))]
+
+    # Spawned processes would have to pickle everything over, which defeats the point
+    if mode == 'processes' and 'fork' not in multiprocessing.get_all_start_methods():
+        mode = 'threads'
+    return mode
+
+
+def limit_blas_threads(num_threads):
+    threadpool_limits(limits=num_threads)
+
+
+# Limits the BLAS/OpenMP threads only while this block runs, and puts back whatever limits were
+# there before
+@contextlib.contextmanager
+def blas_threads_limited(num_threads):
+    with threadpool_limits(limits=num_threads):
+        yield
+
+
+# Each of our workers gets an equal share of the BLAS/OpenMP threads. Otherwise every worker's
+# numpy calls would start as many threads as there are cores, whether or not anyone called
+# configure_execution.
+def get_blas_threads_per_worker(num_workers):
+    return max(get_cpu_budget() // num_workers, 1)
+
+
+def get_thread_pool():
+    cpu_budget = get_cpu_budget()
+    with shared_thread_pool_lock:
+        if shared_thread_pool['executor'] is None or \
+                shared_thread_pool['max_workers'] != cpu_budget:
+            if shared_thread_pool['executor'] is not None:
+                shared_thread_pool['executor'].shutdown(wait=False)
+            shared_thread_pool['executor'] = ThreadPoolExecutor(max_workers=cpu_budget)
+            shared_thread_pool['max_workers'] = cpu_budget
+        return shared_thread_pool['executor']
+
+
+def shutdown_thread_pool():
+    with shared_thread_pool_lock:
+        if shared_thread_pool['executor'] is not None:
+            shared_thread_pool['executor'].shutdown(wait=True)
+        shared_thread_pool['executor'] = None
+        shared_thread_pool['max_workers'] = None
+
+
+# Calls func on every item, in parallel where our mode and cpu_budget allow it, and returns the
+# results in the same order as items. Workers pick up items in order, so put the largest (slowest)
+# items first to keep them from holding everything up at the end.
+# func does not need to be picklable (lambdas and closures are fine), but with processes, whatever
+# it returns does.
+# max_workers: caps how many items are processed at once, below our cpu_budget (to stay inside a
+# memory budget, say).
+def map_in_workers(func, items, preferred_mode='processes', max_workers=None):
+    items = list(items)
+    mode = get_execution_mode(preferred_mode)
+
+    num_workers = min(len(items), get_cpu_budget())
+    if max_workers is not None:
+        num_workers = min(num_workers, max_workers)
+
+    if mode == 'serial' or num_workers < 2:
+        return [func(item) for item in items]
+
+    if mode == 'threads':
+        # The shared pool is sized to our cpu_budget, so this caps how many of our items run at
+        # once when we want fewer than that
+        running_slots = threading.Semaphore(num_workers)
+
+        def call_in_thread_worker(item):
+            with running_slots:
+                thread_worker_flags.in_thread_worker = True
+                try:
+                    return func(item)
+                finally:
+                    thread_worker_flags.in_thread_worker = False
+
+        # BLAS limits apply to the whole process, so our threads share them for as long as they run
+        with blas_threads_limited(get_blas_threads_per_worker(num_workers)):
+            return list(get_thread_pool().map(call_in_thread_worker, items))
+
+    return map_in_forked_workers(func, items, num_workers)
+
+
+# Process pools are created for each call, rather than kept around. A pool forked earlier would
+# not see the data we're about to work on, so every input would have to be pickled over to it.
+# Forking only copies pages that get written to, which is much cheaper than that for the large
+# frames we're handing off here.
+def map_in_forked_workers(func, items, num_workers):
+    fork_state['func'] = func
+    fork_state['items'] = items
+    try:
+        blas_threads_per_worker = get_blas_threads_per_worker(num_workers)
+        pool = multiprocessing.get_context('fork').Pool(num_workers,
+                                                        initializer=set_up_forked_worker,
+                                                        initargs=(blas_threads_per_worker,))
+        try:
+            return pool.map(call_in_forked_worker, range(len(items)), chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        fork_state.clear()
+
+
+def set_up_forked_worker(blas_threads_per_worker):
+    worker_flags['in_forked_worker'] = True
+    limit_blas_threads(blas_threads_per_worker)
+
+
+def call_in_forked_worker(item_idx):
+    return fork_state['func'](fork_state['items'][item_idx])
@@ -3,22 +3,25 @@ from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
 from sklearn.feature_selection import GenericUnivariateSelect, RFECV, SelectFromModel
 
+from brainless.utils.execution import utils_execution
+
 
 def get_feature_selection_model_from_name(type_of_estimator, model_name):
+    n_jobs = utils_execution.get_n_jobs(-1)
     model_map = {
         'classifier': {
             'SelectFromModel': SelectFromModel(
-                RandomForestClassifier(n_jobs=-1, max_depth=10, n_estimators=15),
+                RandomForestClassifier(n_jobs=n_jobs, max_depth=10, n_estimators=15),
                 threshold='20*mean'),
-            'RFECV': RFECV(estimator=RandomForestClassifier(n_jobs=-1), step=0.1),
+            'RFECV': RFECV(estimator=RandomForestClassifier(n_jobs=n_jobs), step=0.1),
             'GenericUnivariateSelect': GenericUnivariateSelect(),
             'KeepAll': 'KeepAll'
         },
         'regressor': {
             'SelectFromModel': SelectFromModel(
-                RandomForestRegressor(n_jobs=-1, max_depth=10, n_estimators=15),
+                RandomForestRegressor(n_jobs=n_jobs, max_depth=10, n_estimators=15),
                 threshold='0.7*mean'),
-            'RFECV': RFECV(estimator=RandomForestRegressor(n_jobs=-1), step=0.1),
+            'RFECV': RFECV(estimator=RandomForestRegressor(n_jobs=n_jobs), step=0.1),
             'GenericUnivariateSelect': GenericUnivariateSelect(),
             'KeepAll': 'KeepAll'
         }
@@ -52,11 +55,13 @@ class FeatureSelectionTransformer(BaseEstimator, TransformerMixin):
         if self.selector != 'KeepAll':
             if self.feature_selection_model == 'SelectFromModel':
                 num_rows = X.shape[0]
+                n_jobs = utils_execution.get_n_jobs(-1)
                 if self.type_of_estimator == 'regressor':
-                    self.estimator = RandomForestRegressor(n_jobs=-1, max_depth=10, n_estimators=15)
+                    self.estimator = RandomForestRegressor(n_jobs=n_jobs, max_depth=10,
+                                                           n_estimators=15)
                 else:
                     self.estimator = RandomForestClassifier(
-                        n_jobs=-1, max_depth=10, n_estimators=15)
+                        n_jobs=n_jobs, max_depth=10, n_estimators=15)
 
                 self.estimator.fit(X, y)
 
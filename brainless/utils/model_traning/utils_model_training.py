@@ -3,30 +3,22 @@ import gc
 import os
 import random
 import warnings
-from collections import Iterable
-from copy import deepcopy
+from collections import Iterable, OrderedDict
 
 import numpy as np
 import pandas as pd
 from scipy import sparse as scipy_sparse
+from scipy.special import expit, softmax
 from sklearn import __version__ as sklearn_version
-from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.base import BaseEstimator, TransformerMixin, is_classifier
+from sklearn.metrics import accuracy_score, r2_score
 from sklearn.model_selection import train_test_split
+from sklearn.utils import check_array
 
+from brainless.utils import utils
 from brainless.utils.models import utils_models
 from brainless.utils.models.utils_models import get_name_from_model
 
-try:
-    from keras import Sequential
-    from keras.layers import Dense
-    from keras.callbacks import EarlyStopping, ModelCheckpoint, TerminateOnNaN
-    from keras.models import load_model as keras_load_model
-    from keras.wrappers.scikit_learn import KerasRegressor, KerasClassifier
-
-    keras_installed = True
-except ImportError:
-    keras_installed = False
-
 
 # This is the Air Traffic Controller (ATC) that is a wrapper around sklearn estimators.
 
@@ -107,7 +99,8 @@ class FinalModelATC(BaseEstimator, TransformerMixin):
                 X_fit = X_fit.todense()
 
             if self.model_name[:12] == 'DeepLearning':
-                if keras_installed is False:
+                keras_backend = utils_models.get_backend('keras')
+                if keras_backend is None:
                     # Suppress some level of logs
                     os.environ['TF_CPP_MIN_VLOG_LEVEL'] = '3'
                     os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
@@ -130,19 +123,23 @@ class FinalModelATC(BaseEstimator, TransformerMixin):
                     pass
 
                 if self.type_of_estimator == 'regressor':
-                    self.model = KerasRegressor(
+                    self.model = keras_backend['DeepLearningRegressor'](
                         build_fn=utils_models.make_deep_learning_model,
                         num_cols=num_cols,
                         feature_learning=self.feature_learning,
                         **model_params)
                 elif self.type_of_estimator == 'classifier':
-                    self.model = KerasClassifier(
+                    self.model = keras_backend['DeepLearningClassifier'](
                         build_fn=utils_models.make_deep_learning_classifier,
                         num_cols=num_cols,
                         feature_learning=self.feature_learning,
                         **model_params)
 
         if self.model_name[:12] == 'DeepLearning':
+            # Only import this if we have to, because it takes a while to import in some
+            # environments
+            from keras.callbacks import EarlyStopping, ModelCheckpoint, TerminateOnNaN
+
             try:
 
                 if self.is_hp_search is True:
@@ -197,7 +194,7 @@ class FinalModelATC(BaseEstimator, TransformerMixin):
                 #  best accuracy, etc.
 
                 if self.is_hp_search is False:
-                    self.model = keras_load_model(temp_file_name)
+                    self.model = utils_models.keras_load_model(temp_file_name)
 
                     # TODO: Try to improve flow control
                 try:
@@ -213,7 +210,7 @@ class FinalModelATC(BaseEstimator, TransformerMixin):
 
                 if self.is_hp_search is False:
                     # TODO: Make sure that temp_file_name is initialized
-                    self.model = keras_load_model(temp_file_name)
+                    self.model = utils_models.keras_load_model(temp_file_name)
                     # TODO: Try to improve flow control
                 try:
                     os.remove(temp_file_name)
@@ -318,8 +315,14 @@ class FinalModelATC(BaseEstimator, TransformerMixin):
             patience = 20
             best_val_loss = -10000000000
             num_worse_rounds = 0
-            best_model = deepcopy(self.model)
+            # We keep track of how many trees gave us our best score, rather than keeping a copy
+            # of the model at that point, then drop every tree after that once we're done
+            best_num_estimators = None
+            original_warm_start = self.model.get_params()['warm_start']
             X_fit, y, X_test, y_test = self.get_X_test(X_fit, y)
+            # Drop any missing y values once, rather than every time we score the holdout set
+            X_test, y_test = utils.drop_missing_y_values(X_test, y_test, output_column=None)
+            staged_holdout_predictions = StagedHoldoutPredictions(self.model, X_test)
 
             # Add a variable number of trees each time, depending how far into the process we are
             if os.environ.get('is_test_suite', False) == 'True':
@@ -342,19 +345,19 @@ class FinalModelATC(BaseEstimator, TransformerMixin):
                     self.model.set_params(n_estimators=num_iter, warm_start=warm_start)
                     self.model.fit(X_fit, y)
 
-                    if self.training_prediction_intervals is True:
-                        val_loss = self.model.score(X_test, y_test)
-                    else:
-                        try:
-                            val_loss = self._scorer.score(self, X_test, y_test)
-                        except Exception:
-                            # TODO: Fix bare Except
-                            val_loss = self.model.score(X_test, y_test)
-
-                    if val_loss - self.min_step_improvement > best_val_loss:
-                        best_val_loss = val_loss
+                    # Score the holdout set after every one of the trees we just added
+                    found_improvement = False
+                    for num_estimators, predictions in \
+                            staged_holdout_predictions.get_new_stage_predictions():
+                        val_loss = self.score_holdout_predictions(predictions, y_test)
+
+                        if val_loss - self.min_step_improvement > best_val_loss:
+                            best_val_loss = val_loss
+                            best_num_estimators = num_estimators
+                            found_improvement = True
+
+                    if found_improvement:
                         num_worse_rounds = 0
-                        best_model = deepcopy(self.model)
                     else:
                         num_worse_rounds += 1
                     print('[' + str(num_iter) +
@@ -366,7 +369,9 @@ class FinalModelATC(BaseEstimator, TransformerMixin):
                 print('Heard KeyboardInterrupt. Stopping training, and using the best '
                       'GradientBoosting model with a checkpoint')
 
-            self.model = best_model
+            if best_num_estimators is not None:
+                self.truncate_gradient_boosting_model(best_num_estimators)
+            self.model.set_params(warm_start=original_warm_start)
             print('The number of estimators that were the best for this training dataset: ' +
                   str(self.model.get_params()['n_estimators']))
             print('The best score on the holdout set: ' + str(best_val_loss))
@@ -380,6 +385,41 @@ class FinalModelATC(BaseEstimator, TransformerMixin):
         gc.collect()
         return self
 
+    # Scores the predictions (or predicted probabilities) from a GradientBoosting model on our
+    # holdout set, the same way we would score the model itself
+    def score_holdout_predictions(self, predictions, y):
+        if self.training_prediction_intervals is True:
+            return r2_score(y, predictions)
+
+        # Classifiers trained inside a regressor (like our uncertainty model) are scored on their
+        # predicted labels by the regressor's scorer, just as their .predict() would be
+        if is_classifier(self.model) and self.type_of_estimator != 'classifier':
+            predictions = self.model.classes_[np.argmax(predictions, axis=1)]
+
+        try:
+            return self._scorer.score_predictions(predictions, y)
+        except Exception:
+            # TODO: Fix bare Except
+            # Falls back on the same score the model's own .score() would give us
+            if self.type_of_estimator == 'classifier':
+                predicted_labels = self.model.classes_[np.argmax(predictions, axis=1)]
+                return accuracy_score(y, predicted_labels)
+            return r2_score(y, predictions)
+
+    # Drops every tree after the first num_estimators, as if we had trained only that many
+    def truncate_gradient_boosting_model(self, num_estimators):
+        self.model.estimators_ = self.model.estimators_[:num_estimators]
+        self.model.train_score_ = self.model.train_score_[:num_estimators]
+        if hasattr(self.model, 'oob_improvement_'):
+            self.model.oob_improvement_ = self.model.oob_improvement_[:num_estimators]
+        # Newer versions of sklearn also keep the out-of-bag score after each stage
+        if hasattr(self.model, 'oob_scores_'):
+            self.model.oob_scores_ = self.model.oob_scores_[:num_estimators]
+            self.model.oob_score_ = self.model.oob_scores_[-1]
+        if hasattr(self.model, 'n_estimators_'):
+            self.model.n_estimators_ = num_estimators
+        self.model.set_params(n_estimators=num_estimators)
+
     @staticmethod
     def remove_categorical_values(features):
         clean_features = set([])
@@ -545,7 +585,9 @@ class FinalModelATC(BaseEstimator, TransformerMixin):
             return self.model.score(X, y)
 
     # TODO: Simplify
-    def predict_proba(self, X):
+    # output='numpy' skips building nested python lists, and always returns a 2D ndarray of shape
+    # (n_rows, n_classes), even for a single row
+    def predict_proba(self, X, output=None):
 
         if self.model_name[:3] == 'XGB':
             ones = [[1] for _ in range(X.shape[0])]
@@ -592,6 +634,9 @@ class FinalModelATC(BaseEstimator, TransformerMixin):
                 X = X.todense()
             predictions = self.model.predict_proba(X)
 
+        if output == 'numpy':
+            return get_probabilities_array(predictions)
+
         # If this model does not have predict_proba, and we have fallen back on predict,
         # we want to make sure we give results back in the same format the user would expect for
         # predict_proba, namely each prediction is a list of predicted probabilities for each
@@ -626,7 +671,8 @@ class FinalModelATC(BaseEstimator, TransformerMixin):
             return predictions
 
     # TODO: Simplify
-    def predict(self, X):
+    # output='numpy' returns the model's predictions as a flat ndarray, even for a single row
+    def predict(self, X, output=None):
 
         if self.model_name[:3] == 'XGB':
             ones = [[1] for _ in range(X.shape[0])]
@@ -664,6 +710,14 @@ class FinalModelATC(BaseEstimator, TransformerMixin):
             predictions = self.model.predict(X, num_iteration=best_iteration)
         else:
             predictions = self.model.predict(X_predict)
+
+        if output == 'numpy':
+            predictions = np.asarray(predictions)
+            # Keras hands back a column of predictions, rather than a flat array
+            if predictions.ndim == 2 and predictions.shape[1] == 1:
+                predictions = predictions[:, 0]
+            return np.ascontiguousarray(predictions)
+
         # Handle cases of getting a prediction for a single item. It makes a cleaner interface
         # just to get just the single prediction back, rather than a list with the prediction
         # hidden inside.
@@ -762,8 +816,7 @@ class FinalModelATC(BaseEstimator, TransformerMixin):
         base_predictions = self.predict(X)
 
         if isinstance(base_predictions, Iterable):
-            base_predictions_col = [[val] for val in base_predictions]
-            base_predictions_col = np.array(base_predictions_col)
+            base_predictions_col = np.asarray(base_predictions, dtype=np.float64).reshape(-1, 1)
         else:
             base_predictions_col = [base_predictions]
 
@@ -778,36 +831,23 @@ class FinalModelATC(BaseEstimator, TransformerMixin):
 
         if isinstance(base_predictions, Iterable):
 
-            results['uncertainty_prediction'] = [
-                row[1] for row in results['uncertainty_prediction']
-            ]
+            results['uncertainty_prediction'] = np.asarray(
+                results['uncertainty_prediction'])[:, 1]
 
             results = pd.DataFrame.from_dict(results, orient='columns')
 
             if self.uc_results is not None:
-                calibration_results = {}
-                # grab the relevant properties from our uc_results, and make them each their own
-                # list in calibration_results
-                for key, value in self.uc_results[1].items():
-                    calibration_results[key] = []
-
-                for proba in results['uncertainty_prediction']:
-                    max_bucket_proba = 0
-                    bucket_num = 1
-                    while proba > max_bucket_proba:
-                        calibration_result = self.uc_results[bucket_num]
-                        max_bucket_proba = self.uc_results[bucket_num]['max_proba']
-                        bucket_num += 1
-
-                    # TODO: Make sure that calibration_result is initialized
-                    for key, value in calibration_result.items():
-                        calibration_results[key].append(value)
-                # TODO: grab the uncertainty_calibration data for DataFrames
-                df_calibration_results = pd.DataFrame.from_dict(
-                    calibration_results, orient='columns')
-                del df_calibration_results['max_proba']
+                max_probas, calibration_columns = get_uc_results_arrays(self.uc_results)
+
+                # Each row's bucket is the first one whose max_proba is at least as large as the
+                # row's uncertainty_prediction
+                bucket_idxs = np.searchsorted(max_probas, results['uncertainty_prediction'].values,
+                                              side='left')
+                bucket_idxs = np.minimum(bucket_idxs, len(max_probas) - 1)
 
-                results = pd.concat([results, df_calibration_results], axis=1)
+                # TODO: grab the uncertainty_calibration data for DataFrames
+                for key, column_values in calibration_columns.items():
+                    results[key] = column_values[bucket_idxs]
 
         # else:
         #     if self.uc_results is not None:
@@ -843,3 +883,90 @@ class FinalModelATC(BaseEstimator, TransformerMixin):
         else:
             X_fit, X_test, y, y_test = train_test_split(X_fit, y, test_size=0.15)
             return X_fit, y, X_test, y_test
+
+
+# Keeps a GradientBoosting model's predictions on a holdout set up to date as trees get added to it
+# with warm_start. Each new tree only gets run on the holdout set once, rather than re-running
+# every tree in the model each time we check in on the holdout score.
+class StagedHoldoutPredictions(object):
+
+    def __init__(self, model, X):
+        self.model = model
+        # The same dtype and format the model converts X to when predicting
+        self.X = check_array(X, dtype=np.float32, accept_sparse='csr')
+        self.raw_predictions = None
+        self.num_stages = 0
+
+    # Yields the number of trees, along with the predictions (or predicted probabilities) we get
+    # from that many trees, for every tree that has been added since we last checked
+    def get_new_stage_predictions(self):
+        estimators = self.model.estimators_
+        for stage_idx in range(self.num_stages, estimators.shape[0]):
+            if self.raw_predictions is None:
+                # The first stage includes the model's initial predictions, so we let the model
+                # work those out for itself
+                if is_classifier(self.model):
+                    first_stage = next(self.model.staged_decision_function(self.X))
+                else:
+                    first_stage = next(self.model.staged_predict(self.X))
+                self.raw_predictions = np.array(first_stage, dtype=np.float64).reshape(
+                    self.X.shape[0], -1)
+            else:
+                for class_idx in range(estimators.shape[1]):
+                    self.raw_predictions[:, class_idx] += self.model.learning_rate * estimators[
+                        stage_idx, class_idx].predict(self.X, check_input=False)
+
+            self.num_stages = stage_idx + 1
+            yield self.num_stages, self.get_predictions()
+
+    def get_predictions(self):
+        if not is_classifier(self.model):
+            return self.raw_predictions[:, 0].copy()
+
+        # The same link functions the model's own predict_proba uses
+        if self.raw_predictions.shape[1] == 1:
+            if self.model.loss == 'exponential':
+                positive_probabilities = expit(2 * self.raw_predictions[:, 0])
+            else:
+                positive_probabilities = expit(self.raw_predictions[:, 0])
+            return np.column_stack([1 - positive_probabilities, positive_probabilities])
+
+        return softmax(self.raw_predictions, axis=1)
+
+
+# Turns whatever a model gave us from predict_proba (or from predict, for models without
+# predict_proba) into a 2D ndarray with one column per class, without going through python lists.
+# Like predict_proba's list output, this assumes predict's classes have been reduced to 0 and 1.
+def get_probabilities_array(predictions):
+    predictions = np.asarray(predictions)
+
+    if predictions.ndim == 1:
+        positive_probabilities = (predictions == 1).astype(np.float64)
+        predictions = np.column_stack([1 - positive_probabilities, positive_probabilities])
+
+    # Libraries like Keras return just the probability of the positive class for binary problems
+    elif predictions.shape[1] == 1:
+        predictions = np.column_stack([1 - predictions[:, 0], predictions[:, 0]])
+
+    return np.ascontiguousarray(predictions)
+
+
+# Compiles our uc_results (an OrderedDict of calibration results for each bucket, in order) into
+# arrays we can look up all of our rows in at once. Returns each bucket's max_proba, along with an
+# array for each of the other calibration results, with one value per bucket.
+def get_uc_results_arrays(uc_results):
+    bucket_results = list(uc_results.values())
+
+    # The running max lets us binary search for the first bucket whose max_proba is at least as
+    # large as a prediction, even if the buckets' max_probas are not perfectly sorted
+    max_probas = np.maximum.accumulate(
+        np.array([bucket_result['max_proba'] for bucket_result in bucket_results],
+                 dtype=np.float64))
+
+    calibration_columns = OrderedDict()
+    for key in bucket_results[0]:
+        if key != 'max_proba':
+            calibration_columns[key] = np.array(
+                [bucket_result[key] for bucket_result in bucket_results])
+
+    return max_probas, calibration_columns
@@ -1,4 +1,6 @@
 import os
+import sys
+import threading
 
 import dill
 from sklearn.cluster import MiniBatchKMeans
@@ -11,45 +13,87 @@ from sklearn.linear_model import RANSACRegressor, LinearRegression, Ridge, Lasso
     PassiveAggressiveClassifier
 from sklearn.svm import LinearSVC, LinearSVR
 
+from brainless.utils.bundle import utils_bundle
 from brainless.utils.categorical import utils_categorical_ensembling
+from brainless.utils.execution import utils_execution
 
-try:
-    from xgboost import XGBClassifier, XGBRegressor
 
-    xgb_installed = True
-except ImportError:
-    xgb_installed = False
+# The model libraries we support but don't require. None of them are imported until a model
+# actually needs them, rather than whenever brainless is imported: keras alone pulls in all of
+# tensorflow, which can take several seconds, and most pipelines never touch it.
+# Each importer returns the names we use from its library, keyed by our model_name.
+def import_xgboost():
+    from xgboost import XGBClassifier, XGBRegressor
+    return {'XGBClassifier': XGBClassifier, 'XGBRegressor': XGBRegressor}
 
 
-try:
+def import_lightgbm():
     from lightgbm import LGBMRegressor, LGBMClassifier
+    return {'LGBMRegressor': LGBMRegressor, 'LGBMClassifier': LGBMClassifier}
 
-    lgb_installed = True
-except ImportError:
-    lgb_installed = False
 
-
-try:
+def import_catboost():
     from catboost import CatBoostRegressor, CatBoostClassifier
+    return {'CatBoostRegressor': CatBoostRegressor, 'CatBoostClassifier': CatBoostClassifier}
 
-    catboost_installed = True
-except ImportError:
-    catboost_installed = False
 
-try:
-    from keras import Sequential, regularizers, optimizers
-    from keras.models import load_model as keras_load_model
+def import_keras():
     from keras.wrappers.scikit_learn import KerasRegressor, KerasClassifier
-    from keras.layers import ELU, PReLU, ThresholdedReLU, LeakyReLU, ReLU, \
-        Dense, Dropout, Activation
+    return {'DeepLearningRegressor': KerasRegressor, 'DeepLearningClassifier': KerasClassifier}
+
+
+# backend name: (the module an instance of one of its models comes from, its importer)
+optional_backends = {
+    'xgboost': ('xgboost', import_xgboost),
+    'lightgbm': ('lightgbm', import_lightgbm),
+    'catboost': ('catboost', import_catboost),
+    'keras': ('keras', import_keras)
+}
+
+# model_name prefix: the backend that provides it
+model_name_prefixes_to_backends = {
+    'XGB': 'xgboost',
+    'LGBM': 'lightgbm',
+    'CatBoost': 'catboost',
+    'DeepLearning': 'keras'
+}
+
+# backend name: the dictionary its importer returned, or None if it is not installed
+loaded_backends = {}
+loaded_backends_lock = threading.Lock()
+
+
+# Imports the backend the first time anyone asks for it. Returns None if it is not installed.
+def get_backend(backend_name):
+    try:
+        return loaded_backends[backend_name]
+    except KeyError:
+        pass
+
+    with loaded_backends_lock:
+        if backend_name not in loaded_backends:
+            try:
+                loaded_backends[backend_name] = optional_backends[backend_name][1]()
+            except ImportError:
+                loaded_backends[backend_name] = None
+        return loaded_backends[backend_name]
+
+
+def is_backend_installed(backend_name):
+    return get_backend(backend_name) is not None
+
+
+def get_backend_name(model_name):
+    for prefix, backend_name in model_name_prefixes_to_backends.items():
+        if model_name[:len(prefix)] == prefix:
+            return backend_name
+    return None
 
-    keras_installed = True
-except ImportError:
-    keras_installed = False
 
-# Note: it's important that importing tensorflow come last. We can run into OpenCL issues if we
-# import it ahead of some other packages. At the moment, it's a known behavior with tensorflow,
-# but everyone's ok with this workaround.
+def keras_load_model(file_name):
+    # Only import this if we have to, because it takes a while to import in some environments
+    from keras.models import load_model
+    return load_model(file_name)
 
 
 # TODO: Simplify
@@ -211,34 +255,25 @@ def get_model_from_name(model_name, training_params=None, is_hp_search=False):
         model_map['SGDRegressor'] = SGDRegressor()
         model_map['PassiveAggressiveRegressor'] = PassiveAggressiveRegressor()
 
-    if xgb_installed:
-        model_map['XGBClassifier'] = XGBClassifier()
-        model_map['XGBRegressor'] = XGBRegressor()
-
-    if lgb_installed:
-        model_map['LGBMRegressor'] = LGBMRegressor()
-        model_map['LGBMClassifier'] = LGBMClassifier()
-
-    if catboost_installed:
-        model_map['CatBoostRegressor'] = CatBoostRegressor()
-        model_map['CatBoostClassifier'] = CatBoostClassifier()
-
-    if model_name[:12] == 'DeepLearning':
-        if keras_installed is False:
+    backend_name = get_backend_name(model_name)
+    if backend_name is not None:
+        if backend_name == 'keras':
             # Suppress some level of logs if TF is installed (but allow it to not be installed,
-            # and use Theano instead)
-            try:
-                os.environ['TF_CPP_MIN_VLOG_LEVEL'] = '3'
-                os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
-                from tensorflow import logging
-                logging.set_verbosity(logging.INFO)
-            except:
-                # TODO: Fix bare Except
-                pass
-
-        model_map['DeepLearningClassifier'] = KerasClassifier(
-            build_fn=make_deep_learning_classifier)
-        model_map['DeepLearningRegressor'] = KerasRegressor(build_fn=make_deep_learning_model)
+            # and use Theano instead). This has to happen before tensorflow is first imported.
+            if 'keras' not in loaded_backends:
+                os.environ.setdefault('TF_CPP_MIN_VLOG_LEVEL', '3')
+                os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '3')
+
+        backend = get_backend(backend_name)
+        if backend is not None and model_name in backend:
+            if backend_name == 'keras':
+                build_fns = {
+                    'DeepLearningClassifier': make_deep_learning_classifier,
+                    'DeepLearningRegressor': make_deep_learning_model
+                }
+                model_map[model_name] = backend[model_name](build_fn=build_fns[model_name])
+            else:
+                model_map[model_name] = backend[model_name]()
 
     try:
         model_without_params = model_map[model_name]
@@ -247,9 +282,9 @@ def get_model_from_name(model_name, training_params=None, is_hp_search=False):
               'import it, or using a value for model_names that we do not recognize.')
         raise e
 
-    if os.environ.get('is_test_suite', False) == 'True':
-        if 'n_jobs' in model_params:
-            model_params['n_jobs'] = 1
+    # Keep the model inside our cpu_budget, rather than letting it grab every core on the machine
+    if 'n_jobs' in model_params:
+        model_params['n_jobs'] = utils_execution.get_n_jobs(model_params['n_jobs'])
     model_with_params = model_without_params.set_params(**model_params)
 
     return model_with_params
@@ -312,29 +347,16 @@ def get_name_from_model(model):
     if isinstance(model, LinearSVC):
         return 'LinearSVC'
 
-    if xgb_installed:
-        if isinstance(model, XGBClassifier):
-            return 'XGBClassifier'
-        if isinstance(model, XGBRegressor):
-            return 'XGBRegressor'
-
-    if keras_installed:
-        if isinstance(model, KerasRegressor):
-            return 'DeepLearningRegressor'
-        if isinstance(model, KerasClassifier):
-            return 'DeepLearningClassifier'
-
-    if lgb_installed:
-        if isinstance(model, LGBMClassifier):
-            return 'LGBMClassifier'
-        if isinstance(model, LGBMRegressor):
-            return 'LGBMRegressor'
-
-    if catboost_installed:
-        if isinstance(model, CatBoostClassifier):
-            return 'CatBoostClassifier'
-        if isinstance(model, CatBoostRegressor):
-            return 'CatBoostRegressor'
+    # A model can only come from a library that has already been imported, so there's no need to
+    # import any of the others just to check
+    for backend_name, (module_name, _) in optional_backends.items():
+        if module_name in sys.modules:
+            backend = get_backend(backend_name)
+            if backend is None:
+                continue
+            for model_name, model_class in backend.items():
+                if isinstance(model, model_class):
+                    return model_name
 
 
 # Hyperparameter search spaces for each model
@@ -451,7 +473,7 @@ def get_search_params(model_name):
             'bootstrap': [True, False]
         },
         'AdaBoostRegressor': {
-            'base_estimator': [None, LinearRegression(n_jobs=-1)],
+            'base_estimator': [None, LinearRegression(n_jobs=utils_execution.get_n_jobs(-1))],
             'loss': ['linear', 'square', 'exponential']
         },
         'RANSACRegressor': {
@@ -592,8 +614,19 @@ def insert_deep_learning_model(pipeline_step, file_name):
     return model
 
 
+# Loads a pipeline saved by PredictorBase.save, in any of its bundle_formats.
+# mmap_mode='r' memory maps the arrays in a bundle, so that every process that loads it shares a
+# single copy of them (see utils_bundle.BundleReader).
 # TODO: Simplify
-def load_ml_model(file_name):
+def load_ml_model(file_name, mmap_mode=None):
+    if utils_bundle.is_bundle(file_name):
+        return utils_bundle.load_bundle(file_name, mmap_mode=mmap_mode)
+
+    if mmap_mode is not None:
+        print('We can only memory map pipelines saved as bundles, and ' + str(file_name) +
+              ' was saved as a single dill file. We will load it into memory instead. Save it '
+              'again with bundle_format="zip" to be able to memory map it.')
+
     with open(file_name, 'rb') as read_file:
         base_pipeline = dill.load(read_file)
 
@@ -635,6 +668,8 @@ def load_ml_model(file_name):
 # For many activations, we can just pass the activation name into Activations
 # For some others, we have to import them as their own standalone activation function
 def get_activation_layer(activation):
+    from keras.layers import ELU, PReLU, ThresholdedReLU, LeakyReLU, Activation
+
     if activation == 'LeakyReLU':
         return LeakyReLU()
     if activation == 'PReLU':
@@ -649,6 +684,8 @@ def get_activation_layer(activation):
 
 # TODO: same for optimizers, including clipnorm
 def get_optimizer(name='Adadelta'):
+    from keras import optimizers
+
     if name == 'SGD':
         return optimizers.SGD(clipnorm=1.)
     if name == 'RMSprop':
@@ -694,6 +731,9 @@ def make_deep_learning_model(hidden_layers=None,
     if feature_learning is True:
         scaled_layers.append(10)
 
+    from keras import Sequential, regularizers
+    from keras.layers import Dense, Dropout
+
     model = Sequential()
 
     model.add(
@@ -764,6 +804,9 @@ def make_deep_learning_classifier(hidden_layers=None,
     if feature_learning is True:
         scaled_layers.append(10)
 
+    from keras import Sequential, regularizers
+    from keras.layers import Dense, Dropout
+
     model = Sequential()
 
     # There are times we will want the output from our penultimate layer, not the final layer,
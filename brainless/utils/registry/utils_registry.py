@@ -0,0 +1,318 @@
+import collections
+import hashlib
+import mmap
+import os
+import sys
+import threading
+import types
+
+import numpy as np
+
+from brainless.utils.bundle import utils_bundle
+from brainless.utils.models.utils_models import load_ml_model
+
+# Libraries whose objects we size from their weights, rather than walking into them (a Keras model
+# references its whole TensorFlow graph)
+weights_modules = ['keras', 'tensorflow', 'tf_keras']
+
+# Code is shared by everything that uses it, so it never counts towards a model's size
+unsized_types = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType,
+                 types.MethodType)
+
+
+# Roughly how many bytes of this process's memory a loaded pipeline holds onto: its numpy arrays
+# (tree nodes and values, coefficients, idf vectors), scipy sparse matrices, vocabularies and other
+# python objects, and the weights of any Keras models. Anything several parts of the pipeline share
+# is counted once.
+# Arrays that are memory mapped (load_ml_model(mmap_mode='r')) live in the OS's page cache, shared
+# with every other process that maps them, so they aren't counted. Sub-models of a bundle that
+# haven't been loaded yet are counted as the size of their pickle, which is about what they'll
+# take up once something uses them.
+def get_model_size(trained_pipeline):
+    total_bytes = 0
+    seen_ids = set()
+    counted_data_ids = set()
+    objs_to_visit = [trained_pipeline]
+
+    while len(objs_to_visit) > 0:
+        obj = objs_to_visit.pop()
+        if id(obj) in seen_ids or obj is None or isinstance(obj, unsized_types):
+            continue
+        seen_ids.add(id(obj))
+
+        if isinstance(obj, utils_bundle.LazyModel):
+            # Anything but our own attributes would load the model
+            if obj.is_loaded():
+                objs_to_visit.append(obj._lazy_model)
+            else:
+                total_bytes += obj._lazy_bundle_reader.get_member_size(obj._lazy_member_name)
+            continue
+
+        if isinstance(obj, np.ndarray):
+            # Views share the data of the array they came from, so we count that data only once
+            data_owner = obj
+            while isinstance(data_owner.base, np.ndarray) and \
+                    not isinstance(data_owner, np.memmap):
+                data_owner = data_owner.base
+            is_mapped = isinstance(data_owner, np.memmap) or isinstance(data_owner.base, mmap.mmap)
+            if id(data_owner) not in counted_data_ids and not is_mapped:
+                counted_data_ids.add(id(data_owner))
+                total_bytes += data_owner.nbytes
+            total_bytes += sys.getsizeof(obj) - (obj.nbytes if obj.base is None else 0)
+            if obj.dtype.hasobject:
+                objs_to_visit.extend(obj.flat)
+            continue
+
+        module_name = type(obj).__module__.split('.')[0]
+        if module_name in weights_modules:
+            if hasattr(obj, 'get_weights'):
+                total_bytes += sum(weights.nbytes for weights in obj.get_weights())
+            else:
+                total_bytes += sys.getsizeof(obj)
+            continue
+
+        if module_name == 'pandas' and hasattr(obj, 'memory_usage'):
+            total_bytes += int(np.sum(obj.memory_usage(deep=True)))
+            continue
+
+        total_bytes += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            objs_to_visit.extend(obj.keys())
+            objs_to_visit.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            objs_to_visit.extend(obj)
+        elif isinstance(obj, (str, bytes, bytearray, int, float, bool, complex)):
+            pass
+        elif type(obj).__name__ == 'Tree' and module_name == 'sklearn':
+            # sklearn's decision trees keep their nodes in memory of their own, which we can only
+            # get at through what they pickle
+            tree_state = obj.__getstate__()
+            total_bytes += tree_state['nodes'].nbytes + tree_state['values'].nbytes
+        else:
+            objs_to_visit.extend(getattr(obj, '__dict__', {}).values())
+            for slot_name in get_slot_names(type(obj)):
+                objs_to_visit.append(getattr(obj, slot_name, None))
+
+    return total_bytes
+
+
+def get_slot_names(obj_type):
+    slot_names = []
+    for cls in obj_type.__mro__:
+        cls_slot_names = cls.__dict__.get('__slots__', ())
+        if isinstance(cls_slot_names, str):
+            cls_slot_names = [cls_slot_names]
+        slot_names.extend(slot_name for slot_name in cls_slot_names
+                          if slot_name not in ['__dict__', '__weakref__'])
+    return slot_names
+
+
+# Hashes everything in a saved pipeline (a bundle directory, or a single file)
+def get_content_hash(file_name):
+    content_hash = hashlib.sha256()
+    if os.path.isdir(file_name):
+        file_paths = get_file_paths(file_name)
+    else:
+        file_paths = [file_name]
+
+    for file_path in file_paths:
+        content_hash.update(os.path.relpath(file_path, file_name).encode('utf-8'))
+        with open(file_path, 'rb') as model_file:
+            for chunk in iter(lambda: model_file.read(1024 * 1024), b''):
+                content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+# Changes whenever the saved pipeline does, without reading it. Saving a pipeline replaces its
+# file, which gives it a new inode even if the size and modified time happen to match.
+def get_file_fingerprint(file_name):
+    if os.path.isdir(file_name):
+        file_paths = get_file_paths(file_name)
+    else:
+        file_paths = [file_name]
+
+    fingerprint = []
+    for file_path in file_paths:
+        file_stat = os.stat(file_path)
+        fingerprint.append((file_path, file_stat.st_size, file_stat.st_mtime_ns,
+                            file_stat.st_ino))
+    return tuple(fingerprint)
+
+
+def get_file_paths(dir_name):
+    file_paths = []
+    for dir_path, dir_names, file_names in os.walk(dir_name):
+        dir_names.sort()
+        file_paths.extend(os.path.join(dir_path, file_name) for file_name in sorted(file_names))
+    return file_paths
+
+
+# A load that other threads asking for the same model wait on, rather than loading it themselves
+class PendingLoad(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.trained_pipeline = None
+        self.error = None
+
+    def finish(self, trained_pipeline=None, error=None):
+        self.trained_pipeline = trained_pipeline
+        self.error = error
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.trained_pipeline
+
+
+# Keeps the pipelines a process serves loaded, for processes that serve more of them than fit in
+# memory at once (one per client and market, say). Each one is loaded with load_ml_model the first
+# time it's asked for, and the ones used least recently are dropped once the models we hold
+# add up to more than max_bytes (see get_model_size). The model we just loaded is always kept,
+# even if it's larger than max_bytes on its own.
+# Models are keyed by their path and a hash of their contents, so saving a new version over a
+# model gets you the new version the next time you ask for it. We only hash a model again when
+# its files change. If you already know the hash (from wherever you store your models), pass it
+# in as content_hash, and we won't read or hash anything.
+# Any number of threads can share a registry. Threads that ask for a model that's still loading
+# wait for that load, rather than loading their own copy.
+class ModelRegistry(object):
+
+    def __init__(self, max_bytes=None, mmap_mode=None):
+        if max_bytes is not None:
+            if isinstance(max_bytes, bool) or not isinstance(max_bytes, int) or max_bytes < 1:
+                raise ValueError('max_bytes must be a positive integer, but we received ' +
+                                 str(max_bytes))
+        if mmap_mode not in utils_bundle.mmap_modes:
+            raise ValueError('mmap_mode must be one of ' + str(utils_bundle.mmap_modes) +
+                             ', but we received ' + str(mmap_mode))
+
+        self.max_bytes = max_bytes
+        self.mmap_mode = mmap_mode
+
+        # (file_name, content_hash) to {'trained_pipeline', 'num_bytes'}, least recently used first
+        self.models = collections.OrderedDict()
+        self.keys_by_file_name = {}
+        self.pending_loads = {}
+        self.content_hashes = {}
+        self.num_bytes = 0
+        self.lock = threading.Lock()
+
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_coalesced_loads = 0
+        self.num_evictions = 0
+
+    def get(self, file_name, content_hash=None):
+        file_name = os.path.abspath(file_name)
+        if content_hash is None:
+            content_hash = self.get_content_hash(file_name)
+        key = (file_name, content_hash)
+
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                self.num_hits += 1
+                return self.models[key]['trained_pipeline']
+
+            pending_load = self.pending_loads.get(key)
+            if pending_load is not None:
+                self.num_coalesced_loads += 1
+            else:
+                self.num_misses += 1
+                self.pending_loads[key] = PendingLoad()
+
+        if pending_load is not None:
+            return pending_load.wait()
+        return self.load(key)
+
+    def load(self, key):
+        file_name = key[0]
+        try:
+            trained_pipeline = load_ml_model(file_name, mmap_mode=self.mmap_mode)
+            num_bytes = get_model_size(trained_pipeline)
+        except Exception as e:
+            # Failed loads aren't kept, so the next get tries again
+            with self.lock:
+                pending_load = self.pending_loads.pop(key)
+            pending_load.finish(error=e)
+            raise
+
+        with self.lock:
+            # Whatever version of this file we had before is out of date
+            old_key = self.keys_by_file_name.get(file_name)
+            if old_key is not None and old_key != key:
+                self.remove_model(old_key)
+
+            self.models[key] = {'trained_pipeline': trained_pipeline, 'num_bytes': num_bytes}
+            self.keys_by_file_name[file_name] = key
+            self.num_bytes += num_bytes
+            self.evict()
+            pending_load = self.pending_loads.pop(key)
+
+        pending_load.finish(trained_pipeline=trained_pipeline)
+        return trained_pipeline
+
+    # Drops the least recently used models until we're back under max_bytes. Callers still
+    # holding onto a model we dropped can keep using it.
+    def evict(self):
+        if self.max_bytes is None:
+            return
+        while self.num_bytes > self.max_bytes and len(self.models) > 1:
+            self.remove_model(next(iter(self.models)))
+            self.num_evictions += 1
+
+    def remove_model(self, key):
+        model = self.models.pop(key)
+        self.num_bytes -= model['num_bytes']
+        if self.keys_by_file_name.get(key[0]) == key:
+            del self.keys_by_file_name[key[0]]
+
+    # Drops a model, if we have it loaded
+    def remove(self, file_name):
+        file_name = os.path.abspath(file_name)
+        with self.lock:
+            key = self.keys_by_file_name.get(file_name)
+            if key is not None:
+                self.remove_model(key)
+            self.content_hashes.pop(file_name, None)
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+            self.keys_by_file_name.clear()
+            self.content_hashes.clear()
+            self.num_bytes = 0
+
+    def get_content_hash(self, file_name):
+        fingerprint = get_file_fingerprint(file_name)
+        with self.lock:
+            cached_hash = self.content_hashes.get(file_name)
+        if cached_hash is not None and cached_hash[0] == fingerprint:
+            return cached_hash[1]
+
+        content_hash = get_content_hash(file_name)
+        with self.lock:
+            self.content_hashes[file_name] = (fingerprint, content_hash)
+        return content_hash
+
+    def __contains__(self, file_name):
+        with self.lock:
+            return os.path.abspath(file_name) in self.keys_by_file_name
+
+    def __len__(self):
+        return len(self.models)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'num_models': len(self.models),
+                'num_bytes': self.num_bytes,
+                'max_bytes': self.max_bytes,
+                'num_hits': self.num_hits,
+                'num_misses': self.num_misses,
+                'num_coalesced_loads': self.num_coalesced_loads,
+                'num_evictions': self.num_evictions
+            }
@@ -1,5 +1,3 @@
-import math
-
 import numpy as np
 import pandas as pd
 from sklearn.ensemble import GradientBoostingRegressor, GradientBoostingClassifier
@@ -268,9 +266,24 @@ class RegressionScorer(object):
         predictions = estimator.predict(X)
 
         if took_log_of_y:
-            for idx, val in enumerate(predictions):
-                predictions[idx] = math.exp(val)
+            predictions = utils.exp_predictions(predictions)
+
+        score, predictions, y = self.calculate_score(predictions, y)
+
+        if advanced_scoring is True:
+            if hasattr(estimator, 'name'):
+                print(estimator.name)
+            advanced_scoring_regressors(predictions, y, verbose=verbose, name=name)
+        return -1 * score
+
+    # Same as .score(), for predictions we have already made. y must already have had its missing
+    # values dropped.
+    def score_predictions(self, predictions, y):
+        return -1 * self.calculate_score(predictions, y)[0]
 
+    # Returns the score, along with the predictions and y values it was calculated on (which will
+    # have had any null or infinity values removed)
+    def calculate_score(self, predictions, y):
         try:
             score = self.scoring_func(y, predictions)
         except ValueError:
@@ -289,11 +302,7 @@ class RegressionScorer(object):
                   'dataset')
             score = self.scoring_func(y, predictions)
 
-        if advanced_scoring is True:
-            if hasattr(estimator, 'name'):
-                print(estimator.name)
-            advanced_scoring_regressors(predictions, y, verbose=verbose, name=name)
-        return -1 * score
+        return score, predictions, y
 
 
 class ClassificationScorer(object):
@@ -361,7 +370,22 @@ class ClassificationScorer(object):
         # predictions = estimator.predict_proba(X)
         # Start new code
         predictions = np.array(estimator.predict_proba(X))
+        # End new code
+
+        score, predictions = self.calculate_score(predictions, y)
+
+        if advanced_scoring:
+            return -1 * score, predictions
+        else:
+            return -1 * score
 
+    # Same as .score(), for predicted probabilities we have already made. y must already have had
+    # its missing values dropped.
+    def score_predictions(self, predictions, y):
+        return -1 * self.calculate_score(np.array(predictions), y)[0]
+
+    # Returns the score, along with the predictions it was calculated on
+    def calculate_score(self, predictions, y):
         kwargs = {}
         if np.unique(y).size > 2 or predictions.ndim > 1:
             if self.scoring_method in ['log_loss', 'roc_auc']:
@@ -372,15 +396,13 @@ class ClassificationScorer(object):
             if self.scoring_method in ['f1_score']:
                 predictions = predictions.argmax(axis=1)
                 kwargs['average'] = 'weighted'
-        # End new code
 
         if self.scoring_method == 'brier_score_loss':
             # Should this actually say < 1 and > 0?
             # At the moment, Microsoft's LightGBM returns probabilities > 1 and < 0, which can
             # break some scoring functions. So we have to take the max of 1 and the pred,
             # and the min of 0 and the pred.
-            probabilities = [max(min(row[1], 1), 0) for row in predictions]
-            predictions = probabilities
+            predictions = np.clip(predictions[:, 1], 0, 1)
 
         try:
             # TODO: Check new code
@@ -416,7 +438,4 @@ class ClassificationScorer(object):
             score *= -1    # value needs to go up to optimize these
         # End new code
 
-        if advanced_scoring:
-            return -1 * score, predictions
-        else:
-            return -1 * score
+        return score, predictions
@@ -0,0 +1,389 @@
+import asyncio
+import math
+
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from brainless.DataFrameVectorizer import bad_values, stringify_category
+from brainless.utils.cleaning.utils_data_cleaning import add_date_features_dict, \
+    clean_val_nan_version
+from brainless.utils.scaling.utils_scaling import scale_val
+
+numeric_col_descs = {'continuous', 'numerical', 'float', 'int'}
+date_feature_suffixes = ['_day_of_week', '_hour', '_minutes_into_day', '_is_weekend']
+
+
+# A ServingPlan is a flattened, pre-resolved version of the transformation steps of a trained
+# ExtendedPipeline. Walking the full sklearn pipeline for a single dictionary means running the
+# dict branches of BasicDataCleaning, CustomSparseScaler and DataFrameVectorizer, and then
+# building and sorting a scipy CSR matrix for a single row. For single-row predictions in
+# production, that dispatch overhead dominates the time spent inside the model itself.
+
+# At compile time we resolve, for every raw input column, exactly which slot (or slots) of the
+# final feature vector it writes to, along with any scaling range and label encoder that applies.
+# At prediction time, we just walk the incoming dictionary once and write straight into a
+# float32 vector.
+
+# The plan holds references to the fitted transformers, not copies. If the pipeline is modified
+# after it has been compiled (restricted, retrained, etc.), call compile_for_serving() again.
+class ServingPlan(object):
+
+    def __init__(self, pipeline):
+        named_steps = pipeline.named_steps
+        step_names = [step[0] for step in pipeline.steps]
+
+        if 'basic_transform' not in named_steps or 'dv' not in named_steps:
+            raise ValueError('compile_for_serving() expects a trained brainless pipeline with '
+                             'both a "basic_transform" and a "dv" step')
+
+        self.user_func = named_steps.get('user_func')
+
+        # Everything after DataFrameVectorizer (feature_learning_model, for instance) is run
+        # as-is on our dense vector. The final estimator, if there is one, is kept separately.
+        if step_names[-1] == 'final_model':
+            self.final_model = pipeline.steps[-1][1]
+            post_dv_steps = pipeline.steps[step_names.index('dv') + 1:-1]
+        else:
+            self.final_model = None
+            post_dv_steps = pipeline.steps[step_names.index('dv') + 1:]
+        self.post_dv_steps = [step[1] for step in post_dv_steps if step[1] is not None]
+
+        cleaner = named_steps['basic_transform']
+        scaler = named_steps.get('scaler')
+        dv = named_steps['dv']
+
+        self.datatype = dv.datatype
+        self.num_features = len(dv.vocabulary_)
+        self.keep_cat_features = dv.get('keep_cat_features', False)
+        if scaler is not None and scaler.get('perform_feature_scaling', True):
+            self.column_ranges = scaler.get('column_ranges', {})
+            self.truncate_large_values = scaler.truncate_large_values
+        else:
+            self.column_ranges = {}
+            self.truncate_large_values = False
+
+        self.vocabulary = dv.vocabulary_
+        self.categorical_index = dv.get_categorical_index()
+        self.label_encoders = dv.get('label_encoders', {})
+        self.dv_column_descriptions = dv.column_descriptions
+
+        column_descriptions = cleaner.get('transformed_column_descriptions',
+                                          cleaner.column_descriptions)
+        text_columns = cleaner.get('text_columns', {})
+
+        self.handlers = {}
+        for col_name, col_desc in column_descriptions.items():
+            if col_desc in numeric_col_descs:
+                slot = self._numeric_slot(col_name)
+                if slot is not None:
+                    self.handlers[col_name] = ('numeric', slot)
+            elif col_desc == 'date':
+                slots = {}
+                for suffix in date_feature_suffixes:
+                    slot = self._numeric_slot(col_name + suffix)
+                    if slot is not None:
+                        slots[col_name + suffix] = slot
+                # _day_part is a categorical feature, so it gets one-hot encoded like any other
+                day_part_value_map = {}
+                if not self.keep_cat_features:
+                    day_part_value_map = self._one_hot_value_map(col_name + '_day_part')
+                if len(slots) > 0 or len(day_part_value_map) > 0:
+                    date_format = cleaner.get('date_formats', {}).get(col_name)
+                    self.handlers[col_name] = ('date', (slots, day_part_value_map, date_format))
+            elif col_desc == 'categorical':
+                if self.keep_cat_features:
+                    if col_name in self.vocabulary:
+                        self.handlers[col_name] = ('label_encoded',
+                                                   (self.vocabulary[col_name],
+                                                    self.label_encoders[col_name]))
+                else:
+                    value_map = self._one_hot_value_map(col_name)
+                    if len(value_map) > 0:
+                        self.handlers[col_name] = ('one_hot', value_map)
+            elif col_name in text_columns:
+                vectorizer = text_columns[col_name]
+                slots = [
+                    self._numeric_slot(feature_name)
+                    for feature_name in vectorizer.cleaned_feature_names
+                ]
+                if any(slot is not None for slot in slots):
+                    self.handlers[col_name] = ('nlp', (vectorizer, slots,
+                                                       self._compile_tfidf(vectorizer, slots)))
+
+    # A slot is (index_in_feature_vector, min_val, inner_range). min_val and inner_range are None
+    # when the scaler did not scale this feature
+    def _numeric_slot(self, feature_name):
+        if feature_name not in self.vocabulary:
+            return None
+        if self.dv_column_descriptions.get(feature_name, False) == 'categorical':
+            return None
+        col_range = self.column_ranges.get(feature_name)
+        if col_range is None:
+            return (self.vocabulary[feature_name], None, None)
+        return (self.vocabulary[feature_name], col_range['min_val'], col_range['inner_range'])
+
+    def _one_hot_value_map(self, col_name):
+        if col_name not in self.categorical_index:
+            return {}
+        start_idx, categories, category_offsets = self.categorical_index[col_name]
+        return {val: start_idx + offset for val, offset in category_offsets.items()}
+
+    # TfidfVectorizer.transform builds two sparse matrices and runs sklearn's validation just to
+    # score a handful of tokens. For the default settings we use (raw counts, idf weighting,
+    # l2 normalization), we can do the same math directly on a dict of token counts.
+    # Returns None if the vectorizer was configured in a way we do not replicate here (including
+    # the stateless HashingVectorizer, which has no vocabulary to compile).
+    @staticmethod
+    def _compile_tfidf(vectorizer, slots):
+        if not isinstance(vectorizer, TfidfVectorizer):
+            return None
+        if vectorizer.get_params().get('binary') or vectorizer.get_params().get('sublinear_tf') \
+                or not vectorizer.get_params().get('use_idf', True) \
+                or vectorizer.get_params().get('norm') != 'l2':
+            return None
+
+        idf = vectorizer.idf_
+        token_map = {}
+        for token, tfidf_idx in vectorizer.vocabulary_.items():
+            token_map[token] = (tfidf_idx, idf[tfidf_idx], slots[tfidf_idx])
+
+        return vectorizer.build_analyzer(), token_map
+
+    def _write_numeric(self, vector, slot, value):
+        col_idx, min_val, inner_range = slot
+        if min_val is not None:
+            value = scale_val(value, min_val, inner_range, self.truncate_large_values)
+        if value in bad_values or np.isnan(value):
+            return
+        vector[col_idx] = value
+
+    # Returns a dense (1, num_features) array, ready to be passed to the final estimator. Like the
+    # full pipeline, we never modify row unless copy=False.
+    def transform(self, row, copy=True):
+        if self.user_func is not None:
+            # A user_func could do anything to row, so it gets a copy
+            if copy:
+                row = dict(row)
+            row = self.user_func.transform(row)
+
+        vector = np.zeros((1, self.num_features), dtype=self.datatype)
+        features = vector[0]
+
+        for key, val in row.items():
+            handler = self.handlers.get(key)
+            if handler is None:
+                continue
+            kind, payload = handler
+
+            if kind == 'numeric':
+                self._write_numeric(features, payload,
+                                    clean_val_nan_version(key, val, replacement_val=0))
+
+            elif kind == 'one_hot':
+                col_idx = payload.get(stringify_category(val))
+                if col_idx is not None:
+                    features[col_idx] = 1
+
+            elif kind == 'label_encoded':
+                col_idx, label_encoder = payload
+                if val in bad_values:
+                    val = '_None'
+                features[col_idx] = label_encoder.transform([val])
+
+            elif kind == 'date':
+                slots, day_part_value_map, date_format = payload
+                date_feature_dict = add_date_features_dict(row, key, date_format=date_format)
+                for feature_name, feature_val in date_feature_dict.items():
+                    slot = slots.get(feature_name)
+                    if slot is not None:
+                        self._write_numeric(features, slot, feature_val)
+                col_idx = day_part_value_map.get(date_feature_dict.get(key + '_day_part'))
+                if col_idx is not None:
+                    features[col_idx] = 1
+
+            elif kind == 'nlp':
+                vectorizer, slots, compiled_tfidf = payload
+                try:
+                    text_val = str(val)
+                except UnicodeEncodeError:
+                    text_val = val.encode('ascii', 'ignore').decode('ascii')
+
+                if compiled_tfidf is None:
+                    nlp_matrix = vectorizer.transform([text_val]).tocoo()
+                    for tfidf_idx, tfidf_val in zip(nlp_matrix.col, nlp_matrix.data):
+                        slot = slots[tfidf_idx]
+                        if slot is not None:
+                            self._write_numeric(features, slot, tfidf_val)
+                    continue
+
+                analyzer, token_map = compiled_tfidf
+                token_counts = {}
+                for token in analyzer(text_val):
+                    if token in token_map:
+                        token_counts[token] = token_counts.get(token, 0) + 1
+
+                weights = []
+                sum_of_squares = 0.0
+                for token, count in token_counts.items():
+                    tfidf_idx, idf_weight, slot = token_map[token]
+                    weight = count * idf_weight
+                    sum_of_squares += weight * weight
+                    weights.append((slot, weight))
+
+                if sum_of_squares > 0:
+                    norm = math.sqrt(sum_of_squares)
+                    for slot, weight in weights:
+                        if slot is not None:
+                            self._write_numeric(features, slot, weight / norm)
+
+        Xt = vector
+        for step in self.post_dv_steps:
+            Xt = step.transform(Xt)
+        return Xt
+
+    def predict(self, row):
+        return self.final_model.predict(self.transform(row))
+
+    def predict_proba(self, row):
+        return self.final_model.predict_proba(self.transform(row))
+
+
+# Rounds n up to the nearest power of two, so our histograms stay small no matter how much traffic
+# we see. A histogram key of 8 counts everything from 5 through 8.
+def histogram_bucket(n):
+    bucket = 1
+    while bucket < n:
+        bucket *= 2
+    return bucket
+
+
+# Wraps a trained model (either a Predictor, or the pipeline returned by load_ml_model) for use
+# inside an asyncio service. Concurrent single-row requests are gathered into one DataFrame and
+# sent through a single vectorized predict/predict_proba call, which is much cheaper than paying
+# the full per-call pipeline overhead for every request.
+
+# A batch is sent off as soon as it has max_batch rows, or max_wait_ms after its first row
+# arrived, whichever comes first. If an executor is passed in, batches run there; otherwise they
+# run on the event loop itself.
+class BatchingPredictor(object):
+
+    def __init__(self, model, max_batch=256, max_wait_ms=2, executor=None):
+        if max_batch < 1:
+            raise ValueError('max_batch must be at least 1')
+        if max_wait_ms < 0:
+            raise ValueError('max_wait_ms cannot be negative')
+
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait_ms = max_wait_ms
+        self.executor = executor
+
+        self.pending = {'predict': [], 'predict_proba': []}
+        self.flush_handles = {'predict': None, 'predict_proba': None}
+
+        self.num_requests = 0
+        self.num_batches = 0
+        self.queue_depth_histogram = {}
+        self.batch_size_histogram = {}
+
+    async def predict(self, row):
+        return await self._submit('predict', row)
+
+    async def predict_proba(self, row):
+        return await self._submit('predict_proba', row)
+
+    # Sends off everything that is currently queued, without waiting for max_wait_ms
+    async def flush(self):
+        for method in self.pending:
+            while len(self.pending[method]) > 0:
+                self._flush(method)
+
+    def get_stats(self):
+        return {
+            'num_requests': self.num_requests,
+            'num_batches': self.num_batches,
+            'queue_depth': sum(len(pending) for pending in self.pending.values()),
+            'queue_depth_histogram': dict(self.queue_depth_histogram),
+            'batch_size_histogram': dict(self.batch_size_histogram)
+        }
+
+    # Only ever called from inside the event loop, by our coroutines and the loop's callbacks
+    def _submit(self, method, row):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        pending = self.pending[method]
+        pending.append((row, future))
+        self.num_requests += 1
+
+        bucket = histogram_bucket(len(pending))
+        self.queue_depth_histogram[bucket] = self.queue_depth_histogram.get(bucket, 0) + 1
+
+        if len(pending) >= self.max_batch:
+            self._flush(method)
+        elif self.flush_handles[method] is None:
+            self.flush_handles[method] = loop.call_later(self.max_wait_ms / 1000.0, self._flush,
+                                                         method)
+        return future
+
+    def _flush(self, method):
+        flush_handle = self.flush_handles[method]
+        if flush_handle is not None:
+            flush_handle.cancel()
+            self.flush_handles[method] = None
+
+        batch = self.pending[method][:self.max_batch]
+        self.pending[method] = self.pending[method][self.max_batch:]
+        # Requests that were cancelled while they waited don't need predictions
+        batch = [(row, future) for row, future in batch if not future.done()]
+        if len(batch) == 0:
+            return
+
+        if len(self.pending[method]) > 0:
+            self.flush_handles[method] = asyncio.get_running_loop().call_later(
+                self.max_wait_ms / 1000.0, self._flush, method)
+
+        self.num_batches += 1
+        bucket = histogram_bucket(len(batch))
+        self.batch_size_histogram[bucket] = self.batch_size_histogram.get(bucket, 0) + 1
+
+        rows = [row for row, future in batch]
+        if self.executor is None:
+            try:
+                results = self._predict_batch(method, rows)
+            except Exception as e:
+                self._resolve(batch, error=e)
+            else:
+                self._resolve(batch, results=results)
+        else:
+            executor_future = asyncio.get_running_loop().run_in_executor(
+                self.executor, self._predict_batch, method, rows)
+            executor_future.add_done_callback(lambda done: self._resolve_from_executor(
+                batch, done))
+
+    def _predict_batch(self, method, rows):
+        results = getattr(self.model, method)(pd.DataFrame(rows))
+        # Our models unwrap the prediction when they are only given a single row
+        if len(rows) == 1:
+            results = [results]
+        return results
+
+    def _resolve_from_executor(self, batch, executor_future):
+        if executor_future.cancelled():
+            for row, future in batch:
+                future.cancel()
+        elif executor_future.exception() is not None:
+            self._resolve(batch, error=executor_future.exception())
+        else:
+            self._resolve(batch, results=executor_future.result())
+
+    def _resolve(self, batch, results=None, error=None):
+        for idx, (row, future) in enumerate(batch):
+            # The caller may have given up on this request already
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(results[idx])
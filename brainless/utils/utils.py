@@ -2,12 +2,11 @@ import csv
 import datetime
 import numbers
 import os
+from functools import lru_cache
 
 import numpy as np
 import pandas as pd
-import pkg_resources
 from scipy import sparse as scipy_sparse
-from sklearn.datasets import load_boston
 from sklearn.model_selection import train_test_split
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import LabelEncoder
@@ -121,6 +120,8 @@ def drop_duplicate_columns(df):
 
 
 def get_boston_dataset():
+    from sklearn.datasets import load_boston
+
     boston = load_boston()
     df_boston = pd.DataFrame(boston.data)
     df_boston.columns = boston.feature_names
@@ -136,6 +137,12 @@ bad_string_values = {
 }
 
 
+# Our text features are kept as pandas sparse columns between data cleaning and vectorizing. These
+# (SparseDtype, and the .sparse accessor we build and read them with) need pandas 0.25 or later.
+def is_sparse_col(col_values):
+    return isinstance(col_values.dtype, pd.SparseDtype)
+
+
 def delete_rows_csr(mat, indices):
     """
     Remove the rows denoted by ``indices`` form the CSR sparse matrix ``mat``.
@@ -189,6 +196,21 @@ def drop_missing_y_values(df, y, output_column=None):
     return df, y
 
 
+# The formats predict and predict_proba can return. None is the default python values and lists,
+# 'numpy' is ndarrays, even for a single row.
+prediction_outputs = [None, 'numpy']
+
+
+# Undoes taking the log of y, for all the predictions at once. Hands back the same kind of thing it
+# was given: an ndarray, a list, or a single value.
+def exp_predictions(predictions):
+    if isinstance(predictions, np.ndarray):
+        return np.exp(predictions)
+    if isinstance(predictions, list):
+        return np.exp(np.asarray(predictions, dtype=np.float64)).tolist()
+    return float(np.exp(predictions))
+
+
 class CustomLabelEncoder:
 
     def __init__(self):
@@ -242,17 +264,31 @@ class ExtendedLabelEncoder(LabelEncoder):
         return np.searchsorted(self.classes_, y)[0]
 
 
-def get_versions():
+def get_distribution_version(lib):
+    try:
+        from importlib import metadata
+    except ImportError:
+        # Python < 3.8. pkg_resources scans every installed package when it is imported, so only
+        # fall back to it when we have to.
+        import pkg_resources
+        return pkg_resources.get_distribution(lib).version
+    return metadata.version(lib)
+
+
+# The installed libraries can't change underneath a running process, so we only look them up
+# once, rather than every time we build a pipeline (which happens a lot during a grid search).
+@lru_cache(maxsize=None)
+def get_installed_versions():
     libraries_to_check = [
-        'dill', 'h5py', 'keras', 'lightgbm', 'numpy', 'pandas', 'pathos', 'python', 'scikit-learn',
-        'scipy', 'sklearn-deap2', 'tabulate', 'tensorflow', 'xgboost'
+        'dill', 'h5py', 'keras', 'lightgbm', 'numpy', 'pandas', 'python', 'scikit-learn', 'scipy',
+        'sklearn-deap2', 'tabulate', 'tensorflow', 'threadpoolctl', 'xgboost'
     ]
 
     versions = {'brainless': brainless_version}
 
     for lib in libraries_to_check:
         try:
-            versions[lib] = pkg_resources.get_distribution(lib).version
+            versions[lib] = get_distribution_version(lib)
         except:
             # TODO: Fix bare Except
             pass
@@ -260,6 +296,10 @@ def get_versions():
     return versions
 
 
+def get_versions():
+    return dict(get_installed_versions())
+
+
 class ExtendedPipeline(Pipeline):
 
     def __init__(self, steps, keep_cat_features=False, name=None, training_features=None):
@@ -269,38 +309,91 @@ class ExtendedPipeline(Pipeline):
         self.name = name
         self.feature_importances_ = None
         self.training_features = training_features
+        self.serving_plan = None
+
+    # Pre-resolve all of our transformation steps into a flat plan for single-dictionary
+    # predictions. Once compiled, .predict(dict), .predict_proba(dict), and friends skip walking
+    # the sklearn pipeline entirely. DataFrames and lists of dictionaries are unaffected.
+    def compile_for_serving(self):
+        # Imported here to avoid a circular import (the serving plan relies on our transformers,
+        # which rely on this module)
+        from brainless.utils.serving.utils_serving import ServingPlan
+
+        self.serving_plan = ServingPlan(self)
+        return self
+
+    # Runs X through every step but the final estimator, using the compiled serving plan for
+    # single dictionaries when one is available
+    def _transform_up_to_final_estimator(self, X, copy=True):
+        serving_plan = getattr(self, 'serving_plan', None)
+        if serving_plan is not None and isinstance(X, dict):
+            return serving_plan.transform(X, copy=copy)
+        return self._transform_through_steps(X, self.steps[:-1], copy=copy)
+
+    # For pipelines without a final estimator (like the transformation_pipeline shared by a
+    # CategoricalEnsembler), the serving plan covers every step
+    def transform(self, X, copy=True):
+        serving_plan = getattr(self, 'serving_plan', None)
+        if serving_plan is not None and serving_plan.final_model is None and isinstance(X, dict):
+            return serving_plan.transform(X, copy=copy)
+        return self._transform_through_steps(X, self.steps, copy=copy)
+
+    # We make at most one copy of X, and only when copy is True. Our own steps never modify the
+    # data they are handed, unless we tell basic_transform and the scaler that they can. With
+    # copy=False, X itself may be modified in place, which saves copying a large DataFrame.
+    def _transform_through_steps(self, X, steps, copy=True):
+        # A user_func could do anything to X, so it gets the one copy
+        if copy and 'user_func' in self.named_steps:
+            X = X.copy()
+            copy = False
 
-    @if_delegate_has_method(delegate='_final_estimator')
-    def predict_uncertainty(self, X):
         Xt = X
-        for name, transform in self.steps[:-1]:
-            if transform is not None:
+        for name, transform in steps:
+            if transform is None or transform == 'passthrough':
+                continue
+            if name == 'basic_transform':
+                Xt = transform.transform(Xt, copy=copy)
+            elif name == 'scaler':
+                # Whatever basic_transform hands back is ours to modify
+                Xt = transform.transform(Xt, copy=False)
+            else:
                 Xt = transform.transform(Xt)
+        return Xt
+
+    # output is only passed on when it is set, so that final estimators that don't know about it
+    # keep working. copy=False lets us modify X in place, rather than copying it.
+    @if_delegate_has_method(delegate='_final_estimator')
+    def predict(self, X, output=None, copy=True):
+        Xt = self._transform_up_to_final_estimator(X, copy=copy)
+        if output is None:
+            return self.steps[-1][-1].predict(Xt)
+        return self.steps[-1][-1].predict(Xt, output=output)
+
+    @if_delegate_has_method(delegate='_final_estimator')
+    def predict_proba(self, X, output=None, copy=True):
+        Xt = self._transform_up_to_final_estimator(X, copy=copy)
+        if output is None:
+            return self.steps[-1][-1].predict_proba(Xt)
+        return self.steps[-1][-1].predict_proba(Xt, output=output)
+
+    @if_delegate_has_method(delegate='_final_estimator')
+    def predict_uncertainty(self, X):
+        Xt = self._transform_up_to_final_estimator(X)
         return self.steps[-1][-1].predict_uncertainty(Xt)
 
     @if_delegate_has_method(delegate='_final_estimator')
     def score_uncertainty(self, X):
-        Xt = X
-        for name, transform in self.steps[:-1]:
-            if transform is not None:
-                Xt = transform.transform(Xt)
+        Xt = self._transform_up_to_final_estimator(X)
         return self.steps[-1][-1].score_uncertainty(Xt)
 
     @if_delegate_has_method(delegate='_final_estimator')
     def transform_only(self, X):
-        Xt = X
-        for name, transform in self.steps[:-1]:
-            if transform is not None:
-                Xt = transform.transform(Xt)
+        Xt = self._transform_up_to_final_estimator(X)
         return self.steps[-1][-1].transform_only(Xt)
 
     @if_delegate_has_method(delegate='_final_estimator')
     def predict_intervals(self, X, return_type=None):
-        Xt = X
-        for name, transform in self.steps[:-1]:
-            if transform is not None:
-                Xt = transform.transform(Xt)
-
+        Xt = self._transform_up_to_final_estimator(X)
         return self.steps[-1][-1].predict_intervals(Xt, return_type=return_type)
 
 
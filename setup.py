@@ -77,14 +77,14 @@ setup(
         'lightgbm>=2.0.11',
         'nose>=1.3.0',
         'numpy>=1.11.0',
-        'pandas>=0.18.0',
-        'pathos>=0.2.1',
+        'pandas>=0.25.0',
         'scikit-learn>=0.18.1',
         'scipy>=0.14.0',
         'six>=1.11.0',
         'sklearn-deap2>=0.2.1',
         'tabulate>=0.7.5',
         'tables>=3.4.0',
+        'threadpoolctl>=2.0.0',
     ],
     test_suite='nose.collector',
     tests_require=['nose', 'coveralls'])
@@ -3,10 +3,14 @@ To get standard out, run nosetests as follows:
 nosetests -sv tests
 nosetests --verbosity=2 --detailed-errors --nologcapture --processes=4 --process-restartworker --process-timeout=1000 tests
 """
+import asyncio
 import datetime
 import os
 import random
 import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
 sys.path = [os.path.abspath(os.path.dirname(__file__))] + sys.path
 sys.path = [os.path.abspath(os.path.dirname(os.path.dirname(__file__)))] + sys.path
 
@@ -14,8 +18,10 @@ os.environ['is_test_suite'] = 'True'
 
 from brainless import Predictor
 from brainless.utils.models.utils_models import load_ml_model
+from brainless.utils.serving.utils_serving import BatchingPredictor
 
 import numpy as np
+import pandas as pd
 import tests.utils_testing as utils
 
 
@@ -93,6 +99,330 @@ def test_model_uses_user_provided_training_params(model_name=None):
         assert True
 
 
+def test_compile_for_serving_matches_pipeline_and_is_fast():
+    np.random.seed(0)
+
+    df_boston_train, df_boston_test = utils.get_boston_regression_dataset()
+
+    column_descriptions = {'MEDV': 'output', 'CHAS': 'categorical'}
+
+    ml_predictor = Predictor(type_of_estimator='regressor', column_descriptions=column_descriptions)
+
+    ml_predictor.train(df_boston_train, model_names=['Ridge'])
+
+    df_boston_test_dictionaries = df_boston_test.to_dict('records')
+
+    uncompiled_predictions = [ml_predictor.predict(row) for row in df_boston_test_dictionaries]
+
+    ml_predictor.compile_for_serving()
+
+    # 1. The compiled plan must give the same predictions as walking the full pipeline
+    compiled_predictions = [ml_predictor.predict(row) for row in df_boston_test_dictionaries]
+    assert np.allclose(uncompiled_predictions, compiled_predictions)
+
+    # DataFrames still go through the full pipeline
+    df_predictions = ml_predictor.predict(df_boston_test)
+    assert np.allclose(df_predictions, compiled_predictions)
+
+    # 2. Enforce our single-prediction latency claim from the README
+    data_length = len(df_boston_test_dictionaries)
+    start_time = datetime.datetime.now()
+    for idx in range(1000):
+        row_num = idx % data_length
+        ml_predictor.predict(df_boston_test_dictionaries[row_num])
+    end_time = datetime.datetime.now()
+    duration = end_time - start_time
+
+    print('duration.total_seconds()')
+    print(duration.total_seconds())
+
+    # This runs in about 0.1 seconds for 1000 predictions on a modern laptop
+    # Leave plenty of headroom for slow test boxes, but keep us under 1 millisecond per prediction
+    assert duration.total_seconds() < 1.0
+
+
+def get_row_predictions(ml_predictor, df, method_name):
+    return [getattr(ml_predictor, method_name)(row) for row in df.to_dict('records')]
+
+
+# Compiling must not change a single prediction, whatever kinds of columns the pipeline handles
+def assert_compiled_predictions_match(ml_predictor, df, method_names):
+    uncompiled_predictions = {
+        method_name: get_row_predictions(ml_predictor, df, method_name)
+        for method_name in method_names
+    }
+
+    ml_predictor.compile_for_serving()
+
+    for method_name in method_names:
+        compiled_predictions = get_row_predictions(ml_predictor, df, method_name)
+        assert np.allclose(uncompiled_predictions[method_name], compiled_predictions)
+
+
+def test_compile_for_serving_matches_pipeline_for_classifiers():
+    np.random.seed(0)
+
+    df_titanic_train, df_titanic_test = utils.get_titanic_binary_classification_dataset()
+
+    column_descriptions = {
+        'survived': 'output',
+        'sex': 'categorical',
+        'embarked': 'categorical',
+        'pclass': 'categorical'
+    }
+
+    ml_predictor = Predictor(type_of_estimator='classifier',
+                             column_descriptions=column_descriptions)
+
+    ml_predictor.train(df_titanic_train, model_names=['LogisticRegression'])
+
+    assert_compiled_predictions_match(ml_predictor, df_titanic_test,
+                                      ['predict', 'predict_proba'])
+
+
+def test_compile_for_serving_matches_pipeline_with_date_and_nlp_columns():
+    np.random.seed(0)
+
+    df_boston_train, df_boston_test = utils.get_boston_regression_dataset()
+
+    phrases = ['great food', 'terrible service and cold food', 'ok', '', 'GREAT service!']
+
+    def add_date_and_text(df):
+        # Every few hours, so that every day_part shows up
+        return df.assign(when=pd.date_range('2017-01-01', periods=len(df), freq='7H'),
+                         review=np.random.choice(phrases, len(df)))
+
+    df_boston_train = add_date_and_text(df_boston_train)
+    df_boston_test = add_date_and_text(df_boston_test)
+
+    column_descriptions = {'MEDV': 'output', 'CHAS': 'categorical', 'when': 'date',
+                           'review': 'nlp'}
+
+    # Once with our default TF-IDF vectorizer, once with hashed nlp features
+    for nlp_hashed_features in [None, 64]:
+        ml_predictor = Predictor(type_of_estimator='regressor',
+                                 column_descriptions=column_descriptions)
+
+        ml_predictor.train(df_boston_train, model_names=['Ridge'],
+                           nlp_hashed_features=nlp_hashed_features)
+
+        assert_compiled_predictions_match(ml_predictor, df_boston_test, ['predict'])
+
+
+def test_compile_for_serving_matches_pipeline_with_kept_categorical_features():
+    np.random.seed(0)
+
+    df_titanic_train, df_titanic_test = utils.get_titanic_binary_classification_dataset()
+
+    column_descriptions = {
+        'survived': 'output',
+        'sex': 'categorical',
+        'embarked': 'categorical',
+        'pclass': 'categorical'
+    }
+
+    ml_predictor = Predictor(type_of_estimator='classifier',
+                             column_descriptions=column_descriptions)
+
+    # LightGBM handles categorical features itself, so we label encode them instead of one-hot
+    # encoding them
+    ml_predictor.train(df_titanic_train, model_names=['LGBMClassifier'])
+    assert ml_predictor.transformation_pipeline.keep_cat_features
+
+    assert_compiled_predictions_match(ml_predictor, df_titanic_test,
+                                      ['predict', 'predict_proba'])
+
+
+def test_batching_predictor_matches_dataframe_predictions():
+    np.random.seed(0)
+
+    df_boston_train, df_boston_test = utils.get_boston_regression_dataset()
+
+    column_descriptions = {'MEDV': 'output', 'CHAS': 'categorical'}
+
+    ml_predictor = Predictor(type_of_estimator='regressor', column_descriptions=column_descriptions)
+
+    ml_predictor.train(df_boston_train, model_names=['Ridge'])
+
+    df_boston_test_dictionaries = df_boston_test.to_dict('records')
+
+    batching_predictor = BatchingPredictor(ml_predictor, max_batch=32, max_wait_ms=2)
+
+    async def predict_all():
+        return await asyncio.gather(
+            *[batching_predictor.predict(row) for row in df_boston_test_dictionaries])
+
+    predictions = asyncio.run(predict_all())
+
+    # Batches are sent through the DataFrame path, so we should get exactly what we'd get from
+    # predicting on each batch of 32 rows ourselves
+    expected_predictions = []
+    for idx in range(0, len(df_boston_test_dictionaries), 32):
+        batch = pd.DataFrame(df_boston_test_dictionaries[idx:idx + 32])
+        expected_predictions.extend(ml_predictor.predict(batch))
+
+    assert np.allclose(predictions, expected_predictions)
+
+    stats = batching_predictor.get_stats()
+    print('stats')
+    print(stats)
+    assert stats['num_requests'] == len(df_boston_test_dictionaries)
+    assert stats['num_batches'] == int(np.ceil(len(df_boston_test_dictionaries) / 32.0))
+    assert stats['batch_size_histogram'][32] == len(df_boston_test_dictionaries) // 32
+    assert stats['queue_depth'] == 0
+
+
+class SlowModel(object):
+
+    def __init__(self, model):
+        self.model = model
+
+    def predict(self, rows):
+        time.sleep(0.05)
+        return self.model.predict(rows)
+
+
+def test_batching_predictor_skips_cancelled_requests():
+    np.random.seed(0)
+
+    df_boston_train, df_boston_test = utils.get_boston_regression_dataset()
+
+    column_descriptions = {'MEDV': 'output', 'CHAS': 'categorical'}
+
+    ml_predictor = Predictor(type_of_estimator='regressor', column_descriptions=column_descriptions)
+
+    ml_predictor.train(df_boston_train, model_names=['Ridge'])
+
+    rows = df_boston_test.head(8).to_dict('records')
+    expected_predictions = ml_predictor.predict(pd.DataFrame(rows))
+
+    async def predict_and_cancel(batching_predictor, cancel_after_seconds):
+        tasks = [asyncio.ensure_future(batching_predictor.predict(row)) for row in rows]
+        await asyncio.sleep(cancel_after_seconds)
+        tasks[0].cancel()
+        return await asyncio.gather(*tasks[1:])
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        for cancel_after_seconds in [0, 0.02]:
+            # Cancelled while it's still queued, and while its batch is being predicted
+            batching_predictor = BatchingPredictor(SlowModel(ml_predictor), max_batch=16,
+                                                   max_wait_ms=10, executor=executor)
+            predictions = asyncio.run(predict_and_cancel(batching_predictor,
+                                                         cancel_after_seconds))
+            assert np.allclose(predictions, expected_predictions[1:])
+
+
+def test_numpy_output_matches_default_output():
+    np.random.seed(0)
+
+    df_boston_train, df_boston_test = utils.get_boston_regression_dataset()
+
+    column_descriptions = {'MEDV': 'output', 'CHAS': 'categorical'}
+
+    ml_predictor = Predictor(type_of_estimator='regressor', column_descriptions=column_descriptions)
+
+    ml_predictor.train(df_boston_train, model_names=['Ridge'], take_log_of_y=True)
+
+    predictions = ml_predictor.predict(df_boston_test)
+    numpy_predictions = ml_predictor.predict(df_boston_test, output='numpy')
+    assert isinstance(predictions, list)
+    assert isinstance(numpy_predictions, np.ndarray)
+    assert numpy_predictions.dtype in [np.float32, np.float64]
+    assert numpy_predictions.flags['C_CONTIGUOUS']
+    assert np.allclose(numpy_predictions, predictions)
+    # We are predicting house prices, rather than their logs
+    assert np.median(numpy_predictions) > 10
+
+    # A single dictionary gets an array holding its single prediction
+    row = df_boston_test.to_dict('records')[0]
+    single_prediction = ml_predictor.predict(row, output='numpy')
+    assert single_prediction.shape == (1, )
+    assert np.isclose(single_prediction[0], ml_predictor.predict(row))
+
+    try:
+        ml_predictor.predict(df_boston_test, output='pandas')
+        assert False
+    except ValueError:
+        pass
+
+
+def test_predict_does_not_modify_or_needlessly_copy_its_input():
+    np.random.seed(0)
+
+    df_boston_train, df_boston_test = utils.get_boston_regression_dataset()
+
+    column_descriptions = {'MEDV': 'output', 'CHAS': 'categorical'}
+
+    ml_predictor = Predictor(type_of_estimator='regressor', column_descriptions=column_descriptions)
+
+    ml_predictor.train(df_boston_train, model_names=['Ridge'])
+
+    df_boston_test = pd.concat([df_boston_test] * 100).drop('MEDV', axis=1)
+    df_boston_test.index = np.arange(df_boston_test.shape[0]) * 3 + 7
+    df_boston_test.iloc[::5, 0] = np.nan
+    df_boston_test['CHAS'] = df_boston_test['CHAS'].astype(str)
+    original_df = df_boston_test.copy()
+    input_bytes = df_boston_test.memory_usage(deep=True).sum()
+
+    ml_predictor.predict(df_boston_test.head())
+
+    tracemalloc.start()
+    predictions = ml_predictor.predict(df_boston_test)
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    assert len(predictions) == len(original_df)
+    # Transforming the data takes some working memory, but nothing like a copy at every step
+    assert peak_bytes < 3.75 * input_bytes
+    assert df_boston_test.equals(original_df)
+    assert list(df_boston_test.columns) == list(original_df.columns)
+    assert df_boston_test.index.equals(original_df.index)
+
+    row = original_df.to_dict('records')[0]
+    original_row = dict(row)
+    ml_predictor.predict(row)
+    ml_predictor.predict([row])
+    assert row.keys() == original_row.keys()
+    assert all(row[key] == original_row[key] or pd.isnull(row[key]) for key in row)
+
+    # A user_input_func that modifies its input only ever sees our copy, compiled or not
+    def add_rm_squared(X):
+        X['RM_squared'] = X['RM']**2
+        return X
+
+    user_func_predictor = Predictor(type_of_estimator='regressor',
+                                    column_descriptions=column_descriptions)
+    user_func_predictor.train(df_boston_train, model_names=['Ridge'],
+                              user_input_func=add_rm_squared)
+    user_func_predictor.predict(row)
+    user_func_predictor.predict(original_df)
+    user_func_predictor.compile_for_serving()
+    user_func_predictor.predict(row)
+    assert row.keys() == original_row.keys()
+    assert list(original_df.columns) == list(df_boston_test.columns)
+
+    # Frames with any non-numeric columns get cleaned on copies of just those columns, copy or
+    # not. copy=False only saves us a copy of frames that are numeric all the way through.
+    numeric_df = original_df.astype(np.float64)
+    numeric_input_bytes = numeric_df.memory_usage(deep=True).sum()
+    uncopied_df = numeric_df.copy()
+
+    tracemalloc.start()
+    numeric_predictions = ml_predictor.predict(numeric_df)
+    copied_peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    uncopied_predictions = ml_predictor.predict(uncopied_df, copy=False)
+    uncopied_peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    print('numeric_input_bytes, copied_peak_bytes, uncopied_peak_bytes')
+    print(numeric_input_bytes, copied_peak_bytes, uncopied_peak_bytes)
+    assert np.allclose(numeric_predictions, uncopied_predictions)
+    assert uncopied_peak_bytes < copied_peak_bytes - 0.5 * numeric_input_bytes
+
+
 def test_ignores_new_invalid_features():
 
     # One of the great unintentional features of brainless is that you can pass in new features at prediction time, that weren't present at training time, and they're silently ignored!
@@ -0,0 +1,270 @@
+"""
+nosetests -sv --nologcapture tests/core_tests/bundle_tests.py
+"""
+import json
+import os
+import pickle
+import random
+import shutil
+import sys
+import zipfile
+sys.path = [os.path.abspath(os.path.dirname(__file__))] + sys.path
+sys.path = [os.path.abspath(os.path.dirname(os.path.dirname(__file__)))] + sys.path
+
+os.environ['is_test_suite'] = 'True'
+
+from brainless import load_ml_model, Predictor
+from brainless.utils.bundle import utils_bundle
+from brainless.utils.bundle.utils_bundle import LazyModel
+
+import numpy as np
+
+import tests.utils_testing as utils
+
+
+def remove_saved_file(file_name):
+    if os.path.isdir(file_name):
+        shutil.rmtree(file_name)
+    else:
+        os.remove(file_name)
+
+
+def test_bundles_round_trip_in_every_format():
+    np.random.seed(0)
+
+    df_boston_train, df_boston_test = utils.get_boston_regression_dataset()
+
+    column_descriptions = {'MEDV': 'output', 'CHAS': 'categorical'}
+
+    ml_predictor = Predictor(type_of_estimator='regressor', column_descriptions=column_descriptions)
+
+    ml_predictor.train(df_boston_train, model_names=['RandomForestRegressor'],
+                       prediction_intervals=True)
+
+    predictions = ml_predictor.predict(df_boston_test)
+    intervals = ml_predictor.predict_intervals(df_boston_test)
+
+    # Our test models are small, so make sure some of their arrays end up in their own files
+    min_separate_array_bytes = utils_bundle.min_separate_array_bytes
+    utils_bundle.min_separate_array_bytes = 1024
+    try:
+        for bundle_format in utils_bundle.bundle_formats:
+            file_name = ml_predictor.save(str(random.random()), verbose=False,
+                                          bundle_format=bundle_format)
+
+            try:
+                assert utils_bundle.is_bundle(file_name) == (bundle_format != 'dill')
+                saved_ml_pipeline = load_ml_model(file_name)
+
+                if bundle_format == 'zip':
+                    manifest = utils_bundle.BundleReader(file_name).manifest
+                    assert len(manifest['arrays']) > 0
+                    assert len(manifest['sub_models']) == len(
+                        saved_ml_pipeline.named_steps['final_model'].interval_predictors)
+
+                    # Arrays start on the same alignment they would have in their own .npy file
+                    with zipfile.ZipFile(file_name) as zip_file, open(file_name, 'rb') as raw_file:
+                        for member_name in manifest['arrays']:
+                            header_offset = zip_file.getinfo(member_name).header_offset
+                            raw_file.seek(header_offset + 26)
+                            name_length, extra_length = np.frombuffer(raw_file.read(4), '<u2')
+                            data_offset = header_offset + 30 + name_length + extra_length
+                            assert data_offset % utils_bundle.zip_array_alignment == 0
+
+                if bundle_format != 'dill':
+                    interval_predictors = [
+                        tup[1]
+                        for tup in saved_ml_pipeline.named_steps['final_model'].interval_predictors
+                    ]
+                    assert all(isinstance(predictor, LazyModel) for predictor in
+                               interval_predictors)
+                    assert not any(predictor.is_loaded() for predictor in interval_predictors)
+
+                saved_predictions = saved_ml_pipeline.predict(df_boston_test)
+                assert np.allclose(saved_predictions, predictions)
+
+                saved_intervals = saved_ml_pipeline.predict_intervals(df_boston_test)
+                assert np.allclose(saved_intervals.values, intervals.values)
+            finally:
+                remove_saved_file(file_name)
+    finally:
+        utils_bundle.min_separate_array_bytes = min_separate_array_bytes
+
+
+def test_categorical_bundles_only_load_the_category_models_they_use():
+    np.random.seed(0)
+
+    df_boston_train, df_boston_test = utils.get_boston_regression_dataset()
+
+    column_descriptions = {'MEDV': 'output', 'CHAS': 'categorical'}
+
+    ml_predictor = Predictor(type_of_estimator='regressor', column_descriptions=column_descriptions)
+
+    ml_predictor.train_categorical_ensemble(df_boston_train, categorical_column='CHAS',
+                                            min_category_size=2)
+
+    df_boston_test = df_boston_test[df_boston_test.CHAS == 0]
+    predictions = ml_predictor.predict(df_boston_test)
+
+    file_name = ml_predictor.save(str(random.random()), verbose=False)
+    try:
+        saved_ml_pipeline = load_ml_model(file_name)
+        trained_models = saved_ml_pipeline.trained_models
+        assert len(trained_models) > 1
+        assert all(isinstance(model, LazyModel) for model in trained_models.values())
+        assert not any(model.is_loaded() for model in trained_models.values())
+
+        assert np.allclose(saved_ml_pipeline.predict(df_boston_test), predictions)
+
+        loaded_categories = [
+            category for category, model in trained_models.items() if model.is_loaded()
+        ]
+        assert loaded_categories == [saved_ml_pipeline.get_model_key(0)]
+    finally:
+        remove_saved_file(file_name)
+
+
+def test_large_arrays_and_vocabularies_are_kept_out_of_the_pickle():
+    np.random.seed(0)
+
+    vocabulary = dict(('word_' + str(idx), idx) for idx in range(50000))
+    coefs = np.random.rand(100000)
+    nodes = np.zeros(10000, dtype=[('left_child', '<i8'), ('threshold', '<f8')])
+    saved_obj = {
+        'vocabulary_': vocabulary,
+        'coef_': coefs,
+        'same_coef_': coefs,
+        'nodes': nodes,
+        'small_array': np.arange(3),
+        'small_vocabulary': {'a': 0},
+        'objects': np.array([{'a': 1}] * 100000, dtype=object)
+    }
+
+    for bundle_format in ['zip', 'directory']:
+        file_name = str(random.random())
+        manifest = utils_bundle.save_bundle(saved_obj, file_name, bundle_format=bundle_format)
+        try:
+            # The vocabulary's keys and values, coef_ (once), and nodes
+            assert len(manifest['arrays']) == 4
+
+            loaded_obj = utils_bundle.load_bundle(file_name)
+            assert loaded_obj['vocabulary_'] == vocabulary
+            assert np.array_equal(loaded_obj['coef_'], coefs)
+            assert loaded_obj['same_coef_'] is loaded_obj['coef_']
+            assert loaded_obj['nodes'].dtype == nodes.dtype
+            assert np.array_equal(loaded_obj['small_array'], np.arange(3))
+            assert loaded_obj['small_vocabulary'] == {'a': 0}
+            assert len(loaded_obj['objects']) == 100000
+        finally:
+            remove_saved_file(file_name)
+
+
+def test_bundles_from_newer_versions_of_brainless_raise_an_error():
+    file_name = str(random.random())
+    utils_bundle.save_bundle({'a': 1}, file_name, bundle_format='directory')
+    try:
+        manifest_path = os.path.join(file_name, utils_bundle.manifest_name)
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        manifest['format_version'] = utils_bundle.bundle_format_version + 1
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+
+        try:
+            load_ml_model(file_name)
+            assert False
+        except ValueError as e:
+            assert 'newer bundle format' in str(e)
+    finally:
+        remove_saved_file(file_name)
+
+
+class UnpicklableModel(object):
+
+    def __reduce__(self):
+        raise pickle.PicklingError('this model cannot be pickled')
+
+
+def test_failed_saves_leave_nothing_behind():
+    file_name = str(random.random())
+    try:
+        utils_bundle.save_bundle({'model': UnpicklableModel()}, file_name, bundle_format='zip')
+        assert False
+    except pickle.PicklingError:
+        pass
+
+    assert not os.path.exists(file_name)
+    assert not os.path.exists(file_name + '.tmp')
+
+
+def test_default_file_names_match_the_bundle_format():
+    df_boston_train, df_boston_test = utils.get_boston_regression_dataset()
+
+    column_descriptions = {'MEDV': 'output', 'CHAS': 'categorical'}
+
+    ml_predictor = Predictor(type_of_estimator='regressor', column_descriptions=column_descriptions)
+
+    ml_predictor.train(df_boston_train, model_names=['Ridge'])
+
+    for bundle_format in utils_bundle.bundle_formats:
+        file_name = ml_predictor.save(verbose=False, bundle_format=bundle_format)
+        try:
+            assert file_name == utils_bundle.default_file_names[bundle_format]
+            assert file_name.endswith('.dill') == (bundle_format == 'dill')
+            assert utils_bundle.is_bundle(file_name) == (bundle_format != 'dill')
+            load_ml_model(file_name).predict(df_boston_test)
+        finally:
+            remove_saved_file(file_name)
+
+
+def test_memory_mapped_bundles_share_their_arrays():
+    np.random.seed(0)
+
+    coefs = np.random.rand(100000)
+    for bundle_format in ['zip', 'directory']:
+        file_name = str(random.random())
+        utils_bundle.save_bundle({'coef_': coefs}, file_name, bundle_format=bundle_format)
+        try:
+            loaded_coefs = utils_bundle.load_bundle(file_name, mmap_mode='r')['coef_']
+            assert isinstance(loaded_coefs.base, np.memmap)
+            assert not loaded_coefs.flags.writeable
+            assert np.array_equal(loaded_coefs, coefs)
+
+            loaded_coefs = utils_bundle.load_bundle(file_name, mmap_mode='c')['coef_']
+            loaded_coefs[0] = -1
+            assert np.array_equal(utils_bundle.load_bundle(file_name)['coef_'], coefs)
+        finally:
+            remove_saved_file(file_name)
+
+    df_boston_train, df_boston_test = utils.get_boston_regression_dataset()
+
+    column_descriptions = {'MEDV': 'output', 'CHAS': 'categorical'}
+
+    ml_predictor = Predictor(type_of_estimator='regressor', column_descriptions=column_descriptions)
+
+    ml_predictor.train(df_boston_train, model_names=['Ridge'])
+
+    predictions = ml_predictor.predict(df_boston_test)
+
+    # Our test model is tiny, so make sure its coefficients end up in their own file
+    min_separate_array_bytes = utils_bundle.min_separate_array_bytes
+    utils_bundle.min_separate_array_bytes = 8
+    try:
+        file_name = ml_predictor.save(str(random.random()), verbose=False)
+    finally:
+        utils_bundle.min_separate_array_bytes = min_separate_array_bytes
+
+    try:
+        saved_ml_pipeline = load_ml_model(file_name, mmap_mode='r')
+        coef_ = saved_ml_pipeline.named_steps['final_model'].model.coef_
+        assert not coef_.flags.writeable
+
+        assert np.allclose(saved_ml_pipeline.predict(df_boston_test), predictions)
+
+        try:
+            load_ml_model(file_name, mmap_mode='w+')
+            assert False
+        except ValueError as e:
+            assert 'mmap_mode' in str(e)
+    finally:
+        remove_saved_file(file_name)
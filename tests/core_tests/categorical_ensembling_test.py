@@ -6,9 +6,13 @@ sys.path = [os.path.abspath(os.path.dirname(os.path.dirname(__file__)))] + sys.p
 os.environ['is_test_suite'] = 'True'
 
 from brainless import Predictor
+from brainless.utils.categorical.utils_categorical_ensembling import estimate_training_bytes, \
+    partition_rows_by_category
 
 import dill
 import numpy as np
+import pandas as pd
+from scipy import sparse as scipy_sparse
 from nose.tools import assert_equal, assert_not_equal, with_setup
 from sklearn.metrics import accuracy_score
 from sklearn.model_selection import train_test_split
@@ -66,3 +70,86 @@ def test_categorical_ensembling_regression(model_name=None):
     lower_bound = -4.2
 
     assert lower_bound < test_score < -2.8
+
+
+def get_market_df(num_rows=3000):
+    np.random.seed(0)
+    df = pd.DataFrame({
+        'market': np.random.choice(['north', 'south', 'east', 'west', 'tiny'],
+                                   num_rows,
+                                   p=[0.4, 0.3, 0.2, 0.099, 0.001]),
+        'price': np.random.rand(num_rows) * 100,
+        'size': np.random.randint(1, 10, num_rows),
+        'color': np.random.choice(['red', 'blue', 'green'], num_rows)
+    })
+    df['sales'] = df['price'] * (df['market'] == 'north') - df['size'] * 3 + (
+        df['color'] == 'red') * 10 + np.random.randn(num_rows)
+    df['sold_out'] = (df['sales'] > df['sales'].median()).astype(int)
+    return df
+
+
+def test_batch_predictions_match_row_by_row_predictions():
+    df = get_market_df()
+    df_train = df.head(2500)
+    # Include a market we never trained on, so rows have to fall back on the default_category
+    df_test = df.tail(500).copy()
+    df_test.loc[df_test.index[::50], 'market'] = 'brand_new_market'
+
+    for type_of_estimator, output_column in [('regressor', 'sales'), ('classifier', 'sold_out')]:
+        column_descriptions = {
+            output_column: 'output',
+            'market': 'categorical',
+            'color': 'categorical'
+        }
+        other_output_column = 'sold_out' if output_column == 'sales' else 'sales'
+
+        ml_predictor = Predictor(type_of_estimator=type_of_estimator,
+                                 column_descriptions=column_descriptions)
+        ml_predictor.train_categorical_ensemble(df_train.drop(other_output_column, axis=1),
+                                                categorical_column='market')
+
+        row_by_row_predictions = [ml_predictor.predict(row) for row in df_test.to_dict('records')]
+        batch_predictions = ml_predictor.predict(df_test)
+        assert len(batch_predictions) == len(df_test)
+        assert np.allclose(batch_predictions, row_by_row_predictions)
+
+        if type_of_estimator == 'classifier':
+            row_by_row_probas = [
+                ml_predictor.predict_proba(row) for row in df_test.to_dict('records')
+            ]
+            batch_probas = ml_predictor.predict_proba(df_test)
+            assert np.allclose(np.array(batch_probas), np.array(row_by_row_probas))
+
+            numpy_probas = ml_predictor.predict_proba(df_test, output='numpy')
+            assert numpy_probas.shape == (len(df_test), 2)
+            assert np.allclose(numpy_probas, np.array(batch_probas))
+
+        numpy_predictions = ml_predictor.predict(df_test, output='numpy')
+        assert isinstance(numpy_predictions, np.ndarray)
+        assert numpy_predictions.shape == (len(df_test), )
+        assert np.allclose(numpy_predictions, batch_predictions)
+        assert np.allclose(ml_predictor.predict(df_test.to_dict('records')[:1], output='numpy'),
+                           row_by_row_predictions[:1])
+
+        # A single dictionary still gets a single prediction back
+        single_prediction = ml_predictor.predict(df_test.to_dict('records')[0])
+        assert np.isclose(single_prediction, row_by_row_predictions[0])
+
+
+def test_partitioning_rows_by_category_matches_finding_each_category():
+    np.random.seed(0)
+    category_values = pd.Series(np.random.choice(['a', 'b', 'c', 7, 'nan'], 10000))
+
+    categories_and_indices = partition_rows_by_category(category_values)
+
+    assert sorted(str(category) for category, indices in categories_and_indices) == sorted(
+        str(category) for category in category_values.unique())
+    for category, indices in categories_and_indices:
+        assert list(indices) == list(np.flatnonzero(category_values == category))
+
+    X = scipy_sparse.random(10000, 50, density=0.1, format='csr', random_state=0)
+    estimated_bytes = estimate_training_bytes(
+        X, [indices for category, indices in categories_and_indices])
+    for (category, indices), category_bytes in zip(categories_and_indices, estimated_bytes):
+        relevant_X = X[indices]
+        assert category_bytes >= relevant_X.toarray().nbytes + relevant_X.data.nbytes
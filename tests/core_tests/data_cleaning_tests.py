@@ -0,0 +1,276 @@
+"""
+nosetests -sv --nologcapture tests/core_tests/data_cleaning_tests.py
+"""
+import datetime
+import decimal
+import os
+import sys
+from unittest import SkipTest
+sys.path = [os.path.abspath(os.path.dirname(__file__))] + sys.path
+sys.path = [os.path.abspath(os.path.dirname(os.path.dirname(__file__)))] + sys.path
+
+os.environ['is_test_suite'] = 'True'
+
+from brainless.DataFrameVectorizer import DataFrameVectorizer
+from brainless.utils.execution import utils_execution
+from brainless.utils.cleaning import utils_data_cleaning
+from brainless.utils.cleaning.utils_data_cleaning import BasicDataCleaning, \
+    add_date_features_df, add_date_features_dict, clean_numeric_column, \
+    clean_val_nan_version, minutes_into_day_parts
+
+import numpy as np
+import pandas as pd
+
+
+def get_messy_numeric_column(num_rows=200000):
+    np.random.seed(0)
+    messy_values = [
+        '1,234.5', '1,,000', ',', 'nan,', 'NAN', 'Infinity', '-inf', 'inf', ' 12 ', '1_000', '1e400',
+        '.5', 'abc', '', 'None', 'null', 'NULL', None, np.nan, float('inf'), True, 7,
+        decimal.Decimal('0.1'),
+        datetime.datetime(2017, 1, 1), [1, 2]
+    ]
+    values = [repr(val) for val in np.random.randn(num_rows) * 1000]
+    for idx in np.random.randint(0, num_rows, 1000):
+        values[idx] = messy_values[idx % len(messy_values)]
+    return pd.Series(values, name='messy')
+
+
+def assert_same_cleaned_values(result, expected):
+    assert list(result.index) == list(expected.index)
+    result = result.values.astype(np.float64)
+    expected = expected.values.astype(np.float64)
+    assert np.array_equal(np.isnan(result), np.isnan(expected))
+    assert np.array_equal(result[~np.isnan(result)], expected[~np.isnan(expected)])
+
+
+def test_clean_numeric_column_matches_clean_val_nan_version():
+    column_values = get_messy_numeric_column()
+
+    expected = column_values.apply(
+        lambda x: clean_val_nan_version('messy', x, replacement_val=0))
+    result = clean_numeric_column('messy', column_values, replacement_val=0)
+
+    assert_same_cleaned_values(result, expected)
+
+
+def test_clean_numeric_column_is_faster_on_csv_style_columns():
+    # What we typically get from a CSV: object dtype, thousands separators, and blanks
+    np.random.seed(0)
+    num_rows = 500000
+    column_values = pd.Series(['{:,}'.format(round(val, 2))
+                               for val in np.random.randn(num_rows) * 100000])
+    column_values[np.random.rand(num_rows) > 0.9] = ''
+
+    start_time = datetime.datetime.now()
+    expected = column_values.apply(
+        lambda x: clean_val_nan_version('csv_style', x, replacement_val=0))
+    apply_duration = (datetime.datetime.now() - start_time).total_seconds()
+
+    start_time = datetime.datetime.now()
+    result = clean_numeric_column('csv_style', column_values, replacement_val=0)
+    vectorized_duration = (datetime.datetime.now() - start_time).total_seconds()
+
+    print('apply_duration')
+    print(apply_duration)
+    print('vectorized_duration')
+    print(vectorized_duration)
+
+    assert_same_cleaned_values(result, expected)
+
+    # On a laptop, this is roughly 3x faster than apply. Comparing the two would make this test
+    # flaky on busy test boxes, so we only make sure nothing has gotten drastically slower.
+    assert vectorized_duration < 15
+
+
+def test_clean_numeric_column_handles_uniform_columns():
+    columns = [
+        pd.Series(['1,000', '2', 'nan', None], index=[5, 6, 7, 8]),
+        pd.Series([1, 2.5, float('nan'), float('-inf')], dtype=object),
+        pd.Series([None, None]),
+        pd.Series([True, False]),
+        pd.Series(pd.Categorical(['1', '2', '1']))
+    ]
+    for column_values in columns:
+        expected = column_values.apply(
+            lambda x: clean_val_nan_version('uniform', x, replacement_val=0))
+        result = clean_numeric_column('uniform', column_values, replacement_val=0)
+        assert_same_cleaned_values(result, expected)
+
+
+def test_parallel_cleaning_matches_serial_cleaning():
+    np.random.seed(0)
+    num_rows = 20000
+    df = pd.DataFrame({
+        'num_as_str': ['{:,}'.format(round(val, 2)) for val in np.random.randn(num_rows) * 1e5],
+        'other_num_as_str': [repr(val) for val in np.random.randn(num_rows)],
+        'when': pd.date_range('2017-01-01', periods=num_rows, freq='17min'),
+        'store': np.random.choice(['a', 'b', 'c'], num_rows),
+        'review': np.random.choice(['great food', 'terrible service', 'ok'], num_rows)
+    })
+    column_descriptions = {'when': 'date', 'store': 'categorical', 'review': 'nlp'}
+
+    cleaner = BasicDataCleaning(column_descriptions=column_descriptions)
+    cleaner.fit(df.copy())
+
+    df_to_clean = df.copy()
+    serial_results = {}
+    for col_name in df_to_clean.columns:
+        serial_results.update(
+            cleaner.process_one_column(column_values=df_to_clean[col_name].copy(),
+                                       col_name=col_name))
+
+    # The test suite runs serially by default, so ask for worker processes explicitly
+    utils_execution.configure_execution(mode='processes', cpu_budget=2)
+    try:
+        parallel_results = {}
+        for result in cleaner.process_columns_in_parallel(df.copy()):
+            parallel_results.update(result)
+    finally:
+        utils_execution.configure_execution()
+
+    assert set(serial_results.keys()) == set(parallel_results.keys())
+    for col_name, serial_values in serial_results.items():
+        assert pd.Series(parallel_results[col_name]).equals(pd.Series(serial_values))
+
+
+# The row-by-row date features we had before add_date_features_df was vectorized
+def apply_date_features(col_data, date_col):
+    col_data = pd.to_datetime(col_data)
+    result = {}
+    result[date_col + '_day_of_week'] = col_data.apply(lambda x: x.weekday()).fillna(0)
+    result[date_col + '_hour'] = col_data.apply(lambda x: x.hour).fillna(0)
+    result[date_col + '_minutes_into_day'] = col_data.apply(
+        lambda x: x.hour * 60 + x.minute).fillna(0)
+    result[date_col + '_is_weekend'] = col_data.apply(lambda x: x.weekday() in (5, 6))
+    result[date_col + '_day_part'] = result[date_col + '_minutes_into_day'].apply(
+        minutes_into_day_parts)
+    return result
+
+
+def test_date_features_match_row_by_row_features():
+    dates = pd.Series(pd.date_range('2017-01-01', periods=5000, freq='7min'))
+    dates_with_missing = dates.copy()
+    dates_with_missing[::50] = pd.NaT
+
+    for col_data in [dates, dates_with_missing, dates.dt.strftime('%Y-%m-%d %H:%M:%S')]:
+        result = add_date_features_df(col_data, 'when')
+        expected = apply_date_features(col_data, 'when')
+
+        assert set(result.keys()) == set(expected.keys())
+        for feature_name, expected_values in expected.items():
+            assert list(result[feature_name]) == list(expected_values)
+
+
+def test_date_format_is_learned_at_fit_time_and_used_for_dicts():
+    if utils_data_cleaning.guess_datetime_format is None:
+        raise SkipTest('this version of pandas cannot guess date formats')
+
+    df = pd.DataFrame({
+        'when': pd.date_range('2017-01-01', periods=200, freq='37min').strftime('%d %b %Y %H:%M'),
+        'num': np.arange(200)
+    })
+
+    cleaner = BasicDataCleaning(column_descriptions={'when': 'date'})
+    cleaner.fit(df.copy())
+    assert cleaner.date_formats['when'] == '%d %b %Y %H:%M'
+
+    df_results = cleaner.process_one_column(column_values=df['when'].copy(), col_name='when')
+
+    for row_idx, date_string in enumerate(df['when']):
+        dict_results = add_date_features_dict({'when': date_string},
+                                              'when',
+                                              date_format=cleaner.date_formats['when'])
+        assert set(dict_results.keys()) == set(df_results.keys())
+        for feature_name, dict_val in dict_results.items():
+            assert dict_val == df_results[feature_name].iloc[row_idx]
+
+    # Anything that doesn't match the format from training still gets parsed
+    dict_results = add_date_features_dict({'when': '2017-06-03T18:45:00'},
+                                          'when',
+                                          date_format=cleaner.date_formats['when'])
+    assert dict_results['when_minutes_into_day'] == 18 * 60 + 45
+    assert dict_results['when_day_part'] == 'dinnertime'
+    assert dict_results['when_is_weekend'] is True
+
+
+def get_text_df(num_rows=5000):
+    np.random.seed(0)
+    words = np.array(['word{}'.format(idx) for idx in range(500)])
+    return pd.DataFrame({
+        'review': [' '.join(np.random.choice(words, 8)) for _ in range(num_rows)],
+        'title': [' '.join(np.random.choice(words, 3)) for _ in range(num_rows)],
+        'num': np.random.randn(num_rows)
+    })
+
+
+def test_text_features_stay_sparse_and_keep_tfidf_weights():
+    df = get_text_df()
+    column_descriptions = {'review': 'nlp', 'title': 'nlp'}
+
+    cleaner = BasicDataCleaning(column_descriptions=column_descriptions)
+    cleaner.fit(df.copy())
+    X = cleaner.transform(df.copy())
+
+    vectorizer = cleaner.text_columns['review']
+    review_cols = vectorizer.cleaned_feature_names
+    for col_name in review_cols:
+        assert isinstance(X[col_name].dtype, pd.SparseDtype)
+
+    expected = vectorizer.transform(df['review']).toarray()
+    assert np.allclose(X[review_cols].sparse.to_dense().values, expected)
+    # These used to be cast to ints, which turned nearly every weight into a 0
+    assert (expected > 0).sum() > df.shape[0]
+
+    dv = DataFrameVectorizer(column_descriptions=column_descriptions)
+    dv_result = dv.fit_transform(X)
+    review_idxs = [dv.vocabulary_[col_name] for col_name in review_cols]
+    assert np.allclose(dv_result[:, review_idxs].toarray(), expected)
+    assert np.allclose(dv_result[:, dv.vocabulary_['num']].toarray().ravel(), df['num'])
+
+
+def test_parallel_text_fitting_matches_serial_fitting():
+    df = get_text_df()
+    column_descriptions = {'review': 'nlp', 'title': 'nlp'}
+
+    serial_cleaner = BasicDataCleaning(column_descriptions=column_descriptions)
+    serial_cleaner.fit(df.copy())
+
+    utils_execution.configure_execution(mode='processes', cpu_budget=2)
+    try:
+        parallel_cleaner = BasicDataCleaning(column_descriptions=column_descriptions)
+        parallel_cleaner.fit_text_columns_in_parallel(df.copy(), ['review', 'title'])
+    finally:
+        utils_execution.configure_execution()
+
+    for col_name in ['review', 'title']:
+        serial_vectorizer = serial_cleaner.text_columns[col_name]
+        parallel_vectorizer = parallel_cleaner.text_columns[col_name]
+        assert serial_vectorizer.vocabulary_ == parallel_vectorizer.vocabulary_
+        assert np.allclose(serial_vectorizer.idf_, parallel_vectorizer.idf_)
+        assert serial_vectorizer.cleaned_feature_names == parallel_vectorizer.cleaned_feature_names
+
+
+def test_hashed_text_features_need_no_vocabulary():
+    df = get_text_df()
+    column_descriptions = {'review': 'nlp', 'title': 'nlp'}
+
+    cleaner = BasicDataCleaning(column_descriptions=column_descriptions, nlp_hashed_features=256)
+    cleaner.fit(df.copy())
+    X = cleaner.transform(df.copy())
+
+    vectorizer = cleaner.text_columns['review']
+    assert not hasattr(vectorizer, 'vocabulary_')
+    review_cols = ['nlp_review_hash_' + str(bucket) for bucket in range(256)]
+    assert vectorizer.cleaned_feature_names == review_cols
+
+    expected = vectorizer.transform(df['review']).toarray()
+    assert expected.min() >= 0
+    assert np.allclose(X[review_cols].sparse.to_dense().values, expected)
+
+    # Single dictionaries land in the same buckets
+    for row_idx in range(20):
+        row = df.iloc[row_idx].to_dict()
+        dict_result = cleaner.transform(row)
+        for bucket, col_name in enumerate(review_cols):
+            assert np.isclose(dict_result.get(col_name, 0), expected[row_idx, bucket])
@@ -0,0 +1,206 @@
+"""
+nosetests -sv --nologcapture tests/core_tests/dataframe_vectorizer_tests.py
+"""
+import datetime
+import numbers
+import os
+import sys
+sys.path = [os.path.abspath(os.path.dirname(__file__))] + sys.path
+sys.path = [os.path.abspath(os.path.dirname(os.path.dirname(__file__)))] + sys.path
+
+os.environ['is_test_suite'] = 'True'
+
+from brainless.DataFrameVectorizer import DataFrameVectorizer
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+
+def get_high_cardinality_df(num_rows=200000, num_categories=2000):
+    np.random.seed(0)
+    df = pd.DataFrame({
+        'num': np.random.rand(num_rows),
+        'store': ['store_' + str(val) for val in np.random.randint(0, num_categories, num_rows)],
+        'zip': np.random.randint(0, num_categories, num_rows),
+        'mixed': np.random.choice([1, 1.0, True, 'a', None, float('nan')], num_rows)
+    })
+    column_descriptions = {'store': 'categorical', 'zip': 'categorical', 'mixed': 'categorical'}
+    return df, column_descriptions
+
+
+# This is how transform_categorical_col worked before it was vectorized. We keep it around as the
+# reference our vectorized version must match, and as the baseline we benchmark against.
+def loop_one_hot_encode_col(dv, col_values, col_name, min_transformed_idx, num_trained_cols):
+    result = sp.lil_matrix((len(col_values), num_trained_cols))
+    for row_idx, val in enumerate(col_values):
+        if not isinstance(val, str):
+            if isinstance(val, numbers.Number) or val is None:
+                val = str(val)
+            else:
+                val = val.encode('utf-8').decode('utf-8')
+
+        feature_name = col_name + dv.separator + val
+        if feature_name in dv.vocabulary_:
+            col_idx = dv.vocabulary_[feature_name]
+            col_idx = col_idx - min_transformed_idx
+
+            result[row_idx, col_idx] = 1
+    return result
+
+
+def test_vectorized_one_hot_matches_loop_and_is_faster():
+    df, column_descriptions = get_high_cardinality_df()
+
+    dv = DataFrameVectorizer(column_descriptions=column_descriptions)
+    dv.fit(df.iloc[:len(df) // 2])
+
+    # Include values that were never seen during training
+    df_test = df.iloc[len(df) // 2:]
+
+    for col_name in ['store', 'zip', 'mixed']:
+        col_idxs = [
+            col_idx for feature_name, col_idx in dv.vocabulary_.items()
+            if feature_name[:len(col_name) + 1] == col_name + dv.separator
+        ]
+        min_transformed_idx = min(col_idxs)
+        num_trained_cols = len(col_idxs)
+        col_values = list(df_test[col_name])
+
+        start_time = datetime.datetime.now()
+        expected = loop_one_hot_encode_col(dv, col_values, col_name, min_transformed_idx,
+                                           num_trained_cols)
+        loop_duration = (datetime.datetime.now() - start_time).total_seconds()
+
+        start_time = datetime.datetime.now()
+        result = dv.one_hot_encode_col(col_values, col_name)
+        vectorized_duration = (datetime.datetime.now() - start_time).total_seconds()
+
+        print(col_name)
+        print('loop_duration')
+        print(loop_duration)
+        print('vectorized_duration')
+        print(vectorized_duration)
+
+        assert result.shape == expected.shape
+        assert (result != expected.tocsr()).nnz == 0
+
+        # On a laptop, this is 5-30x faster than the loop (the mixed-type column is the slow
+        # case), and takes well under a second. Comparing the two would make this test flaky on
+        # busy test boxes, so we only make sure nothing has gotten drastically slower.
+        assert vectorized_duration < 15
+
+
+def test_transform_categorical_col_output_is_unchanged():
+    df, column_descriptions = get_high_cardinality_df(num_rows=5000, num_categories=50)
+
+    dv = DataFrameVectorizer(column_descriptions=column_descriptions)
+    dv.fit(df.iloc[:2500])
+
+    for col_name in ['store', 'zip', 'mixed']:
+        col_values = list(df[col_name].iloc[2500:])
+        df_result = dv.transform_categorical_col(col_values=col_values, col_name=col_name)
+
+        encoded_col_names = sorted(
+            [feature_name for feature_name in dv.vocabulary_
+             if feature_name[:len(col_name) + 1] == col_name + dv.separator],
+            key=lambda feature_name: dv.vocabulary_[feature_name])
+        expected = loop_one_hot_encode_col(dv, col_values, col_name,
+                                           dv.vocabulary_[encoded_col_names[0]],
+                                           len(encoded_col_names))
+        df_expected = pd.DataFrame(expected.toarray(), columns=encoded_col_names)
+
+        assert list(df_result.columns) == list(df_expected.columns)
+        assert (df_result.dtypes == df_expected.dtypes).all()
+        assert df_result.equals(df_expected)
+
+
+def test_dataframe_transform_stays_sparse_and_honors_datatype():
+    df, column_descriptions = get_high_cardinality_df(num_rows=5000, num_categories=200)
+    # 'store' and 'store_type' share a prefix, and must still each get their own block
+    df['store_type'] = np.random.choice(['big', 'small'], len(df))
+    column_descriptions['store_type'] = 'categorical'
+
+    dv = DataFrameVectorizer(column_descriptions=column_descriptions)
+    dv.fit(df.iloc[:2500])
+
+    df_test = df.iloc[2500:].reset_index(drop=True)
+    result = dv.transform(df_test.copy())
+
+    assert sp.isspmatrix_csr(result)
+    assert result.dtype == np.float32
+    assert result.shape == (len(df_test), len(dv.vocabulary_))
+
+    # Build the same thing densely, one feature at a time
+    expected = np.zeros(result.shape, dtype=np.float32)
+    for feature_name, col_idx in dv.vocabulary_.items():
+        if feature_name in df_test.columns:
+            expected[:, col_idx] = df_test[feature_name].fillna(0)
+        else:
+            col_name, val = feature_name.split(dv.separator, 1)
+            col_values = df_test[col_name].fillna(0)
+            expected[:, col_idx] = [str(row_val) == val for row_val in col_values]
+
+    assert np.array_equal(result.toarray(), expected)
+
+
+def test_categorical_index_is_maintained_through_restrict():
+    df, column_descriptions = get_high_cardinality_df(num_rows=2000, num_categories=20)
+    df['store_type'] = np.random.choice(['big', 'small'], len(df))
+    column_descriptions['store_type'] = 'categorical'
+
+    dv = DataFrameVectorizer(column_descriptions=column_descriptions)
+    dv.fit(df)
+
+    for col_name, (start_idx, categories, category_offsets) in dv.categorical_index.items():
+        for offset, val in enumerate(categories):
+            assert dv.vocabulary_[col_name + dv.separator + val] == start_idx + offset
+            assert category_offsets[val] == offset
+
+    # Drop every other feature, including the first category of each block
+    support = [idx % 2 == 1 for idx in range(len(dv.feature_names_))]
+    dv.restrict(support)
+
+    assert len(dv.vocabulary_) == sum(support)
+    num_encoded_features = 0
+    for col_name, (start_idx, categories, category_offsets) in dv.categorical_index.items():
+        for offset, val in enumerate(categories):
+            assert dv.vocabulary_[col_name + dv.separator + val] == start_idx + offset
+        num_encoded_features += len(categories)
+    num_numerical_features = len(dv.numerical_columns) + len(dv.additional_numerical_cols)
+    assert num_encoded_features + num_numerical_features == len(dv.vocabulary_)
+
+    # Models saved before we kept a categorical_index rebuild it from the vocabulary
+    restricted_index = dv.categorical_index
+    dv.categorical_index = None
+    assert dv.get_categorical_index() == restricted_index
+
+    # The dictionary and DataFrame paths agree, row for row
+    df_test = df.iloc[:50].reset_index(drop=True)
+    df_result = dv.transform(df_test.copy()).toarray()
+    for row_idx, row in enumerate(df_test.to_dict('records')):
+        # The DataFrame path fills in missing values before encoding, so leave them out here
+        row = {k: v for k, v in row.items() if not pd.isnull(v)}
+        dict_result = dv.transform(row).toarray()[0]
+        assert np.array_equal(dict_result, df_result[row_idx])
+
+
+def test_restrict_keeps_label_encoded_categorical_columns():
+    df = pd.DataFrame({
+        'a': [1.0, 2.0, 3.0, 4.0],
+        'b': [4.0, 3.0, 2.0, 1.0],
+        'c': ['x', 'y', 'x', 'z'],
+        'd': ['big', 'small', 'big', 'small']
+    })
+    column_descriptions = {'c': 'categorical', 'd': 'categorical'}
+
+    dv = DataFrameVectorizer(column_descriptions=column_descriptions, keep_cat_features=True)
+    dv.fit(df)
+
+    support = [feature_name in ['a', 'c'] for feature_name in dv.feature_names_]
+    dv.restrict(support)
+
+    assert dv.categorical_columns == ['c']
+    result = dv.transform(df.copy())
+    assert sorted(result.columns) == ['a', 'c']
+    assert list(result['c']) == list(dv.label_encoders['c'].transform(df['c']))
@@ -8,9 +8,15 @@ sys.path = [os.path.abspath(os.path.dirname(os.path.dirname(__file__)))] + sys.p
 os.environ['is_test_suite'] = 'True'
 
 from brainless import Predictor
+from brainless.utils.ensembling.utils_ensembling import Ensembler
+from brainless.utils.model_traning.utils_model_training import FinalModelATC, \
+    get_probabilities_array
 from brainless.utils.models.utils_models import load_ml_model
 
 import numpy as np
+import scipy.sparse as sp
+from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
+from sklearn.linear_model import LogisticRegression, Ridge
 import tests.utils_testing as utils
 
 
@@ -232,3 +238,89 @@ def getting_single_predictions_regressor_test():
     # Make sure our score is good, but not unreasonably good
 
     assert lower_bound < second_score < -2.8
+
+
+def get_trained_ensemble_members(type_of_estimator):
+    np.random.seed(0)
+    X = sp.csr_matrix(np.random.randn(3000, 10))
+    y = X[:, 0].toarray().ravel() * 3 + np.random.randn(3000)
+    if type_of_estimator == 'classifier':
+        y = np.digitize(y, [-1, 1])
+        models = [('LogisticRegression', LogisticRegression()),
+                  ('RandomForestClassifier', RandomForestClassifier(n_estimators=20))]
+    else:
+        models = [('Ridge', Ridge()),
+                  ('RandomForestRegressor', RandomForestRegressor(n_estimators=20))]
+
+    members = []
+    for model_name, model in models:
+        model.fit(X, y)
+        members.append(
+            FinalModelATC(model=model,
+                          model_name=model_name,
+                          type_of_estimator=type_of_estimator,
+                          name=model_name))
+    return members, X
+
+
+def vectorized_ensembling_matches_row_by_row_test():
+    for ensemble_method in ['average', 'median', 'max', 'min']:
+        members, X = get_trained_ensemble_members('classifier')
+        ensembler = Ensembler(members, 'classifier', ensemble_method=ensemble_method, num_classes=3)
+        reducer = {'average': np.average, 'median': np.median, 'max': np.max, 'min': np.min}[
+            ensemble_method]
+
+        probas = ensembler.predict_proba(X)
+        member_probas = [member.predict_proba(X) for member in members]
+        assert probas.shape == (X.shape[0], 3)
+        for row_idx in range(0, X.shape[0], 97):
+            for class_idx in range(3):
+                expected = reducer([
+                    member_proba[row_idx][class_idx] for member_proba in member_probas
+                ])
+                assert np.isclose(probas[row_idx][class_idx], expected)
+
+        single_row_probas = ensembler.predict_proba(X[5])
+        assert isinstance(single_row_probas, list)
+        assert np.allclose(single_row_probas, probas[5])
+
+        members, X = get_trained_ensemble_members('regressor')
+        ensembler = Ensembler(members, 'regressor', ensemble_method=ensemble_method)
+        predictions = ensembler.predict(X)
+        member_predictions = [member.predict(X) for member in members]
+        expected = [reducer(row) for row in zip(*member_predictions)]
+        assert np.allclose(predictions, expected)
+        assert np.isclose(ensembler.predict(X[5]), expected[5])
+
+
+def numpy_output_matches_list_output_test():
+    members, X = get_trained_ensemble_members('classifier')
+    ensembler = Ensembler(members, 'classifier', num_classes=3)
+
+    for estimator in members + [ensembler]:
+        probas = estimator.predict_proba(X, output='numpy')
+        assert isinstance(probas, np.ndarray)
+        assert probas.shape == (X.shape[0], 3)
+        assert probas.flags['C_CONTIGUOUS']
+        assert np.allclose(probas, np.array(estimator.predict_proba(X)))
+
+        # A single row still gets a 2D array, rather than a list of probabilities
+        single_row_probas = estimator.predict_proba(X[5], output='numpy')
+        assert single_row_probas.shape == (1, 3)
+        assert np.allclose(single_row_probas[0], probas[5])
+
+    members, X = get_trained_ensemble_members('regressor')
+    ensembler = Ensembler(members, 'regressor')
+
+    for estimator in members + [ensembler]:
+        predictions = estimator.predict(X, output='numpy')
+        assert predictions.shape == (X.shape[0], )
+        assert predictions.dtype == np.float64
+        assert np.allclose(predictions, estimator.predict(X))
+        assert estimator.predict(X[5], output='numpy').shape == (1, )
+
+    # Models that give us only the positive class, or only predicted classes, still get one column
+    # per class
+    assert np.allclose(get_probabilities_array(np.array([[0.25], [0.5]])), [[0.75, 0.25],
+                                                                           [0.5, 0.5]])
+    assert np.allclose(get_probabilities_array(np.array([1, 0, 1])), [[0, 1], [1, 0], [0, 1]])
@@ -0,0 +1,129 @@
+"""
+nosetests -sv --nologcapture tests/core_tests/execution_tests.py
+"""
+import os
+import sys
+from unittest import SkipTest
+sys.path = [os.path.abspath(os.path.dirname(__file__))] + sys.path
+sys.path = [os.path.abspath(os.path.dirname(os.path.dirname(__file__)))] + sys.path
+
+os.environ['is_test_suite'] = 'True'
+
+from brainless.utils.execution import utils_execution
+from brainless.utils.models import utils_models
+
+from threadpoolctl import threadpool_info
+
+
+def test_test_suite_runs_serially_on_one_core():
+    utils_execution.configure_execution()
+
+    assert utils_execution.get_cpu_budget() == 1
+    assert utils_execution.get_n_jobs(-1) == 1
+    assert utils_execution.get_execution_mode('processes') == 'serial'
+    assert utils_models.get_model_from_name('RandomForestRegressor').get_params()['n_jobs'] == 1
+
+
+def test_cpu_budget_caps_n_jobs():
+    utils_execution.configure_execution(cpu_budget=4)
+    try:
+        assert utils_execution.get_n_jobs(-1) == 4
+        assert utils_execution.get_n_jobs(-2) == 3
+        assert utils_execution.get_n_jobs(16) == 4
+        assert utils_execution.get_n_jobs(2) == 2
+        assert utils_models.get_model_from_name('ExtraTreesRegressor').get_params()['n_jobs'] == 4
+
+        utils_execution.configure_execution(mode='serial', cpu_budget=4)
+        assert utils_execution.get_n_jobs(-1) == 1
+    finally:
+        utils_execution.configure_execution()
+
+
+def test_configured_mode_caps_how_parallel_each_call_gets():
+    utils_execution.configure_execution(mode='threads', cpu_budget=4)
+    try:
+        assert utils_execution.get_execution_mode('processes') == 'threads'
+        assert utils_execution.get_execution_mode('threads') == 'threads'
+        assert utils_execution.get_execution_mode('serial') == 'serial'
+    finally:
+        utils_execution.configure_execution()
+
+    try:
+        utils_execution.configure_execution(mode='gpu')
+        assert False
+    except ValueError:
+        pass
+
+
+def test_map_in_workers_keeps_order_in_every_mode():
+    offset = 7
+    items = list(range(20))
+    expected = [item * item + offset for item in items]
+
+    try:
+        for mode in utils_execution.execution_modes:
+            utils_execution.configure_execution(mode=mode, cpu_budget=3)
+            # Closures are fine, even when we fork
+            assert utils_execution.map_in_workers(lambda x: x * x + offset, items) == expected
+    finally:
+        utils_execution.configure_execution()
+
+
+def test_thread_pool_is_reused_across_calls():
+    utils_execution.configure_execution(mode='threads', cpu_budget=2)
+    try:
+        utils_execution.map_in_workers(abs, [-1, -2, -3], preferred_mode='threads')
+        executor = utils_execution.shared_thread_pool['executor']
+        utils_execution.map_in_workers(abs, [-1, -2, -3], preferred_mode='threads')
+        assert utils_execution.shared_thread_pool['executor'] is executor
+    finally:
+        utils_execution.configure_execution()
+
+
+def get_mode_inside_worker(item):
+    return utils_execution.get_execution_mode('processes')
+
+
+def test_work_nested_inside_a_worker_runs_serially():
+    try:
+        for mode in ['threads', 'processes']:
+            utils_execution.configure_execution(mode=mode, cpu_budget=2)
+            assert utils_execution.map_in_workers(get_mode_inside_worker,
+                                                  [1, 2]) == ['serial', 'serial']
+    finally:
+        utils_execution.configure_execution()
+
+
+def test_memory_budget_caps_how_many_workers_run_at_once():
+    utils_execution.configure_execution(cpu_budget=8, memory_budget=1000)
+    try:
+        assert utils_execution.get_max_workers_within_memory_budget([100, 400, 300, 200]) == 4
+        assert utils_execution.get_max_workers_within_memory_budget([100, 600, 300, 200]) == 2
+        # We still have to train the one that doesn't fit on its own
+        assert utils_execution.get_max_workers_within_memory_budget([5000, 10]) == 1
+
+        items = list(range(10))
+        assert utils_execution.map_in_workers(lambda x: x * 2, items,
+                                              max_workers=2) == [x * 2 for x in items]
+    finally:
+        utils_execution.configure_execution()
+
+
+def get_blas_threads_inside_worker(item):
+    return max(pool_info['num_threads'] for pool_info in threadpool_info())
+
+
+def test_workers_split_blas_threads_without_configure_execution():
+    if len(threadpool_info()) == 0:
+        raise SkipTest('numpy is not using a BLAS/OpenMP library we can limit')
+
+    # Only the cpu_budget is set, so nothing has limited the BLAS threads ahead of time
+    utils_execution.execution_config['cpu_budget'] = 4
+    try:
+        for mode in ['threads', 'processes']:
+            utils_execution.execution_config['mode'] = mode
+            blas_threads = utils_execution.map_in_workers(get_blas_threads_inside_worker,
+                                                          [1, 2, 3, 4])
+            assert blas_threads == [1, 1, 1, 1]
+    finally:
+        utils_execution.configure_execution()
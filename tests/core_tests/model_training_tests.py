@@ -0,0 +1,96 @@
+"""
+nosetests -sv --nologcapture tests/core_tests/model_training_tests.py
+"""
+import itertools
+import os
+import sys
+sys.path = [os.path.abspath(os.path.dirname(__file__))] + sys.path
+sys.path = [os.path.abspath(os.path.dirname(os.path.dirname(__file__)))] + sys.path
+
+os.environ['is_test_suite'] = 'True'
+
+from brainless.utils.model_traning.utils_model_training import FinalModelATC, \
+    StagedHoldoutPredictions
+from brainless.utils.scoring.utils_scoring import ClassificationScorer, RegressionScorer
+
+import numpy as np
+from scipy import sparse as scipy_sparse
+from sklearn.ensemble import GradientBoostingClassifier, GradientBoostingRegressor
+
+
+def get_gradient_boosting_data(type_of_estimator, num_classes=2):
+    np.random.seed(0)
+    X = np.random.randn(2000, 8)
+    y = X[:, 0] * 3 + X[:, 1] ** 2 + np.random.randn(2000) * 2
+    if type_of_estimator == 'classifier':
+        y = np.digitize(y, np.percentile(y, np.linspace(0, 100, num_classes + 1)[1:-1]))
+    return scipy_sparse.csr_matrix(X[:1500]), y[:1500], scipy_sparse.csr_matrix(X[1500:]), y[1500:]
+
+
+def test_staged_holdout_predictions_match_the_model():
+    for model, num_classes in [(GradientBoostingRegressor(), None),
+                               (GradientBoostingClassifier(), 2),
+                               (GradientBoostingClassifier(loss='exponential'), 2),
+                               (GradientBoostingClassifier(), 3)]:
+        type_of_estimator = 'classifier' if num_classes is not None else 'regressor'
+        X, y, X_test, y_test = get_gradient_boosting_data(type_of_estimator, num_classes)
+        staged_holdout_predictions = StagedHoldoutPredictions(model, X_test)
+
+        all_stage_predictions = []
+        for num_iter, warm_start in [(1, False), (5, True), (12, True)]:
+            model.set_params(n_estimators=num_iter, warm_start=warm_start)
+            model.fit(X, y)
+            all_stage_predictions.extend(staged_holdout_predictions.get_new_stage_predictions())
+
+        if type_of_estimator == 'classifier':
+            expected_predictions = list(model.staged_predict_proba(X_test))
+        else:
+            expected_predictions = list(model.staged_predict(X_test))
+
+        assert [num_stages for num_stages, predictions in all_stage_predictions
+               ] == list(range(1, 13))
+        for (num_stages, predictions), expected in zip(all_stage_predictions,
+                                                       expected_predictions):
+            assert np.allclose(predictions, expected, rtol=0, atol=1e-10)
+
+
+def test_gradient_boosting_keeps_only_the_trees_up_to_its_best_holdout_score():
+    # subsample < 1 also fits out-of-bag improvements (and scores, on newer versions of sklearn)
+    for type_of_estimator, subsample in itertools.product(['regressor', 'classifier'], [1.0, 0.8]):
+        X, y, X_test, y_test = get_gradient_boosting_data(type_of_estimator)
+        if type_of_estimator == 'classifier':
+            model = GradientBoostingClassifier(learning_rate=0.5, subsample=subsample)
+            scorer = ClassificationScorer()
+        else:
+            model = GradientBoostingRegressor(learning_rate=0.5, subsample=subsample)
+            scorer = RegressionScorer()
+
+        final_model = FinalModelATC(model=model,
+                                    model_name=type(model).__name__,
+                                    type_of_estimator=type_of_estimator,
+                                    _scorer=scorer,
+                                    X_test=X_test,
+                                    y_test=list(y_test))
+        final_model.fit(X, y)
+
+        # A high learning_rate overfits quickly, so we should stop well before the end
+        num_estimators = final_model.model.get_params()['n_estimators']
+        assert final_model.model.estimators_.shape[0] == num_estimators
+        assert num_estimators < 200
+        assert final_model.model.get_params()['warm_start'] is False
+        assert len(final_model.model.train_score_) == num_estimators
+        if subsample < 1:
+            assert len(final_model.model.oob_improvement_) == num_estimators
+            if hasattr(final_model.model, 'oob_scores_'):
+                assert len(final_model.model.oob_scores_) == num_estimators
+                assert final_model.model.oob_score_ == final_model.model.oob_scores_[-1]
+
+        # The trees we kept give us the best score of any number of them
+        if type_of_estimator == 'classifier':
+            stage_predictions = list(final_model.model.staged_predict_proba(X_test.toarray()))
+        else:
+            stage_predictions = list(final_model.model.staged_predict(X_test.toarray()))
+        stage_scores = [scorer.score_predictions(predictions, y_test)
+                        for predictions in stage_predictions]
+        assert stage_scores[-1] >= max(stage_scores) - final_model.min_step_improvement
+        assert np.isclose(scorer.score(final_model, X_test, y_test), stage_scores[-1])
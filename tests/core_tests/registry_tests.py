@@ -0,0 +1,151 @@
+"""
+nosetests -sv --nologcapture tests/core_tests/registry_tests.py
+"""
+import os
+import random
+import sys
+import threading
+import time
+sys.path = [os.path.abspath(os.path.dirname(__file__))] + sys.path
+sys.path = [os.path.abspath(os.path.dirname(os.path.dirname(__file__)))] + sys.path
+
+os.environ['is_test_suite'] = 'True'
+
+from brainless import ModelRegistry, Predictor
+from brainless.utils.registry import utils_registry
+
+import numpy as np
+
+import tests.utils_testing as utils
+
+
+def train_and_save(model_names):
+    df_boston_train, df_boston_test = utils.get_boston_regression_dataset()
+
+    column_descriptions = {'MEDV': 'output', 'CHAS': 'categorical'}
+
+    ml_predictor = Predictor(type_of_estimator='regressor', column_descriptions=column_descriptions)
+    ml_predictor.train(df_boston_train, model_names=model_names)
+
+    file_name = ml_predictor.save(str(random.random()), verbose=False)
+    return file_name, df_boston_test
+
+
+def test_model_size_counts_shared_arrays_once_and_skips_memory_maps():
+    array = np.ones(100000)
+    model = {'coef_': array, 'view': array[:10], 'same_coef': array}
+    model_size = utils_registry.get_model_size(model)
+    assert array.nbytes < model_size < 2 * array.nbytes
+
+    vocabulary = dict(('word_' + str(idx), idx) for idx in range(10000))
+    assert utils_registry.get_model_size({'vocabulary_': vocabulary}) > 10000 * 50
+
+    file_name = str(random.random())
+    try:
+        np.save(file_name + '.npy', array)
+        mapped_array = np.load(file_name + '.npy', mmap_mode='r')
+        assert utils_registry.get_model_size({'coef_': mapped_array}) < array.nbytes
+        del mapped_array
+    finally:
+        os.remove(file_name + '.npy')
+
+
+def test_registry_caches_models_and_evicts_the_least_recently_used():
+    file_names = []
+    try:
+        for _ in range(3):
+            file_name, df_boston_test = train_and_save(['RandomForestRegressor'])
+            file_names.append(file_name)
+
+        registry = ModelRegistry()
+        first_pipeline = registry.get(file_names[0])
+        assert registry.get(file_names[0]) is first_pipeline
+        first_pipeline.predict(df_boston_test)
+
+        stats = registry.get_stats()
+        assert stats['num_misses'] == 1
+        assert stats['num_hits'] == 1
+        assert stats['num_bytes'] > 0
+
+        # Room for about two of our models
+        registry = ModelRegistry(max_bytes=int(stats['num_bytes'] * 2.5))
+        for file_name in file_names[:2]:
+            registry.get(file_name)
+        # Using the first model makes the second the least recently used
+        registry.get(file_names[0])
+        registry.get(file_names[2])
+
+        assert file_names[0] in registry
+        assert file_names[1] not in registry
+        assert file_names[2] in registry
+        assert registry.get_stats()['num_evictions'] == 1
+
+        # A model bigger than our whole budget is still kept, on its own
+        registry = ModelRegistry(max_bytes=1)
+        registry.get(file_names[0])
+        registry.get(file_names[1])
+        assert len(registry) == 1
+        assert file_names[1] in registry
+    finally:
+        for file_name in file_names:
+            os.remove(file_name)
+
+
+def test_registry_reloads_models_whose_files_changed():
+    file_name, df_boston_test = train_and_save(['Ridge'])
+    try:
+        registry = ModelRegistry()
+        first_pipeline = registry.get(file_name)
+
+        new_file_name, _ = train_and_save(['LinearRegression'])
+        os.replace(new_file_name, file_name)
+
+        second_pipeline = registry.get(file_name)
+        assert second_pipeline is not first_pipeline
+        assert second_pipeline.named_steps['final_model'].model_name == 'LinearRegression'
+        assert len(registry) == 1
+
+        # A known hash skips reading the file altogether
+        assert registry.get(file_name, content_hash='v1') is not second_pipeline
+        assert registry.get(file_name, content_hash='v1') is registry.get(file_name,
+                                                                          content_hash='v1')
+    finally:
+        os.remove(file_name)
+
+
+def test_concurrent_gets_load_a_model_once():
+    file_name, df_boston_test = train_and_save(['Ridge'])
+    try:
+        registry = ModelRegistry()
+
+        load_ml_model = utils_registry.load_ml_model
+        num_loads = []
+
+        def slow_load_ml_model(*args, **kwargs):
+            num_loads.append(1)
+            time.sleep(0.2)
+            return load_ml_model(*args, **kwargs)
+
+        utils_registry.load_ml_model = slow_load_ml_model
+        try:
+            results = []
+            threads = [
+                threading.Thread(target=lambda: results.append(registry.get(file_name)))
+                for _ in range(8)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            utils_registry.load_ml_model = load_ml_model
+
+        assert len(num_loads) == 1
+        assert len(results) == 8
+        assert all(result is results[0] for result in results)
+
+        stats = registry.get_stats()
+        assert stats['num_misses'] == 1
+        assert stats['num_hits'] + stats['num_coalesced_loads'] == 7
+    finally:
+        os.remove(file_name)
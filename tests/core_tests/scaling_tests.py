@@ -0,0 +1,197 @@
+"""
+nosetests -sv --nologcapture tests/core_tests/scaling_tests.py
+"""
+import datetime
+import os
+import pickle
+import sys
+sys.path = [os.path.abspath(os.path.dirname(__file__))] + sys.path
+sys.path = [os.path.abspath(os.path.dirname(os.path.dirname(__file__)))] + sys.path
+
+os.environ['is_test_suite'] = 'True'
+
+from brainless.utils.scaling.utils_scaling import booleans, calculate_scaling_ranges, \
+    CustomSparseScaler, QuantileSketch, scale_val
+
+import numpy as np
+import pandas as pd
+
+
+def get_wide_numeric_df(num_rows=20000, num_cols=40):
+    np.random.seed(0)
+    df = pd.DataFrame(np.random.randn(num_rows, num_cols) * 100,
+                      columns=['col_' + str(idx) for idx in range(num_cols)])
+    df['ints'] = np.random.randint(0, 50, num_rows)
+    df['float32s'] = np.random.rand(num_rows).astype(np.float32) * 7
+    df['binary'] = np.random.randint(0, 2, num_rows)
+    df['bools'] = np.random.rand(num_rows) > 0.5
+    df['mostly_constant'] = 3.0
+    df.loc[:10, 'mostly_constant'] = 5.0
+    df['constant'] = 4.0
+    df['empty'] = np.nan
+    df.loc[::7, 'col_0'] = np.nan
+    return df
+
+
+# The sort-based ranges we had before calculate_scaling_ranges used np.partition
+def sorted_scaling_ranges(X, col, min_percentile=0.05, max_percentile=0.95):
+    series_values = sorted(list(X[col][X[col].notnull()]))
+    if len(series_values) == 0:
+        return 'ignore'
+
+    max_value = series_values[int(max_percentile * len(series_values)) - 1]
+    min_value = series_values[int(min_percentile * len(series_values))]
+    if max_value in booleans or min_value in booleans:
+        return 'pass_on_col'
+
+    inner_range = max_value - min_value
+    if inner_range == 0:
+        max_value = series_values[-1]
+        min_value = series_values[0]
+        inner_range = max_value - min_value
+        if inner_range == 0:
+            if max_value == 1:
+                min_value = 0
+                inner_range = 1
+            else:
+                return 'ignore'
+
+    return {'max_val': max_value, 'min_val': min_value, 'inner_range': inner_range}
+
+
+def test_scaling_ranges_match_sorting_the_whole_column():
+    df = get_wide_numeric_df()
+    small_df = df.head(3)
+
+    for X in [df, small_df]:
+        for col in X.columns:
+            for min_percentile, max_percentile in [(0.05, 0.95), (0.1, 0.9), (0, 1)]:
+                assert calculate_scaling_ranges(X, col, min_percentile,
+                                                max_percentile) == sorted_scaling_ranges(
+                                                    X, col, min_percentile, max_percentile)
+
+
+def test_vectorized_transform_matches_scale_val():
+    df = get_wide_numeric_df()
+
+    for truncate_large_values in [False, True]:
+        scaler = CustomSparseScaler(column_descriptions={},
+                                    truncate_large_values=truncate_large_values)
+        scaler.fit(df)
+        assert 'constant' in scaler.cols_to_ignore
+        assert 'bools' not in scaler.column_ranges
+
+        result = scaler.transform(df.copy())
+
+        for col in df.columns:
+            if col in scaler.cols_to_ignore:
+                assert col not in result.columns
+            elif col not in scaler.column_ranges:
+                assert result[col].equals(df[col])
+            else:
+                col_range = scaler.column_ranges[col]
+                expected = df[col].apply(lambda x: scale_val(
+                    x, col_range['min_val'], col_range['inner_range'], truncate_large_values))
+                assert np.allclose(result[col], expected, equal_nan=True, rtol=0, atol=1e-12)
+
+
+def test_vectorized_scaling_is_faster_on_wide_frames():
+    df = get_wide_numeric_df(num_rows=50000, num_cols=100)
+
+    start_time = datetime.datetime.now()
+    column_ranges = {}
+    for col in df.columns:
+        col_summary = sorted_scaling_ranges(df, col)
+        if isinstance(col_summary, dict):
+            column_ranges[col] = col_summary
+    X = df.copy()
+    for col, col_range in column_ranges.items():
+        X[col] = X[col].apply(lambda x: scale_val(x, col_range['min_val'], col_range[
+            'inner_range']))
+    sorted_duration = (datetime.datetime.now() - start_time).total_seconds()
+
+    start_time = datetime.datetime.now()
+    scaler = CustomSparseScaler(column_descriptions={})
+    scaler.fit(df)
+    scaler.transform(df.copy())
+    vectorized_duration = (datetime.datetime.now() - start_time).total_seconds()
+
+    print('sorted_duration')
+    print(sorted_duration)
+    print('vectorized_duration')
+    print(vectorized_duration)
+    # test_scaling_ranges_match_sorting_the_whole_column and
+    # test_vectorized_transform_matches_scale_val cover correctness. Comparing the two timings
+    # would make this test flaky on busy test boxes, so we only make sure nothing has gotten
+    # drastically slower.
+    assert vectorized_duration < 15
+
+
+# How far (as a fraction of all the values) the true rank of value is from index
+def get_rank_error(sorted_values, value, index):
+    lowest_rank = np.searchsorted(sorted_values, value, side='left')
+    highest_rank = np.searchsorted(sorted_values, value, side='right') - 1
+    if lowest_rank <= index <= highest_rank:
+        return 0
+    return min(abs(lowest_rank - index), abs(highest_rank - index)) / len(sorted_values)
+
+
+def test_quantile_sketch_merges_across_shards_within_error_bound():
+    np.random.seed(0)
+    values = np.concatenate([np.random.randn(300000), np.random.exponential(size=200000) * 10])
+    np.random.shuffle(values)
+    sorted_values = np.sort(values)
+
+    # Sketch each shard in chunks, and ship it through pickle like a worker process would
+    shards = []
+    for shard_idx, shard_values in enumerate(np.array_split(values, 4)):
+        sketch = QuantileSketch(random_seed=shard_idx)
+        for chunk in np.array_split(shard_values, 10):
+            sketch.update(chunk)
+        shards.append(pickle.loads(pickle.dumps(sketch)))
+
+    merged_sketch = shards[0]
+    for sketch in shards[1:]:
+        merged_sketch.merge(sketch)
+
+    assert merged_sketch.count == len(values)
+    assert merged_sketch.min_val == values.min()
+    assert merged_sketch.max_val == values.max()
+    assert sum(len(compactor) for compactor in merged_sketch.compactors) < 4 * merged_sketch.k
+
+    for percentile in [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]:
+        index = int(percentile * len(values))
+        value = merged_sketch.get_value_at_index(index)
+        assert get_rank_error(sorted_values, value, index) < 0.005
+
+
+def test_partial_fit_scaling_ranges_are_close_to_fit():
+    df = get_wide_numeric_df(num_rows=50000)
+
+    scaler = CustomSparseScaler(column_descriptions={})
+    scaler.fit(df)
+
+    shard_scalers = []
+    for shard in np.array_split(df, 3):
+        shard_scaler = CustomSparseScaler(column_descriptions={})
+        for chunk in np.array_split(shard, 5):
+            shard_scaler.partial_fit(chunk)
+        shard_scalers.append(shard_scaler)
+    sketched_scaler = shard_scalers[0].merge(shard_scalers[1]).merge(shard_scalers[2])
+
+    assert set(sketched_scaler.cols_to_ignore) == set(scaler.cols_to_ignore)
+    assert set(sketched_scaler.column_ranges.keys()) == set(scaler.column_ranges.keys())
+
+    for col, col_range in sketched_scaler.column_ranges.items():
+        sorted_values = np.sort(df[col].dropna().values)
+        num_values = len(sorted_values)
+        if col_range == scaler.column_ranges[col]:
+            continue
+        assert get_rank_error(sorted_values, col_range['min_val'], int(0.05 * num_values)) < 0.005
+        assert get_rank_error(sorted_values, col_range['max_val'],
+                              int(0.95 * num_values) - 1) < 0.005
+
+    result = sketched_scaler.transform(df.copy())
+    col_range = sketched_scaler.column_ranges['col_1']
+    assert np.allclose(result['col_1'], (df['col_1'] - col_range['min_val']) /
+                       col_range['inner_range'])
@@ -0,0 +1,233 @@
+"""
+nosetests -sv --nologcapture tests/core_tests/startup_tests.py
+"""
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+sys.path = [os.path.abspath(os.path.dirname(__file__))] + sys.path
+sys.path = [os.path.abspath(os.path.dirname(os.path.dirname(__file__)))] + sys.path
+
+os.environ['is_test_suite'] = 'True'
+
+from brainless import Predictor
+from brainless.utils import utils
+from brainless.utils.models import utils_models
+
+from sklearn.linear_model import Ridge
+
+import tests.utils_testing as utils_testing
+
+# Libraries that only training (or models we aren't using) need. None of these should be imported
+# just to get predictions from a saved pipeline.
+training_only_modules = [
+    'brainless.predictor_base', 'brainless.utils.scoring', 'evolutionary_search', 'deap',
+    'tabulate', 'pathos', 'keras', 'tensorflow', 'xgboost', 'lightgbm', 'catboost'
+]
+
+# These are generous, so that a slow machine doesn't fail them. They're here to catch something
+# like tensorflow (which takes several seconds on its own) sneaking back into our imports.
+max_import_seconds = 2.0
+max_load_seconds = 2.0
+
+repo_dir = os.path.abspath(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+
+# Each benchmark runs in a fresh python process, so nothing this test suite has already imported
+# hides the cost. The libraries every pipeline needs anyway are imported before we start timing.
+startup_benchmark_script = """
+import json
+import sys
+import time
+
+import dill
+import numpy
+import pandas
+import scipy.sparse
+import sklearn.base
+
+start_time = time.time()
+import brainless
+import_seconds = time.time() - start_time
+
+load_seconds = None
+if len(sys.argv) > 1:
+    start_time = time.time()
+    trained_pipeline = brainless.load_ml_model(sys.argv[1])
+    trained_pipeline.predict(json.loads(sys.argv[2]))
+    load_seconds = time.time() - start_time
+
+print(json.dumps({
+    'import_seconds': import_seconds,
+    'load_seconds': load_seconds,
+    'modules': sorted(sys.modules.keys())
+}))
+"""
+
+
+runtime_scoring_script = """
+import json
+import sys
+
+from brainless import runtime
+from brainless.utils.bundle import utils_bundle
+
+trained_pipeline = runtime.load_ml_model(sys.argv[1])
+rows = json.loads(sys.argv[2])
+
+if sys.argv[3] == 'regressor':
+    runtime.predict(trained_pipeline, rows[0])
+    runtime.predict(trained_pipeline, rows)
+    runtime.predict_intervals(trained_pipeline, rows[0])
+    runtime.predict_intervals(trained_pipeline, rows)
+else:
+    runtime.predict_proba(trained_pipeline, rows[0])
+    runtime.predict_proba(trained_pipeline, rows, output='numpy')
+
+saved_training_state = []
+for final_model in utils_bundle.get_all_final_models(trained_pipeline):
+    for attribute_name in utils_bundle.training_only_attributes:
+        if getattr(final_model, attribute_name, None) is not None:
+            saved_training_state.append(attribute_name)
+
+print(json.dumps({
+    'saved_training_state': saved_training_state,
+    'modules': sorted(sys.modules.keys())
+}))
+"""
+
+
+def run_in_fresh_process(script, *args):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([repo_dir] + [
+        path for path in env.get('PYTHONPATH', '').split(os.pathsep) if path
+    ])
+    output = subprocess.check_output([sys.executable, '-c', script] + list(args), env=env,
+                                     cwd=repo_dir)
+    # Anything the libraries themselves print comes before our results
+    return json.loads(output.decode('utf-8').strip().split('\n')[-1])
+
+
+def run_startup_benchmark(*args):
+    results = run_in_fresh_process(startup_benchmark_script, *args)
+    print('import brainless took ' + str(results['import_seconds']) + ' seconds, and loading '
+          'and predicting took ' + str(results['load_seconds']) + ' seconds')
+    return results
+
+
+def get_imported_training_only_modules(modules):
+    return [
+        module_name for module_name in modules if any(
+            module_name == training_only_module or module_name.startswith(training_only_module +
+                                                                          '.')
+            for training_only_module in training_only_modules)
+    ]
+
+
+def test_importing_brainless_skips_training_and_optional_libraries():
+    results = run_startup_benchmark()
+
+    assert get_imported_training_only_modules(results['modules']) == []
+    assert results['import_seconds'] < max_import_seconds
+
+
+def test_loading_a_saved_pipeline_skips_training_and_optional_libraries():
+    df_boston_train, df_boston_test = utils_testing.get_boston_regression_dataset()
+
+    column_descriptions = {'MEDV': 'output', 'CHAS': 'categorical'}
+
+    ml_predictor = Predictor(type_of_estimator='regressor', column_descriptions=column_descriptions)
+
+    ml_predictor.train(df_boston_train, model_names=['Ridge'])
+
+    file_name = ml_predictor.save(str(random.random()), verbose=False)
+    try:
+        row = df_boston_test.iloc[0].to_dict()
+        results = run_startup_benchmark(file_name, json.dumps(row))
+    finally:
+        if os.path.isdir(file_name):
+            shutil.rmtree(file_name)
+        else:
+            os.remove(file_name)
+
+    assert get_imported_training_only_modules(results['modules']) == []
+    assert results['load_seconds'] < max_load_seconds
+
+
+def test_runtime_scoring_only_imports_what_predictions_need():
+    df_boston_train, df_boston_test = utils_testing.get_boston_regression_dataset()
+    df_titanic_train, df_titanic_test = utils_testing.get_titanic_binary_classification_dataset()
+
+    for type_of_estimator, df_train, df_test, column_descriptions, train_kwargs in [
+        ('regressor', df_boston_train, df_boston_test, {
+            'MEDV': 'output',
+            'CHAS': 'categorical'
+        }, {
+            'model_names': ['GradientBoostingRegressor'],
+            'prediction_intervals': True
+        }),
+        ('classifier', df_titanic_train, df_titanic_test, {
+            'survived': 'output',
+            'sex': 'categorical',
+            'embarked': 'categorical',
+            'pclass': 'categorical'
+        }, {
+            'model_names': ['LogisticRegression']
+        })
+    ]:
+        ml_predictor = Predictor(type_of_estimator=type_of_estimator,
+                                 column_descriptions=column_descriptions)
+        ml_predictor.train(df_train, **train_kwargs)
+
+        file_name = ml_predictor.save(str(random.random()), verbose=False)
+        try:
+            rows = json.loads(df_test.head(10).to_json(orient='records'))
+            results = run_in_fresh_process(runtime_scoring_script, file_name, json.dumps(rows),
+                                           type_of_estimator)
+        finally:
+            if os.path.isdir(file_name):
+                shutil.rmtree(file_name)
+            else:
+                os.remove(file_name)
+
+        assert get_imported_training_only_modules(results['modules']) == []
+        assert 'brainless.runtime' in results['modules']
+        assert results['saved_training_state'] == []
+
+        # Saving leaves the predictor we trained just the way it was
+        final_model = ml_predictor.model.trained_pipeline.named_steps['final_model']
+        assert final_model._scorer is not None
+
+
+def test_optional_backends_are_only_imported_when_a_model_needs_them():
+    assert utils_models.get_backend_name('XGBRegressor') == 'xgboost'
+    assert utils_models.get_backend_name('LGBMClassifier') == 'lightgbm'
+    assert utils_models.get_backend_name('CatBoostRegressor') == 'catboost'
+    assert utils_models.get_backend_name('DeepLearningClassifier') == 'keras'
+    assert utils_models.get_backend_name('Ridge') is None
+
+    loaded_backends = dict(utils_models.loaded_backends)
+    assert utils_models.get_model_from_name('Ridge').__class__ == Ridge
+    assert utils_models.get_name_from_model(Ridge()) == 'Ridge'
+    assert utils_models.loaded_backends == loaded_backends
+
+    for backend_name in utils_models.optional_backends:
+        backend = utils_models.get_backend(backend_name)
+        assert utils_models.loaded_backends[backend_name] is backend
+        assert utils_models.is_backend_installed(backend_name) == (backend is not None)
+
+
+def test_versions_are_only_looked_up_once():
+    utils.get_installed_versions.cache_clear()
+
+    versions = utils.get_versions()
+    assert versions['brainless'] == utils.brainless_version
+    assert 'numpy' in versions
+
+    for _ in range(3):
+        pipeline = utils.ExtendedPipeline([('model', Ridge())])
+        assert pipeline.__versions__ == versions
+        assert pipeline.__versions__ is not versions
+
+    assert utils.get_installed_versions.cache_info().misses == 1
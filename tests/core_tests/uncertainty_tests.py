@@ -6,6 +6,10 @@ sys.path = [os.path.abspath(os.path.dirname(os.path.dirname(__file__)))] + sys.p
 os.environ['is_test_suite'] = 'True'
 
 from brainless import Predictor
+from brainless.predictor_base import PredictorBase
+from brainless.utils.model_traning.utils_model_training import get_uc_results_arrays
+
+from collections import OrderedDict
 
 import dill
 from nose.tools import assert_equal, assert_not_equal, with_setup
@@ -156,3 +160,67 @@ def test_calibrate_uncertainty():
     # assert lower_bound < test_score < -2.8
 
     # ml_predictor.get_uncertainty_prediction(df_boston_test)
+
+
+# The row-by-row labeling we had before define_uncertain_predictions was vectorized
+def label_uncertain_predictions_row_by_row(base_predictions, y, uncertainty_delta,
+                                           uncertainty_delta_units, uncertainty_delta_direction):
+    is_uncertain_predictions = []
+    for base_prediction, y_val in zip(base_predictions, y):
+        delta = base_prediction - y_val
+        if uncertainty_delta_units == 'percentage':
+            if uncertainty_delta_direction == 'both':
+                delta = abs(delta) / y_val
+            else:
+                delta = delta / y_val
+        elif uncertainty_delta_direction == 'both':
+            delta = abs(delta)
+
+        if uncertainty_delta_direction == 'both' or uncertainty_delta > 0:
+            is_uncertain_predictions.append(int(delta > uncertainty_delta))
+        else:
+            is_uncertain_predictions.append(int(delta < uncertainty_delta))
+    return is_uncertain_predictions
+
+
+def test_vectorized_uncertainty_labels_match_row_by_row():
+    np.random.seed(0)
+    y = np.random.rand(5000) * 100 + 1
+    base_predictions = y + np.random.randn(5000) * 10
+
+    ml_predictor = PredictorBase(type_of_estimator='regressor', column_descriptions={'y': 'output'})
+
+    for units, deltas in [('absolute', [5, -5]), ('percentage', [0.1, -0.1])]:
+        for direction in ['both', 'directional']:
+            for uncertainty_delta in deltas:
+                ml_predictor.uncertainty_delta = uncertainty_delta
+                ml_predictor.uncertainty_delta_units = units
+                ml_predictor.uncertainty_delta_direction = direction
+
+                expected = label_uncertain_predictions_row_by_row(
+                    base_predictions, y, uncertainty_delta, units, direction)
+                # Base predictions also come in as a column, with one value per row
+                for predictions in [base_predictions, base_predictions.reshape(-1, 1)]:
+                    assert ml_predictor.define_uncertain_predictions(predictions,
+                                                                     list(y)) == expected
+
+
+def test_uncertainty_calibration_buckets_match_linear_search():
+    uc_results = OrderedDict()
+    for bucket_num, max_proba in zip(range(1, 5), [0.1, 0.35, 0.6, 1]):
+        uc_results[bucket_num] = OrderedDict()
+        uc_results[bucket_num]['bucket_num'] = bucket_num
+        uc_results[bucket_num]['max_proba'] = max_proba
+        uc_results[bucket_num]['percentile_50_delta'] = bucket_num * 1.5
+
+    max_probas, calibration_columns = get_uc_results_arrays(uc_results)
+    assert list(calibration_columns.keys()) == ['bucket_num', 'percentile_50_delta']
+
+    probas = np.concatenate([np.random.rand(1000), [0.1, 0.35, 0.6, 1]])
+    bucket_idxs = np.searchsorted(max_probas, probas, side='left')
+    for proba, bucket_idx in zip(probas, bucket_idxs):
+        bucket_num = 1
+        while proba > uc_results[bucket_num]['max_proba']:
+            bucket_num += 1
+        assert calibration_columns['bucket_num'][bucket_idx] == bucket_num
+        assert calibration_columns['percentile_50_delta'][bucket_idx] == bucket_num * 1.5
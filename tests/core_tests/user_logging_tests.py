@@ -1,6 +1,5 @@
 # This set of tests id specifically designed to make sure brainless is user friendly- throwing useful warnings where possible about what specific actions the user can take to avoid an error, instead of throwing the non-obvious error messages that the underlying libraries will choke on.
 import datetime
-import dill
 from nose.tools import raises
 import numpy as np
 import os
@@ -12,7 +11,7 @@ sys.path = [os.path.abspath(os.path.dirname(os.path.dirname(__file__)))] + sys.p
 
 os.environ['is_test_suite'] = 'True'
 
-from brainless import Predictor
+from brainless import load_ml_model, Predictor
 import tests.utils_testing as utils
 
 
@@ -117,8 +116,7 @@ def test_verify_features_finds_missing_prediction_features():
 
     file_name = ml_predictor.save(str(random.random()))
 
-    with open(file_name, 'rb') as read_file:
-        saved_ml_pipeline = dill.load(read_file)
+    saved_ml_pipeline = load_ml_model(file_name)
     os.remove(file_name)
     try:
         keras_file_name = file_name[:-5] + '_keras_deep_learning_model.h5'
@@ -162,8 +160,7 @@ def test_verify_features_finds_missing_training_features():
 
     file_name = ml_predictor.save(str(random.random()))
 
-    with open(file_name, 'rb') as read_file:
-        saved_ml_pipeline = dill.load(read_file)
+    saved_ml_pipeline = load_ml_model(file_name)
     os.remove(file_name)
     try:
         keras_file_name = file_name[:-5] + '_keras_deep_learning_model.h5'
@@ -201,8 +198,7 @@ def test_verify_features_finds_no_missing_features_when_none_are_missing():
 
     file_name = ml_predictor.save(str(random.random()))
 
-    with open(file_name, 'rb') as read_file:
-        saved_ml_pipeline = dill.load(read_file)
+    saved_ml_pipeline = load_ml_model(file_name)
     os.remove(file_name)
 
     missing_features = saved_ml_pipeline.named_steps['final_model'].verify_features(df_titanic_test)